@@ -0,0 +1,50 @@
+"""
+Fixtures comunes de las pruebas
+Las pruebas de base de datos usan SQLite en memoria con los modelos de shared.database
+"""
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, Integer, Float, Boolean, DateTime, Date, String, Text
+from sqlalchemy.orm import sessionmaker
+
+pytest_plugins = ['web.testing']
+
+_PLACEHOLDERS = (
+    (Boolean, False),
+    (Integer, 0),
+    (Float, 0.0),
+    (DateTime, datetime.utcnow),
+    (Date, lambda: datetime.utcnow().date()),
+    (String, 'x'),
+    (Text, 'x')
+)
+
+def _placeholder(column):
+    for column_type, value in _PLACEHOLDERS:
+        if isinstance(column.type, column_type):
+            return value() if callable(value) else value
+    return None
+
+@pytest.fixture
+def bot_db():
+    """Sesión sobre una base SQLite en memoria con las tablas de shared.database"""
+    database = pytest.importorskip('shared.database')
+    engine = create_engine('sqlite://')
+    database.Group.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+@pytest.fixture
+def make_row():
+    """Crea una fila del modelo rellenando las columnas obligatorias que no se indiquen"""
+    def make(model, **values):
+        for column in model.__table__.columns:
+            if column.key in values or column.primary_key or column.nullable:
+                continue
+            if column.default is not None or column.server_default is not None:
+                continue
+            values[column.key] = _placeholder(column)
+        return model(**values)
+    return make
@@ -0,0 +1,134 @@
+"""
+Registro de cambios de patrones (ai_pattern_changes)
+La poda respeta la retención, los lectores atrasados reciben ChangeLogGap y la
+marca de agua no salta cambios que se confirman tarde. Con TEST_DATABASE_URL
+apuntando a un PostgreSQL desechable se prueban dos transacciones intercaladas.
+"""
+import os
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from web.changelog import (install_change_triggers, last_change_id, changes_since, prune_changes,
+                           ai_pattern_changes, ChangeLogGap, OP_UPSERT, OP_DELETE)
+
+@pytest.fixture
+def change_db(bot_db):
+    install_change_triggers(bot_db)
+    return bot_db
+
+def _add_pattern(db, make_row, text):
+    from shared.database import AIPattern
+    pattern = make_row(AIPattern, pattern=text, response=f"re: {text}", confidence=0.9)
+    db.add(pattern)
+    db.commit()
+    return pattern
+
+def _age_changes(db, hours):
+    db.execute(ai_pattern_changes.update().values(changed_at=datetime.utcnow() - timedelta(hours=hours)))
+    db.commit()
+
+def test_prune_keeps_changes_within_retention(change_db, make_row):
+    _add_pattern(change_db, make_row, 'hola')
+    _add_pattern(change_db, make_row, 'adiós')
+    until_id = last_change_id(change_db)
+
+    assert prune_changes(change_db, until_id) == 0
+    _, changes = changes_since(change_db, 0, until_id)
+    assert [pattern for _, pattern, _ in changes] == ['hola', 'adiós']
+
+def test_reader_behind_pruned_changes_gets_gap(change_db, make_row):
+    first = _add_pattern(change_db, make_row, 'hola')
+    reader_id = last_change_id(change_db)
+    change_db.delete(first)
+    change_db.commit()
+    _add_pattern(change_db, make_row, 'adiós')
+    until_id = last_change_id(change_db)
+
+    _age_changes(change_db, 48)
+    bound = prune_changes(change_db, until_id)
+    assert bound > reader_id
+
+    # El borrado de 'hola' ya no consta: un lector atrasado no puede aplicar los cambios
+    with pytest.raises(ChangeLogGap):
+        changes_since(change_db, reader_id, last_change_id(change_db))
+
+    # Quien ya estaba al día sigue recibiendo los cambios nuevos
+    _add_pattern(change_db, make_row, 'buenas')
+    _, changes = changes_since(change_db, until_id, last_change_id(change_db))
+    assert [(pattern, op) for _, pattern, op in changes] == [('buenas', OP_UPSERT)]
+
+def test_changes_since_keeps_last_change_per_pattern(change_db, make_row):
+    # Instalar los triggers anota un borrado masivo; se lee desde después
+    start_id = last_change_id(change_db)
+    pattern = _add_pattern(change_db, make_row, 'hola')
+    pattern.response = 'otra'
+    change_db.commit()
+    change_db.delete(pattern)
+    change_db.commit()
+
+    truncated, changes = changes_since(change_db, start_id, last_change_id(change_db))
+    assert not truncated
+    assert [(pattern, op) for _, pattern, op in changes] == [('hola', OP_DELETE)]
+
+@pytest.fixture
+def shared_engine(tmp_path):
+    """Motor con varias conexiones reales: TEST_DATABASE_URL (base desechable) o SQLite en fichero"""
+    database = pytest.importorskip('shared.database')
+    engine = create_engine(os.environ.get('TEST_DATABASE_URL') or f"sqlite:///{tmp_path / 'changes.db'}")
+    database.Group.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    install_change_triggers(session)
+    session.close()
+    yield engine
+    ai_pattern_changes.metadata.drop_all(engine)
+    database.Group.metadata.drop_all(engine)
+    engine.dispose()
+
+def test_watermark_does_not_skip_late_commits(shared_engine, make_row):
+    from shared.database import AIPattern
+    Session = sessionmaker(bind=shared_engine)
+    reader, slow, fast = Session(), Session(), Session()
+    try:
+        start_id = last_change_id(reader)
+        reader.commit()
+
+        # Una transacción escribe un patrón y tarda en confirmar...
+        slow.add(make_row(AIPattern, pattern='lento', response='r', confidence=0.9))
+        slow.flush()
+        # ...mientras otra confirma antes (SQLite no admite dos escritores a la vez)
+        if shared_engine.dialect.name != 'sqlite':
+            fast.add(make_row(AIPattern, pattern='rápido', response='r', confidence=0.9))
+            fast.commit()
+
+        watermark = last_change_id(reader)
+        _, seen = changes_since(reader, start_id, watermark)
+        reader.commit()
+        slow.commit()
+
+        _, late = changes_since(reader, watermark, last_change_id(reader))
+        assert 'lento' not in [pattern for _, pattern, _ in seen]
+        assert [pattern for _, pattern, _ in late] == ['lento']
+    finally:
+        for session in (reader, slow, fast):
+            session.close()
+
+def test_usage_counters_are_not_logged(shared_engine, make_row):
+    from shared.database import AIPattern
+    db = sessionmaker(bind=shared_engine)()
+    try:
+        pattern = _add_pattern(db, make_row, 'hola')
+        start_id = last_change_id(db)
+
+        # Lo que hace el bot en cada respuesta
+        pattern.uses = (pattern.uses or 0) + 1
+        pattern.last_used = datetime.utcnow()
+        db.commit()
+        assert last_change_id(db) == start_id
+
+        pattern.confidence = 0.5
+        db.commit()
+        _, changes = changes_since(db, start_id, last_change_id(db))
+        assert [(text, op) for _, text, op in changes] == [('hola', OP_UPSERT)]
+    finally:
+        db.close()
@@ -0,0 +1,28 @@
+"""
+Registro de consultas lentas
+Una consulta por encima de SLOW_QUERY_MS queda escrita en SLOW_QUERY_LOG
+"""
+import logging
+from sqlalchemy import create_engine, text
+from web import dbaudit
+
+def test_slow_query_is_written_to_its_log(tmp_path, monkeypatch):
+    path = tmp_path / 'slow_queries.log'
+    monkeypatch.setattr(dbaudit, '_slow_log_handler', None)
+    monkeypatch.setattr(dbaudit, 'SLOW_QUERY_MS', 0)
+    handler = dbaudit.setup_slow_query_log(logging.Formatter('%(name)s %(levelname)s %(message)s'), str(path))
+    dbaudit.install_query_auditor()
+
+    engine = create_engine('sqlite://')
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1 WHERE 'a' = 'a'"))
+    finally:
+        engine.dispose()
+        handler.close()
+        dbaudit.slow_logger.removeHandler(handler)
+        dbaudit.slow_logger.propagate = True
+
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert any(line.startswith('web.slow_queries WARNING Consulta lenta') and
+               "SELECT ? WHERE ? = ?" in line and 'segundo plano' in line for line in lines)
@@ -0,0 +1,29 @@
+"""
+Registro de logs en segundo plano
+Los registros de los loggers de la aplicación llegan al fichero al cerrar el manejador
+"""
+import logging
+from web.logpipeline import setup_queued_logging
+
+def test_request_loggers_reach_the_file(tmp_path):
+    path = tmp_path / 'app.log'
+    web_logger = logging.getLogger('web.test_pipeline')
+    web_logger.propagate = False
+    handler = setup_queued_logging(str(path), logging.Formatter('%(name)s %(levelname)s %(message)s'), [web_logger])
+    routes_logger = logging.getLogger('web.test_pipeline.routes')
+    try:
+        for i in range(1200):
+            routes_logger.info("Solicitud %d", i)
+        try:
+            raise ValueError('fallo')
+        except ValueError:
+            routes_logger.exception("Error en la ruta")
+    finally:
+        handler.close()
+        web_logger.removeHandler(handler)
+
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == 'web.test_pipeline.routes INFO Solicitud 0'
+    assert sum(line.startswith('web.test_pipeline.routes INFO Solicitud') for line in lines) == 1200
+    assert 'ValueError: fallo' in lines[-1]
+    assert handler.stats()['dropped'] == 0
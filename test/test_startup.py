@@ -0,0 +1,50 @@
+"""
+Arranque en frío de la aplicación web
+create_app() debe arrancar dentro del presupuesto con el esquema ya creado
+y negarse a arrancar si falta
+"""
+import os
+import sys
+import subprocess
+import pytest
+from sqlalchemy import create_engine
+from web.startup import check_startup_budget, measure_startup, STARTUP_BUDGET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def startup_env(tmp_path, monkeypatch):
+    """Base SQLite en tmp_path con las tablas del bot y entorno de arranque sin precarga de IA"""
+    pytest.importorskip('flask_login')
+    pytest.importorskip('flask_sqlalchemy')
+    database = pytest.importorskip('shared.database')
+
+    # Las tablas del bot las crea el propio bot, no init-db
+    url = f"sqlite:///{tmp_path / 'startup.db'}"
+    engine = create_engine(url)
+    database.Group.metadata.create_all(engine)
+    engine.dispose()
+
+    python_path = [ROOT] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(python_path))
+    monkeypatch.setenv('DATABASE_URL', url)
+    monkeypatch.setenv('SESSION_SECRET', 'test')
+    monkeypatch.setenv('AI_WARMUP', '0')
+    monkeypatch.delenv('DB_AUTO_INIT', raising=False)
+    return tmp_path
+
+def _init_db():
+    process = subprocess.run([sys.executable, '-m', 'web.startup', 'init-db'], capture_output=True, text=True)
+    assert process.returncode == 0, process.stderr[-2000:]
+
+def test_cold_start_within_budget(startup_env):
+    _init_db()
+    report = check_startup_budget(STARTUP_BUDGET)
+    phases = dict(report['phases'])
+    assert 'check_schema' in phases
+    assert 'init_database' not in phases
+
+def test_start_fails_without_schema(startup_env):
+    with pytest.raises(RuntimeError, match='init-db'):
+        measure_startup()
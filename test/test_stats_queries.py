@@ -0,0 +1,62 @@
+"""
+Número de consultas de las estadísticas de moderación
+El dashboard y /api/stats no deben hacer una consulta por grupo
+"""
+from web.stats import get_group_stats, get_moderation_totals
+
+def _add_groups(db, make_row, first, last):
+    from shared.database import Group, ModAction, Warning
+    for number in range(first, last):
+        chat_id = -1000 - number
+        db.add(make_row(Group, chat_id=chat_id, title=f"Grupo {number}"))
+        db.add(make_row(Warning, group_id=str(chat_id)))
+        db.add(make_row(ModAction, group_id=str(chat_id)))
+        db.add(make_row(ModAction, group_id=str(chat_id)))
+    db.commit()
+
+def _count_queries(db, query_budget):
+    with query_budget(10) as audit:
+        totals = get_moderation_totals(db)
+        groups = get_group_stats(db)
+    return audit.count, totals, groups
+
+def test_group_stats_query_count_does_not_grow_with_groups(bot_db, make_row, query_budget):
+    _add_groups(bot_db, make_row, 0, 1)
+    few_queries, totals, groups = _count_queries(bot_db, query_budget)
+    assert totals['total_groups'] == 1
+    assert len(groups) == 1
+
+    _add_groups(bot_db, make_row, 1, 40)
+    many_queries, totals, groups = _count_queries(bot_db, query_budget)
+    assert many_queries == few_queries
+    assert totals == {'total_groups': 40, 'total_actions': 80, 'total_warnings': 40}
+    assert len(groups) == 40
+    assert all(group['warnings'] == 1 and group['actions'] == 2 for group in groups)
+
+def test_group_stats_counts_groups_without_activity(bot_db, make_row, query_budget):
+    from shared.database import Group
+    bot_db.add(make_row(Group, chat_id=-42, title=None))
+    bot_db.commit()
+
+    _, totals, groups = _count_queries(bot_db, query_budget)
+    assert totals['total_warnings'] == 0
+    assert len(groups) == 1
+    assert groups[0]['title'] == 'Sin nombre'
+    assert (groups[0]['warnings'], groups[0]['actions']) == (0, 0)
+
+def test_rollup_counters_sum_global_shards(bot_db, make_row, query_budget):
+    from web.rollup import rebuild_rollup, group_stats_rollup, GLOBAL_KEY
+    _add_groups(bot_db, make_row, 0, 3)
+    rebuild_rollup(bot_db)
+    _add_groups(bot_db, make_row, 3, 5)
+
+    # Fragmentos que escriben los triggers de PostgreSQL desde otros backends
+    bot_db.execute(group_stats_rollup.insert(), [
+        dict(group_id=f"{GLOBAL_KEY}:{shard}", warnings=1, actions=0, messages=0, users=0)
+        for shard in (3, 7)
+    ])
+    bot_db.commit()
+
+    _, totals, groups = _count_queries(bot_db, query_budget)
+    assert totals == {'total_groups': 5, 'total_actions': 10, 'total_warnings': 7}
+    assert all(group['warnings'] == 1 and group['actions'] == 2 for group in groups)
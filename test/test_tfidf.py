@@ -0,0 +1,171 @@
+"""
+Índice TF-IDF de patrones
+Equivalencias con semilla fija entre los caminos rápidos y el cálculo directo:
+poda frente a búsqueda exhaustiva, lotes frente a consultas sueltas, cambios
+incrementales frente a reconstrucción y snapshot en disco frente a memoria
+"""
+import numpy as np
+import pytest
+from web import tfidf
+from web.tfidf import TfidfIndex
+from web.modelstore import ModelStore
+
+SEEDS = (0, 1, 2)
+VOCABULARY = [f"w{i}" for i in range(300)]
+
+def _words(rng, low, high):
+    # Zipf truncado: unos pocos términos muy frecuentes y una cola larga
+    positions = np.minimum(rng.zipf(1.3, size=rng.integers(low, high + 1)) - 1, len(VOCABULARY) - 1)
+    return ' '.join(VOCABULARY[position] for position in positions)
+
+def _corpus(rng, n):
+    return {pattern_id: (_words(rng, 2, 8), f"r{pattern_id}", 0.8) for pattern_id in range(n)}
+
+def _queries(rng, n):
+    # Algunas con términos que el índice no conoce
+    return [_words(rng, 1, 6) + (' desconocido' if i % 5 == 0 else '') for i in range(n)]
+
+def _rows(corpus):
+    return [(pattern_id, *payload) for pattern_id, payload in corpus.items()]
+
+def _by_id(matches):
+    return {match.pattern_id: match for match in matches}
+
+def _assert_same(actual, expected):
+    """Mismos patrones y payloads, puntuaciones iguales salvo redondeo"""
+    actual, expected = _by_id(actual), _by_id(expected)
+    assert actual.keys() == expected.keys()
+    for pattern_id, match in expected.items():
+        assert actual[pattern_id][:4] == match[:4]
+        assert actual[pattern_id].score == pytest.approx(match.score, abs=1e-5)
+
+def _assert_same_top(actual, expected):
+    """Top-k: los empates en el corte pueden resolverse distinto, las puntuaciones no"""
+    assert [match.score for match in actual] == pytest.approx([match.score for match in expected], abs=1e-5)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_pruned_search_matches_exhaustive(seed):
+    rng = np.random.default_rng(seed)
+    corpus = _corpus(rng, 600)
+    index = TfidfIndex.from_rows(_rows(corpus))
+    index.postings()
+    # Filas añadidas después de la instantánea invertida: se puntúan aparte
+    for pattern_id in range(600, 620):
+        index.add(pattern_id, _words(rng, 2, 8), f"r{pattern_id}", 0.8)
+
+    for query in _queries(rng, 60):
+        for min_score in (0.0, 0.3, 0.7):
+            exhaustive = index.search(query, k=len(index), min_score=min_score, prune=False)
+            _assert_same(index.search(query, k=len(index), min_score=min_score, prune=True), exhaustive)
+            _assert_same_top(index.search(query, k=5, min_score=min_score, prune=True), exhaustive[:5])
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_search_batch_matches_search(seed, monkeypatch):
+    rng = np.random.default_rng(seed)
+    index = TfidfIndex.from_rows(_rows(_corpus(rng, 600)))
+    index.postings()
+    for pattern_id in range(600, 620):
+        index.add(pattern_id, _words(rng, 2, 8), f"r{pattern_id}", 0.8)
+    queries = _queries(rng, 40) + ['', 'desconocido']
+    # Tramos pequeños para recorrer también el lote partido
+    monkeypatch.setattr(tfidf, 'BATCH_MAX_PRODUCTS', 500)
+
+    for min_score in (0.0, 0.5):
+        batch = index.search_batch(queries, k=len(index), min_score=min_score)
+        assert len(batch) == len(queries)
+        for query, matches in zip(queries, batch):
+            _assert_same(matches, index.search(query, k=len(index), min_score=min_score))
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_incremental_changes_match_rebuild(seed, monkeypatch):
+    # Compactaciones frecuentes para que los cambios crucen varias
+    monkeypatch.setattr(tfidf, 'COMPACT_MIN_DEAD', 20)
+    rng = np.random.default_rng(seed)
+    corpus = _corpus(rng, 300)
+    index = TfidfIndex.from_rows(_rows(corpus))
+    next_id = len(corpus)
+
+    for _ in range(800):
+        operation = rng.random()
+        if operation < 0.35 and corpus:
+            pattern_id = int(rng.choice(list(corpus)))
+            del corpus[pattern_id]
+            assert index.delete(pattern_id)
+        elif operation < 0.6 and corpus:
+            pattern_id = int(rng.choice(list(corpus)))
+            corpus[pattern_id] = (_words(rng, 2, 8), f"r{pattern_id}b", 0.9)
+            index.update(pattern_id, *corpus[pattern_id])
+        else:
+            corpus[next_id] = (_words(rng, 2, 8), f"r{next_id}", 0.8)
+            index.add(next_id, *corpus[next_id])
+            next_id += 1
+    assert not index.delete(next_id)
+    assert index.stats()['compactions'] > 0
+
+    rebuilt = TfidfIndex.from_rows(_rows(corpus))
+    assert len(index) == len(corpus)
+    assert all(pattern_id in index for pattern_id in corpus)
+    # El IDF se recalcula por lotes: tras reweight() debe coincidir con el de una reconstrucción
+    index.reweight()
+    queries = _queries(rng, 40)
+    for query in queries:
+        _assert_same(index.search(query, k=len(corpus), prune=True), rebuilt.search(query, k=len(corpus)))
+        _assert_same(index.search(query, k=len(corpus), prune=False), rebuilt.search(query, k=len(corpus)))
+    for matches, expected in zip(index.search_batch(queries, k=len(corpus)), rebuilt.search_batch(queries, k=len(corpus))):
+        _assert_same(matches, expected)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_snapshot_round_trip_matches_memory(seed, tmp_path):
+    rng = np.random.default_rng(seed)
+    corpus = _corpus(rng, 500)
+    index = TfidfIndex.from_rows(_rows(corpus))
+    store = ModelStore(directory=str(tmp_path / 'model'), keep=2)
+    version = store.publish(index, change_id=42)
+    mapped = store.load()
+    assert mapped.version == version and mapped.change_id == 42
+    assert len(mapped) == len(index)
+
+    queries = _queries(rng, 40)
+    for query in queries:
+        for min_score in (0.0, 0.5):
+            expected = index.search(query, k=len(index), min_score=min_score)
+            _assert_same(mapped.search(query, k=len(index), min_score=min_score), expected)
+            _assert_same_top(mapped.search(query, k=5, min_score=min_score), expected[:5])
+    for matches, expected in zip(mapped.search_batch(queries, k=len(index)), index.search_batch(queries, k=len(index))):
+        _assert_same(matches, expected)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_snapshot_overlay_under_mutations(seed, tmp_path):
+    rng = np.random.default_rng(seed)
+    corpus = _corpus(rng, 300)
+    store = ModelStore(directory=str(tmp_path / 'model'))
+    store.publish(TfidfIndex.from_rows(_rows(corpus)), change_id=1)
+    mapped = store.load()
+    next_id = len(corpus)
+
+    for _ in range(300):
+        operation = rng.random()
+        if operation < 0.35 and corpus:
+            pattern_id = int(rng.choice(list(corpus)))
+            del corpus[pattern_id]
+            assert mapped.delete(pattern_id)
+        elif operation < 0.6 and corpus:
+            pattern_id = int(rng.choice(list(corpus)))
+            corpus[pattern_id] = (_words(rng, 2, 8) + ' nuevo', f"r{pattern_id}b", 0.9)
+            mapped.update(pattern_id, *corpus[pattern_id])
+        else:
+            corpus[next_id] = (_words(rng, 2, 8), f"r{next_id}", 0.8)
+            mapped.add(next_id, *corpus[next_id])
+            next_id += 1
+
+    # El overlay puntúa con el IDF del snapshot, así que no se compara con una
+    # reconstrucción: sí deben coincidir el contenido y los dos caminos de búsqueda
+    assert len(mapped) == len(corpus)
+    assert all(pattern_id in mapped for pattern_id in corpus)
+    queries = _queries(rng, 40) + ['nuevo']
+    batch = mapped.search_batch(queries, k=len(corpus))
+    for query, matches in zip(queries, batch):
+        single = mapped.search(query, k=len(corpus))
+        _assert_same(matches, single)
+        for match in single:
+            assert match[1:4] == corpus[match.pattern_id]
@@ -0,0 +1,111 @@
+"""
+Series de actividad de mensajes
+Cuenta mensajes por día u hora con una única consulta acotada por rango
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, Index
+
+logger = logging.getLogger('web')
+
+DAY_NAMES = ['Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb', 'Dom']
+
+BUCKETS = {
+    'day': timedelta(days=1),
+    'hour': timedelta(hours=1)
+}
+
+# Límites para evitar series desproporcionadas
+MAX_RANGE = timedelta(days=366)
+MAX_POINTS = 24 * 90
+
+_RANGE_RE = re.compile(r'^(\d+)([dh])$')
+
+def parse_range(value):
+    """Convierte un rango como '7d', '30d' o '24h' en un timedelta"""
+    match = _RANGE_RE.match((value or '').strip().lower())
+    if not match:
+        raise ValueError(f"Rango no válido: {value}")
+    amount, unit = int(match.group(1)), match.group(2)
+    span = timedelta(days=amount) if unit == 'd' else timedelta(hours=amount)
+    if amount <= 0 or span > MAX_RANGE:
+        raise ValueError(f"Rango fuera de límites: {value}")
+    return span
+
+def _truncate(dt, bucket):
+    if bucket == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def _bucket_expression(db, bucket):
+    """Expresión SQL que trunca created_at al inicio del intervalo"""
+    from shared.database import Message
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return func.date_trunc(bucket, Message.created_at)
+    if dialect == 'sqlite':
+        fmt = '%Y-%m-%d 00:00:00' if bucket == 'day' else '%Y-%m-%d %H:00:00'
+        return func.strftime(fmt, Message.created_at)
+    if bucket == 'day':
+        return func.date(Message.created_at)
+    return func.date_format(Message.created_at, '%Y-%m-%d %H:00:00')
+
+def _to_datetime(value, bucket):
+    if isinstance(value, datetime):
+        return _truncate(value, bucket)
+    if hasattr(value, 'year') and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    return _truncate(datetime.fromisoformat(str(value)), bucket)
+
+def get_activity_series(db, span=timedelta(days=7), bucket='day', now=None):
+    """Devuelve los mensajes por intervalo en la ventana indicada
+
+    El filtro usa created_at sin envolver en funciones, así que la consulta
+    recorre solo el rango del índice; los intervalos sin mensajes se
+    rellenan con cero aquí.
+    """
+    from shared.database import Message
+    if bucket not in BUCKETS:
+        raise ValueError(f"Intervalo no válido: {bucket}")
+    step = BUCKETS[bucket]
+
+    now = now or datetime.now()
+    end = _truncate(now, bucket) + step
+    points = int(span / step)
+    if points > MAX_POINTS:
+        raise ValueError(f"Demasiados intervalos: {points}")
+    start = end - points * step
+
+    bucket_expr = _bucket_expression(db, bucket)
+    rows = db.query(bucket_expr, func.count(Message.id)).filter(
+        Message.created_at >= start,
+        Message.created_at < end
+    ).group_by(bucket_expr).all()
+
+    counts = {}
+    for value, total in rows:
+        if value is None:
+            continue
+        key = _to_datetime(value, bucket)
+        counts[key] = counts.get(key, 0) + total
+
+    buckets = [start + i * step for i in range(points)]
+    return {
+        'bucket': bucket,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'buckets': [b.isoformat() for b in buckets],
+        'labels': [
+            DAY_NAMES[b.weekday()] if bucket == 'day' and points <= 7
+            else b.strftime('%d/%m' if bucket == 'day' else '%d/%m %H:00')
+            for b in buckets
+        ],
+        'data': [counts.get(b, 0) for b in buckets]
+    }
+
+def ensure_activity_index(bind):
+    """Crea el índice sobre messages.created_at si no existe"""
+    from shared.database import Message
+    index = Index('ix_messages_created_at', Message.__table__.c.created_at)
+    index.create(bind=bind, checkfirst=True)
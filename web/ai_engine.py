@@ -0,0 +1,385 @@
+"""
+Instancia compartida del motor de IA
+Construye SimpleAI una sola vez por proceso. SimpleAI (bot/ai_module) no
+admite cambios incrementales: cuando el panel modifica o borra patrones se
+reconstruye entero, O(base de conocimiento), en un hilo de fondo, y get()
+sigue devolviendo la instancia anterior hasta que la nueva está lista.
+
+Mantiene además, aparte de SimpleAI, el índice TF-IDF de patrones que usan
+ai_engine.match() y /api/ai/respond_batch, que sí se actualiza en
+O(longitud del patrón). Ni SimpleAI ni el bot lo consultan: el
+emparejamiento del bot no cambia.
+Se actualiza en el sitio con los cambios hechos desde el panel y se sincroniza
+con ai_pattern_changes, que alimentan triggers de la base de datos, para
+recoger también los patrones que aprende el bot o que cambian otros workers.
+
+El índice se comparte entre workers como snapshot mapeado de disco (ver
+modelstore): cada proceso solo guarda en memoria los cambios posteriores al
+snapshot y cambia a una versión nueva en cuanto la ve publicada.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger('web')
+
+# Segundos entre sincronizaciones del índice con ai_pattern_changes
+INDEX_SYNC_INTERVAL = float(os.environ.get('AI_INDEX_SYNC_INTERVAL', 5))
+INDEX_BUILD_BATCH = 1000
+# Mensajes por llamada en /api/ai/respond_batch (JSON) y por tramo en modo NDJSON
+BATCH_MAX_MESSAGES = int(os.environ.get('AI_BATCH_MAX_MESSAGES', 1000))
+BATCH_CHUNK = int(os.environ.get('AI_BATCH_CHUNK', 500))
+
+def _min_confidence():
+    # save_ai_config actualiza MIN_CONFIDENCE en el entorno en tiempo de ejecución
+    return float(os.environ.get('MIN_CONFIDENCE', 0.7))
+
+class AIEngine:
+    """Contenedor thread-safe de una instancia de SimpleAI"""
+
+    def __init__(self, factory=None):
+        self._factory = factory
+        self._lock = threading.RLock()
+        self._instance = None
+        self.warmup_seconds = None
+        self.builds = 0
+        self._index = None
+        self._index_change_id = 0
+        self._index_synced = 0.0
+        self._republisher = None
+        # SimpleAI no refleja cambios hechos desde el panel; se reconstruye en segundo plano
+        self._stale = False
+        self._rebuilder = None
+
+    def _build(self):
+        if self._factory is None:
+            # bot.ai_module es pesado: solo se importa al construir la primera instancia
+            from bot.ai_module import SimpleAI
+            self._factory = SimpleAI
+        start_time = time.time()
+        instance = self._factory()
+        duration = time.time() - start_time
+        self.builds += 1
+        logger.info(f"SimpleAI construido en {duration:.4f}s")
+        return instance, duration
+
+    def warm_up(self):
+        """Construye la instancia al arrancar y registra cuánto tardó"""
+        with self._lock:
+            self._instance, self.warmup_seconds = self._build()
+        return self.warmup_seconds
+
+    def get(self):
+        """Devuelve la instancia compartida, construyéndola si hace falta"""
+        instance = self._instance
+        if instance is not None:
+            return instance
+        with self._lock:
+            if self._instance is None:
+                self._instance, _ = self._build()
+            return self._instance
+
+    def invalidate(self):
+        """Descarta la instancia; la siguiente llamada a get() la reconstruye"""
+        with self._lock:
+            self._instance = None
+
+    def _mark_stale(self):
+        """Pide reconstruir SimpleAI en segundo plano (se llama con self._lock tomado)
+
+        Varios cambios seguidos se agrupan en una sola reconstrucción.
+        """
+        if self._instance is None:
+            return
+        self._stale = True
+        if self._rebuilder is None or not self._rebuilder.is_alive():
+            self._rebuilder = threading.Thread(target=self._rebuild_stale, name='ai-rebuild', daemon=True)
+            self._rebuilder.start()
+
+    def _rebuild_stale(self):
+        while True:
+            with self._lock:
+                if not self._stale:
+                    return
+                self._stale = False
+            try:
+                instance, _ = self._build()
+            except Exception as e:
+                logger.error(f"Error reconstruyendo SimpleAI: {e}")
+                return
+            with self._lock:
+                self._instance = instance
+
+    def refresh(self):
+        """Reconstruye la instancia tras un cambio en los patrones"""
+        with self._lock:
+            self._instance, _ = self._build()
+        return self._instance
+
+    def build_index(self, counts=None):
+        """Construye un índice nuevo desde AIPattern sin publicarlo
+
+        Devuelve (índice, último cambio de ai_pattern_changes ya incluido).
+        """
+        from shared.database import AIPattern
+        from .tfidf import TfidfIndex
+        from .changelog import last_change_id
+        from .dbsession import make_session
+
+        start_time = time.time()
+        db = make_session()
+        try:
+            # Los cambios posteriores a este punto se aplican en la primera sincronización
+            change_id = last_change_id(db)
+            rows = db.query(
+                AIPattern.id, AIPattern.pattern, AIPattern.response, AIPattern.confidence
+            ).yield_per(INDEX_BUILD_BATCH)
+            index = TfidfIndex.from_rows(rows, counts)
+        finally:
+            db.close()
+
+        logger.info(f"Índice TF-IDF construido: {len(index)} patrones en {time.time() - start_time:.4f}s")
+        return index, change_id
+
+    def _mapped(self, index, change_id):
+        """Publica el índice como snapshot y devuelve su versión mapeada
+
+        Si los snapshots están desactivados o no se pudo publicar, devuelve el propio índice.
+        """
+        from .modelstore import model_store
+
+        try:
+            version = model_store.publish(index, change_id)
+        except Exception as e:
+            logger.error(f"Error publicando el snapshot del modelo: {e}")
+            return index
+        return (model_store.load(version) if version else None) or index
+
+    def load_index(self):
+        """(índice, último cambio incluido) del snapshot actual o, si no hay, construido desde AIPattern"""
+        from .modelstore import model_store
+
+        mapped = model_store.load()
+        if mapped is not None:
+            logger.info(f"Índice TF-IDF cargado del snapshot v{mapped.version}: {len(mapped)} patrones")
+            return mapped, mapped.change_id
+        index, change_id = self.build_index()
+        return self._mapped(index, change_id), change_id
+
+    def publish_index(self, index, change_id):
+        """Publica como snapshot un índice construido aparte y lo sustituye de una vez"""
+        index = self._mapped(index, change_id)
+        with self._lock:
+            self._index = index
+            self._index_change_id = change_id
+            # Forzar la sincronización en el próximo acceso
+            self._index_synced = 0.0
+
+    def index(self):
+        """Índice TF-IDF de patrones, construido al primer uso"""
+        index = self._index
+        if index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index, self._index_change_id = self.load_index()
+                    self._index_synced = time.monotonic()
+                return self._index
+        if time.monotonic() - self._index_synced >= INDEX_SYNC_INTERVAL:
+            self.sync_index()
+            # La sincronización puede haber cambiado a un snapshot más nuevo
+            index = self._index
+        return index
+
+    def _swap_snapshot(self):
+        """Cambia al snapshot que apunta CURRENT si es más nuevo que el índice actual"""
+        from .modelstore import model_store
+
+        version = model_store.current_version()
+        if version <= getattr(self._index, 'version', 0):
+            return
+        mapped = model_store.load(version)
+        if mapped is None:
+            return
+        self._index = mapped
+        self._index_change_id = mapped.change_id
+        logger.info(f"Índice TF-IDF cambiado al snapshot v{version}")
+
+    def _maybe_republish(self, full=False):
+        """Lanza en segundo plano la publicación de un snapshot nuevo cuando los
+        cambios en memoria sobre el actual son muchos, o siempre con full=True
+
+        Se llama fuera de self._lock: la reconstrucción no bloquea las solicitudes.
+        """
+        if not full and not getattr(self._index, 'needs_rebuild', False):
+            return
+        with self._lock:
+            if self._republisher is not None and self._republisher.is_alive():
+                return
+            self._republisher = threading.Thread(target=self._republish, args=(full,),
+                                                 name='ai-republish', daemon=True)
+            self._republisher.start()
+
+    def _republish(self, full):
+        from .modelstore import model_store
+
+        if full:
+            # Los cambios que faltan ya no constan: se construye desde AIPattern
+            try:
+                index, change_id = self.build_index()
+            except Exception as e:
+                logger.error(f"Error reconstruyendo el índice TF-IDF: {e}")
+                return
+            self.publish_index(index, change_id)
+            return
+
+        try:
+            # Solo el proceso que obtiene el bloqueo reconstruye; el resto cambia en su próxima sincronización
+            version = model_store.rebuild(self.build_index)
+        except Exception as e:
+            logger.error(f"Error publicando el snapshot del modelo: {e}")
+            return
+        if version:
+            with self._lock:
+                self._swap_snapshot()
+
+    def sync_index(self):
+        """Cambia a un snapshot más nuevo si lo hay y aplica los cambios de ai_pattern_changes aún no vistos"""
+        from shared.database import AIPattern
+        from .changelog import last_change_id, changes_since, ChangeLogGap, OP_DELETE
+        from .dbsession import make_session
+
+        gap = False
+        with self._lock:
+            if self._index is None:
+                return 0
+            self._index_synced = time.monotonic()
+            self._swap_snapshot()
+            index = self._index
+            db = make_session()
+            try:
+                until_id = last_change_id(db)
+                if until_id <= self._index_change_id:
+                    return 0
+                truncated, changes = changes_since(db, self._index_change_id, until_id)
+                if truncated:
+                    index.clear()
+
+                upserts = []
+                for pattern_id, _, op in changes:
+                    if op == OP_DELETE:
+                        index.delete(pattern_id)
+                    else:
+                        upserts.append(pattern_id)
+                for offset in range(0, len(upserts), INDEX_BUILD_BATCH):
+                    rows = db.query(
+                        AIPattern.id, AIPattern.pattern, AIPattern.response, AIPattern.confidence
+                    ).filter(AIPattern.id.in_(upserts[offset:offset + INDEX_BUILD_BATCH]))
+                    for pattern_id, pattern, response, confidence in rows:
+                        index.add(pattern_id, pattern, response, confidence)
+            except ChangeLogGap as e:
+                # El índice sigue sirviendo hasta que se publique el reconstruido
+                logger.warning(f"{e}: el índice TF-IDF se reconstruye en segundo plano")
+                gap = True
+            except Exception as e:
+                logger.error(f"Error sincronizando el índice TF-IDF: {e}")
+                return 0
+            finally:
+                db.close()
+
+            if not gap:
+                self._index_change_id = until_id
+                logger.debug(f"Índice TF-IDF sincronizado: {len(changes)} cambios")
+
+        if gap:
+            self._maybe_republish(full=True)
+            return 0
+        self._maybe_republish()
+        return len(changes)
+
+    def index_upsert(self, pattern):
+        """Aplica en el sitio la modificación de un AIPattern hecha fuera de SimpleAI
+
+        El índice se actualiza en O(longitud del patrón); SimpleAI no ve el
+        cambio y se reconstruye entero en segundo plano.
+        """
+        with self._lock:
+            if self._index is not None:
+                self._index.add(pattern.id, pattern.pattern, pattern.response, pattern.confidence)
+            self._mark_stale()
+
+    def index_delete(self, pattern_id):
+        """Aplica en el sitio el borrado de un patrón (SimpleAI se reconstruye en segundo plano)"""
+        with self._lock:
+            if self._index is not None:
+                self._index.delete(pattern_id)
+            self._mark_stale()
+
+    def index_clear(self):
+        """Vacía el índice tras un borrado masivo de patrones (SimpleAI se reconstruye en segundo plano)"""
+        with self._lock:
+            if self._index is not None:
+                self._index.clear()
+            self._mark_stale()
+
+    def match(self, text, k=5, min_score=None):
+        """Los k patrones más parecidos al texto que alcanzan min_score (MIN_CONFIDENCE por defecto)"""
+        if min_score is None:
+            min_score = _min_confidence()
+        return self.index().search(text, k=k, min_score=min_score)
+
+    def match_batch(self, texts, k=5, min_score=None):
+        """match() para varios textos con un único producto disperso; una lista por texto"""
+        if min_score is None:
+            min_score = _min_confidence()
+        return self.index().search_batch(texts, k=k, min_score=min_score)
+
+ai_engine = AIEngine()
+
+def _ndjson(item):
+    return json.dumps(item, ensure_ascii=False) + '\n'
+
+def respond_stream(lines, k=5, min_score=None, chunk_size=BATCH_CHUNK):
+    """Respuestas NDJSON para un flujo de mensajes NDJSON, por tramos de chunk_size
+
+    Cada línea de entrada es un texto JSON o {"id": ..., "message": ...}; cada
+    línea de salida, en el mismo orden, es {"id": ..., "responses": [...]} o
+    {"id": ..., "error": ...}.
+    """
+    def flush(batch):
+        texts = [text for _, text, error in batch if error is None]
+        results = iter(ai_engine.match_batch(texts, k=k, min_score=min_score) if texts else ())
+        for item_id, _, error in batch:
+            if error is not None:
+                yield _ndjson({'id': item_id, 'error': error})
+            else:
+                yield _ndjson({'id': item_id, 'responses': [match._asdict() for match in next(results)]})
+
+    batch = []
+    for number, line in enumerate(lines):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            batch.append((number, None, 'JSON no válido'))
+            continue
+
+        if isinstance(item, dict):
+            item_id, text = item.get('id', number), item.get('message')
+        else:
+            item_id, text = number, item
+        if isinstance(text, str):
+            batch.append((item_id, text, None))
+        else:
+            batch.append((item_id, None, 'El mensaje debe ser un texto'))
+
+        if len(batch) >= chunk_size:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
@@ -12,9 +12,14 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-file_handler = logging.FileHandler('app.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+# Los registros de 'web' (app, rutas y middleware propagan a él) se encolan y
+# un hilo escritor los vuelca a app.log fuera de la solicitud
+from web.logpipeline import setup_queued_logging
+from web.startup import StartupTimer
+file_handler = setup_queued_logging('app.log', formatter, [logging.getLogger('web')])
+# Las consultas lentas van a SLOW_QUERY_LOG (slow_queries.log por defecto)
+from web.dbaudit import setup_slow_query_log
+slow_query_handler = setup_slow_query_log(formatter)
 
 # Initialize SQLAlchemy
 db = SQLAlchemy()
@@ -29,6 +34,8 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256))
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Se incrementa al cambiar contraseña o permisos; invalida la caché de usuarios
+    auth_version = db.Column(db.Integer, nullable=False, default=0)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -36,9 +43,78 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-def create_app():
-    """Crea y configura la aplicación Flask"""
+def init_database(app):
+    """Crea tablas, índices y el usuario admin; se ejecuta una vez por despliegue"""
+    from web.usercache import ensure_auth_version_column
+    from web.dbsession import make_session
+    from web.rollup import rebuild_rollup
+    from web.activity import ensure_activity_index
+    from web.stats import ensure_pattern_indexes
+    from web.changelog import install_change_triggers
+    from web.broadcast import ensure_broadcast_tables
+
+    with app.app_context():
+        db.create_all()
+        ensure_auth_version_column(db.engine)
+        # Create admin user if not exists
+        if not User.query.filter_by(username='admin').first():
+            admin = User(username='admin', is_admin=True)
+            admin.set_password(os.environ.get('ADMIN_PASSWORD', 'admin'))
+            db.session.add(admin)
+            db.session.commit()
+            logger.info("Usuario admin creado correctamente")
+
+        # Contadores agregados de moderación e índices de estadísticas
+        bot_db = make_session()
+        try:
+            # Instala los triggers del rollup y lo recalcula; hasta entonces se cuenta desde las tablas
+            rebuild_rollup(bot_db)
+            install_change_triggers(bot_db)
+            ensure_broadcast_tables(bot_db.get_bind())
+            ensure_activity_index(bot_db.get_bind())
+            ensure_pattern_indexes(bot_db.get_bind())
+        finally:
+            bot_db.close()
+    logger.info("Esquema de base de datos inicializado")
+
+def check_schema(app):
+    """Falla con un error claro si falta algo de lo que crea init_database()"""
+    from sqlalchemy import inspect
+    from web.dbsession import make_session
+    from web.rollup import group_stats_rollup
+    from web.changelog import ai_pattern_changes
+    from web.broadcast import broadcast_jobs, broadcast_outbox
+
+    missing = []
+    with app.app_context():
+        inspector = inspect(db.engine)
+        if not inspector.has_table(User.__tablename__):
+            missing.append(User.__tablename__)
+        elif 'auth_version' not in {c['name'] for c in inspector.get_columns(User.__tablename__)}:
+            missing.append(f"{User.__tablename__}.auth_version")
+
+        bot_db = make_session()
+        try:
+            bot_inspector = inspect(bot_db.get_bind())
+            for table in (group_stats_rollup, ai_pattern_changes, broadcast_jobs, broadcast_outbox):
+                if not bot_inspector.has_table(table.name):
+                    missing.append(table.name)
+        finally:
+            bot_db.close()
+
+    if missing:
+        raise RuntimeError(
+            f"Falta el esquema de la base de datos ({', '.join(missing)}): "
+            f"ejecuta \"python -m web.startup init-db\" antes de arrancar"
+        )
+
+def create_app(check_database=True):
+    """Crea y configura la aplicación Flask
+
+    Con check_database=False no se comprueba el esquema (lo usa init-db).
+    """
     logger.info("Iniciando creación de la aplicación Flask...")
+    timer = StartupTimer()
     app = Flask(__name__)
 
     try:
@@ -77,19 +153,13 @@ def create_app():
         
         app.config['SQLALCHEMY_DATABASE_URI'] = database_url
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-            'pool_recycle': 60,        # Reducido para evitar conexiones obsoletas
-            'pool_pre_ping': True,     # Verifica conexión antes de usar
-            'connect_args': {
-                'connect_timeout': 10,  # Timeout de conexión en segundos
-                'keepalives': 1,        # Mantener conexión viva
-                'keepalives_idle': 30,  # Tiempo de inactividad antes de enviar keepalive
-                'keepalives_interval': 10,  # Intervalo entre keepalives
-                'keepalives_count': 5   # Número de keepalives fallidos antes de cerrar
-            }
-        }
+        # Pool compartido con las sesiones del bot (DB_POOL_SIZE, DB_MAX_OVERFLOW,
+        # DB_POOL_TIMEOUT y DB_POOL_RECYCLE configurables por despliegue)
+        from web.dbsession import engine_options
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
 
         logger.info("Configuración de Flask cargada correctamente")
+        timer.mark('config')
 
         # Initialize extensions
         db.init_app(app)
@@ -97,26 +167,75 @@ def create_app():
         login_manager.init_app(app)
         login_manager.login_view = 'login'
 
+        # Los usuarios autenticados se sirven desde una caché en memoria
+        from web.usercache import user_cache, install_user_cache
+        install_user_cache(User)
+
         @login_manager.user_loader
         def load_user(user_id):
-            return User.query.get(int(user_id))
-
-        # Create tables
-        with app.app_context():
-            db.create_all()
-            # Create admin user if not exists
-            if not User.query.filter_by(username='admin').first():
-                admin = User(username='admin', is_admin=True)
-                admin.set_password(os.environ.get('ADMIN_PASSWORD', 'admin'))
-                db.session.add(admin)
-                db.session.commit()
-                logger.info("Usuario admin creado correctamente")
+            return user_cache.get(user_id)
+
+        timer.mark('extensions')
+
+        # El esquema se crea con "python -m web.startup init-db", no en cada
+        # arranque de worker; DB_AUTO_INIT=1 mantiene el comportamiento anterior
+        if os.environ.get('DB_AUTO_INIT', '0') == '1':
+            init_database(app)
+            timer.mark('init_database')
+        elif check_database:
+            check_schema(app)
+            timer.mark('check_schema')
+
+        # Un único pool para db y las sesiones del bot, cerradas al final de cada solicitud
+        try:
+            from web.dbsession import init_db_sessions
+            with app.app_context():
+                init_db_sessions(app, db.engine)
+        except Exception as e:
+            logger.error(f"Error enlazando las sesiones del bot al pool compartido: {e}")
+
+        timer.mark('db_sessions')
+
+        # Precargar el motor de IA una vez por proceso (AI_WARMUP=0 lo difiere a la primera solicitud)
+        if os.environ.get('AI_WARMUP', '1') != '0':
+            try:
+                from web.ai_engine import ai_engine
+                warmup_seconds = ai_engine.warm_up()
+                app.config['AI_WARMUP_SECONDS'] = warmup_seconds
+                logger.info(f"Motor de IA precargado en {warmup_seconds:.4f}s")
+            except Exception as e:
+                logger.error(f"Error precargando el motor de IA: {e}")
+            timer.mark('ai_warmup')
+
+        # Precompilar la wiki para que la primera visita no pague el renderizado
+        try:
+            from web.wiki import wiki_cache
+            wiki_cache.warm_up()
+        except Exception as e:
+            logger.error(f"Error precompilando la wiki: {e}")
+        timer.mark('wiki')
+
+        # Middleware de logging, ETag y compresión
+        from web.middleware import setup_middleware
+        setup_middleware(app)
+        timer.mark('middleware')
 
         # Import routes
         from web.routes import register_routes
         register_routes(app)
-
-        logger.info("Aplicación Flask creada correctamente")
+        timer.mark('routes')
+
+        # Reanudar envíos masivos pendientes de ejecuciones anteriores
+        if os.environ.get('BROADCAST_ENGINE', '1') != '0':
+            try:
+                from web.broadcast import broadcast_engine
+                broadcast_engine.ensure_started()
+            except Exception as e:
+                logger.error(f"Error iniciando el motor de envíos masivos: {e}")
+            timer.mark('broadcast')
+
+        app.config['STARTUP_TIMINGS'] = timer.phases
+        logger.info(f"Aplicación Flask creada correctamente en {timer.total:.3f}s")
         return app
 
     except Exception as e:
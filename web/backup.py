@@ -0,0 +1,417 @@
+"""
+Respaldo de la base de conocimiento de IA
+Escribe los patrones en NDJSON comprimido leyendo la tabla por bloques.
+
+Los respaldos forman cadenas: una instantánea completa seguida de
+diferenciales que solo contienen los patrones creados, modificados o
+borrados desde el respaldo anterior (según ai_pattern_changes). Cada
+manifiesto apunta a su padre y a su instantánea base. Si los triggers del
+registro no están instalados se escribe siempre una instantánea completa.
+
+El registro solo anota cambios de patrón, respuesta o confianza: los
+contadores uses/last_used se actualizan en las instantáneas completas.
+"""
+import os
+import sys
+import gzip
+import json
+import zlib
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime
+from .changelog import (last_change_id, changes_since, prune_changes, record_change,
+                        change_log_trusted, ChangeLogGap, OP_UPSERT, OP_DELETE, OP_TRUNCATE)
+from .filelock import FileLock
+
+logger = logging.getLogger('web')
+
+# Filas leídas por bloque desde el cursor del servidor
+CHUNK_SIZE = 1000
+
+# Número máximo de diferenciales antes de forzar una instantánea completa
+FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', 24))
+
+BACKUP_PREFIX = 'ai_knowledge_backup_'
+BACKUP_SUFFIX = '.ndjson.gz'
+MANIFEST_SUFFIX = '.manifest.json'
+
+TYPE_FULL = 'full'
+TYPE_DIFF = 'diff'
+
+# Evita dos respaldos simultáneos en el mismo directorio, desde cualquier worker o la CLI
+LOCK_FILE = '.backup.lock'
+
+class _HashingWriter:
+    """Envuelve un fichero y calcula el SHA-256 de lo que se escribe"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        return self._fileobj.flush()
+
+def _row_dict(row):
+    return {
+        'id': row.id,
+        'pattern': row.pattern,
+        'response': row.response,
+        'confidence': row.confidence,
+        'uses': row.uses,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'last_used': row.last_used.isoformat() if row.last_used else None
+    }
+
+def _pattern_query(db):
+    from shared.database import AIPattern
+
+    return db.query(
+        AIPattern.id,
+        AIPattern.pattern,
+        AIPattern.response,
+        AIPattern.confidence,
+        AIPattern.uses,
+        AIPattern.created_at,
+        AIPattern.last_used
+    )
+
+def _pattern_rows(db):
+    """Itera los patrones como diccionarios sin cargar la tabla en memoria"""
+    from shared.database import AIPattern
+
+    query = _pattern_query(db).order_by(AIPattern.id).yield_per(CHUNK_SIZE)
+    for row in query:
+        yield _row_dict(row)
+
+def _diff_rows(db, changes):
+    """Filas del diferencial: patrones vigentes y marcas de borrado"""
+    from shared.database import AIPattern
+
+    for start in range(0, len(changes), CHUNK_SIZE):
+        chunk = changes[start:start + CHUNK_SIZE]
+        ids = [pattern_id for pattern_id, _, op in chunk if op == OP_UPSERT and pattern_id is not None]
+        current = {row.id: row for row in _pattern_query(db).filter(AIPattern.id.in_(ids))} if ids else {}
+
+        for pattern_id, pattern, op in chunk:
+            row = current.get(pattern_id)
+            if op == OP_UPSERT and row is not None:
+                yield dict(_row_dict(row), op=OP_UPSERT)
+            else:
+                # Borrado, o alta que ya no existe al leerla
+                yield {'op': OP_DELETE, 'id': pattern_id, 'pattern': pattern}
+
+def _ndjson_line(row):
+    return (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _write_ndjson(backup_dir, name, rows, manifest):
+    """Escribe rows en name.ndjson.gz y su manifiesto, ambos con rename atómico"""
+    os.makedirs(backup_dir, exist_ok=True)
+    final_path = os.path.join(backup_dir, name + BACKUP_SUFFIX)
+    tmp_path = f"{final_path}.tmp"
+
+    count = 0
+    try:
+        with open(tmp_path, 'wb') as raw:
+            writer = _HashingWriter(raw)
+            with gzip.GzipFile(filename=name + '.ndjson', mode='wb', fileobj=writer) as gz:
+                for row in rows:
+                    gz.write(_ndjson_line(row))
+                    count += 1
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, final_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    manifest = dict(manifest, **{
+        'name': name,
+        'file': os.path.basename(final_path),
+        'format': 'ndjson+gzip',
+        'rows': count,
+        'size': writer.size,
+        'sha256': writer.sha256.hexdigest(),
+        'created_at': datetime.now().isoformat()
+    })
+    _write_json_atomic(os.path.join(backup_dir, name + MANIFEST_SUFFIX), manifest)
+    return manifest
+
+def _new_name(backup_dir):
+    name = f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    suffix = 1
+    candidate = name
+    while os.path.exists(os.path.join(backup_dir, candidate + MANIFEST_SUFFIX)):
+        suffix += 1
+        candidate = f"{name}_{suffix}"
+    return candidate
+
+def list_manifests(backup_dir):
+    """Manifiestos del directorio ordenados del más antiguo al más reciente"""
+    if not os.path.isdir(backup_dir):
+        return []
+    manifests = []
+    for filename in sorted(os.listdir(backup_dir)):
+        if filename.startswith(BACKUP_PREFIX) and filename.endswith(MANIFEST_SUFFIX):
+            with open(os.path.join(backup_dir, filename), encoding='utf-8') as f:
+                manifest = json.load(f)
+            manifest.setdefault('name', filename[:-len(MANIFEST_SUFFIX)])
+            manifest.setdefault('type', TYPE_FULL)
+            manifests.append(manifest)
+    manifests.sort(key=lambda m: (m.get('created_at') or '', m['name']))
+    return manifests
+
+def resolve_chain(backup_dir, name=None):
+    """Cadena [completo, diff, diff, ...] que termina en name (o en el último respaldo)"""
+    manifests = {m['name']: m for m in list_manifests(backup_dir)}
+    if not manifests:
+        raise ValueError("No hay respaldos disponibles")
+    if name is None:
+        name = list(manifests)[-1]
+
+    chain = []
+    current = manifests.get(name)
+    while current is not None:
+        chain.append(current)
+        if current['type'] == TYPE_FULL:
+            break
+        current = manifests.get(current.get('parent'))
+    if not chain or chain[-1]['type'] != TYPE_FULL:
+        raise ValueError(f"Cadena de respaldos incompleta para {name}")
+    return list(reversed(chain))
+
+def write_backup(db, backup_dir, full=False):
+    """Escribe un respaldo completo o diferencial según la cadena existente
+
+    Devuelve el manifiesto (tipo, padre, base, filas, tamaño y SHA-256).
+    """
+    with FileLock(os.path.join(backup_dir, LOCK_FILE)):
+        until_id = last_change_id(db)
+        previous = list_manifests(backup_dir)
+        previous = previous[-1] if previous else None
+
+        chain_length = previous.get('chain_length', 0) if previous else 0
+        if (full or previous is None or previous.get('change_id') is None
+                or chain_length >= FULL_EVERY):
+            return _write_full(db, backup_dir, until_id)
+
+        if not change_log_trusted(db):
+            logger.warning("ai_pattern_changes no tiene sus triggers instalados: se escribe un respaldo completo")
+            return _write_full(db, backup_dir, until_id)
+
+        try:
+            truncated, changes = changes_since(db, previous['change_id'], until_id)
+        except ChangeLogGap as e:
+            logger.warning(f"{e}: se escribe un respaldo completo")
+            return _write_full(db, backup_dir, until_id)
+        if truncated:
+            # Tras un borrado masivo la base previa no sirve
+            return _write_full(db, backup_dir, until_id)
+
+        manifest = _write_ndjson(backup_dir, _new_name(backup_dir), _diff_rows(db, changes), {
+            'type': TYPE_DIFF,
+            'parent': previous['name'],
+            'base': previous.get('base', previous['name']),
+            'change_id': until_id,
+            'chain_length': chain_length + 1
+        })
+        logger.info(f"Respaldo diferencial de IA escrito: {manifest['file']} ({manifest['rows']} cambios)")
+        return manifest
+
+def _write_full(db, backup_dir, until_id):
+    name = _new_name(backup_dir)
+    manifest = _write_ndjson(backup_dir, name, _pattern_rows(db), {
+        'type': TYPE_FULL,
+        'parent': None,
+        'base': name,
+        'change_id': until_id,
+        'chain_length': 0
+    })
+    # Los cambios incluidos en la instantánea solo hacen falta a los índices
+    # que vayan por detrás; se borran pasado el periodo de retención
+    prune_changes(db, until_id)
+    logger.info(f"Respaldo completo de IA escrito: {manifest['file']} ({manifest['rows']} patrones)")
+    return manifest
+
+def _read_rows(backup_dir, manifest):
+    """Lee las filas de un respaldo verificando su SHA-256"""
+    path = os.path.join(backup_dir, manifest['file'])
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    if manifest.get('sha256') and sha256.hexdigest() != manifest['sha256']:
+        raise ValueError(f"Checksum incorrecto en {manifest['file']}")
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def merge_chain(backup_dir, chain):
+    """Aplica la instantánea base y sus diferenciales; devuelve {clave: fila}"""
+    state = {}
+    for manifest in chain:
+        if manifest['type'] == TYPE_FULL:
+            state = {}
+        for row in _read_rows(backup_dir, manifest):
+            op = row.pop('op', OP_UPSERT)
+            # Los respaldos antiguos no tienen id: se identifican por el texto
+            key = row.get('id') if row.get('id') is not None else row.get('pattern')
+            if op == OP_DELETE:
+                state.pop(key, None)
+            else:
+                state[key] = row
+    return state
+
+def compact_chain(backup_dir, name=None, prune=False):
+    """Fusiona una cadena en una nueva instantánea completa"""
+    with FileLock(os.path.join(backup_dir, LOCK_FILE)):
+        return _compact_chain(backup_dir, name, prune)
+
+def _compact_chain(backup_dir, name, prune):
+    chain = resolve_chain(backup_dir, name)
+    state = merge_chain(backup_dir, chain)
+    last = chain[-1]
+
+    new_name = _new_name(backup_dir)
+    manifest = _write_ndjson(backup_dir, new_name, iter(state.values()), {
+        'type': TYPE_FULL,
+        'parent': None,
+        'base': new_name,
+        'change_id': last.get('change_id'),
+        'chain_length': 0,
+        'compacted_from': [m['name'] for m in chain]
+    })
+
+    if prune:
+        for old in chain:
+            for suffix in (BACKUP_SUFFIX, MANIFEST_SUFFIX):
+                path = os.path.join(backup_dir, old['name'] + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    logger.info(f"Cadena de {len(chain)} respaldos compactada en {manifest['file']}")
+    return manifest
+
+def restore_backup(db, backup_dir, name=None):
+    """Restaura la base de conocimiento reproduciendo la base y sus diferenciales"""
+    from shared.database import AIPattern
+
+    chain = resolve_chain(backup_dir, name)
+    state = merge_chain(backup_dir, chain)
+
+    def parse_date(value):
+        return datetime.fromisoformat(value) if value else None
+
+    db.query(AIPattern).delete()
+    # El siguiente respaldo debe ser completo aunque los triggers no estén instalados
+    record_change(db.connection(), OP_TRUNCATE)
+    for index, row in enumerate(state.values(), 1):
+        fields = {
+            'pattern': row['pattern'],
+            'response': row['response'],
+            'confidence': row['confidence'],
+            'uses': row.get('uses') or 0,
+            'last_used': parse_date(row.get('last_used'))
+        }
+        if row.get('created_at'):
+            fields['created_at'] = parse_date(row['created_at'])
+        db.add(AIPattern(**fields))
+        if index % CHUNK_SIZE == 0:
+            db.flush()
+    db.commit()
+
+    logger.info(f"Restaurados {len(state)} patrones desde {len(chain)} respaldos")
+    return len(state)
+
+def start_backup(session_factory, backup_dir):
+    """Lanza write_backup en un hilo para no bloquear la petición"""
+    def run():
+        db = session_factory()
+        try:
+            write_backup(db, backup_dir)
+        except Exception as e:
+            logger.error(f"Error creando respaldo de IA en segundo plano: {e}")
+        finally:
+            db.close()
+
+    thread = threading.Thread(target=run, name='ai-backup', daemon=True)
+    thread.start()
+    return thread
+
+def stream_backup(session_factory):
+    """Genera un respaldo NDJSON.gz al vuelo para descargarlo sin tocar el disco"""
+    db = session_factory()
+    try:
+        # wbits=31 produce un flujo gzip compatible con gunzip
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        buffer = []
+        buffered = 0
+        for row in _pattern_rows(db):
+            line = _ndjson_line(row)
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= 64 * 1024:
+                chunk = compressor.compress(b''.join(buffer))
+                buffer, buffered = [], 0
+                if chunk:
+                    yield chunk
+        yield compressor.compress(b''.join(buffer)) + compressor.flush()
+    finally:
+        db.close()
+
+def main(argv=None):
+    """Línea de comandos: python -m web.backup {backup,compact,restore}"""
+    from config.config import Config
+    from shared.database import get_db
+
+    parser = argparse.ArgumentParser(description="Respaldos de la base de conocimiento de IA")
+    parser.add_argument('--dir', default=Config.BACKUP_DIR, help="Directorio de respaldos")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup_cmd = commands.add_parser('backup', help="Crea un respaldo (diferencial si es posible)")
+    backup_cmd.add_argument('--full', action='store_true', help="Fuerza una instantánea completa")
+
+    compact_cmd = commands.add_parser('compact', help="Fusiona una cadena en una instantánea completa")
+    compact_cmd.add_argument('name', nargs='?', help="Último respaldo de la cadena (por defecto el más reciente)")
+    compact_cmd.add_argument('--prune', action='store_true', help="Elimina los respaldos fusionados")
+
+    restore_cmd = commands.add_parser('restore', help="Restaura una cadena en la base de datos")
+    restore_cmd.add_argument('name', nargs='?', help="Respaldo hasta el que restaurar (por defecto el más reciente)")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'compact':
+        print(json.dumps(compact_chain(args.dir, args.name, args.prune), indent=4, ensure_ascii=False))
+        return 0
+
+    db = get_db()
+    try:
+        if args.command == 'backup':
+            print(json.dumps(write_backup(db, args.dir, full=args.full), indent=4, ensure_ascii=False))
+        else:
+            print(f"Restaurados {restore_backup(db, args.dir, args.name)} patrones")
+    finally:
+        db.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+Motor de envíos masivos en segundo plano
+Los envíos se guardan en una bandeja de salida persistente y los procesa un
+grupo de hilos con límite global de velocidad, ritmo por chat y reintentos.
+Solo el proceso que gana el bloqueo BROADCAST_LOCK procesa la bandeja, de
+modo que el límite de velocidad vale para todos los workers de la máquina.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import (Table, Column, MetaData, Integer, BigInteger, String, Text, DateTime,
+                        select, func, literal, and_)
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+# Límites de Telegram: ~30 mensajes/s en total, 1/s por chat privado y 20/min por grupo
+GLOBAL_RATE = float(os.environ.get('BROADCAST_RATE', 30))
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+
+MAX_ATTEMPTS = 5
+BATCH_SIZE = 100
+WORKERS = int(os.environ.get('BROADCAST_WORKERS', 4))
+# Envíos reclamados por un proceso que murió vuelven a la cola tras este tiempo
+STALE_CLAIM = timedelta(minutes=5)
+# Cada cuánto busca el despachador envíos reclamados por procesos muertos (segundos)
+REQUEUE_INTERVAL = 60
+
+# Bloqueo que elige el proceso despachador; los demás reintentan cada ELECTION_INTERVAL segundos
+LEADER_LOCK = os.environ.get('BROADCAST_LOCK', run_path('broadcast.lock'))
+ELECTION_INTERVAL = 5.0
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+JOB_QUEUED = 'queued'
+JOB_DONE = 'done'
+
+metadata = MetaData()
+
+broadcast_jobs = Table(
+    'broadcast_jobs', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('message', Text, nullable=False),
+    Column('parse_mode', String(16)),
+    Column('recipient_type', String(16), nullable=False),
+    Column('status', String(16), nullable=False, default=JOB_QUEUED),
+    Column('total', Integer, nullable=False, default=0),
+    Column('created_by', String(80)),
+    Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+    Column('finished_at', DateTime)
+)
+
+broadcast_outbox = Table(
+    'broadcast_outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('job_id', Integer, nullable=False, index=True),
+    Column('chat_id', BigInteger, nullable=False),
+    Column('status', String(16), nullable=False, default=STATUS_PENDING, index=True),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('next_attempt_at', DateTime, nullable=False, default=datetime.utcnow),
+    Column('claimed_at', DateTime),
+    Column('sent_at', DateTime),
+    Column('last_error', Text)
+)
+
+def ensure_broadcast_tables(bind):
+    """Crea las tablas de envíos masivos si no existen"""
+    metadata.create_all(bind=bind, checkfirst=True)
+
+def enqueue_broadcast(db, message, recipient_type, parse_mode='Markdown', created_by=None):
+    """Crea un trabajo y su bandeja de salida con un único INSERT ... SELECT
+
+    Devuelve el id del trabajo.
+    """
+    from shared.database import User as BotUser, Group
+
+    if recipient_type in ('all', 'active'):
+        if not hasattr(BotUser, 'telegram_id'):
+            raise ValueError("El modelo de usuarios del bot no tiene telegram_id")
+        source = select(BotUser.telegram_id).where(BotUser.telegram_id.isnot(None))
+        if recipient_type == 'active':
+            week_ago = datetime.now() - timedelta(days=7)
+            source = source.where(BotUser.created_at >= week_ago)
+    elif recipient_type == 'groups':
+        if not hasattr(Group, 'chat_id'):
+            raise ValueError("El modelo de grupos no tiene chat_id")
+        source = select(Group.chat_id).where(Group.chat_id.isnot(None))
+    else:
+        raise ValueError(f"Tipo de destinatario no válido: {recipient_type}")
+
+    job_id = db.execute(broadcast_jobs.insert().values(
+        message=message,
+        parse_mode=parse_mode,
+        recipient_type=recipient_type,
+        status=JOB_QUEUED,
+        created_by=created_by,
+        created_at=datetime.utcnow()
+    )).inserted_primary_key[0]
+
+    chat_ids = source.subquery()
+    now = datetime.utcnow()
+    result = db.execute(broadcast_outbox.insert().from_select(
+        ['job_id', 'chat_id', 'status', 'attempts', 'next_attempt_at'],
+        select(literal(job_id), chat_ids.c[0], literal(STATUS_PENDING), literal(0), literal(now))
+    ))
+    db.execute(broadcast_jobs.update().where(broadcast_jobs.c.id == job_id).values(total=result.rowcount))
+    db.commit()
+
+    logger.info(f"Envío masivo {job_id} encolado con {result.rowcount} destinatarios")
+    return job_id
+
+def get_broadcast_progress(db, job_id):
+    """Estado de un trabajo con los contadores por estado de su bandeja de salida"""
+    job = db.execute(select(broadcast_jobs).where(broadcast_jobs.c.id == job_id)).mappings().first()
+    if job is None:
+        return None
+
+    counts = {STATUS_PENDING: 0, STATUS_SENDING: 0, STATUS_SENT: 0, STATUS_FAILED: 0}
+    rows = db.execute(
+        select(broadcast_outbox.c.status, func.count())
+        .where(broadcast_outbox.c.job_id == job_id)
+        .group_by(broadcast_outbox.c.status)
+    )
+    for status, total in rows:
+        counts[status] = total
+
+    total = job['total'] or sum(counts.values())
+    done = counts[STATUS_SENT] + counts[STATUS_FAILED]
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'recipient_type': job['recipient_type'],
+        'total': total,
+        'sent': counts[STATUS_SENT],
+        'failed': counts[STATUS_FAILED],
+        'pending': counts[STATUS_PENDING] + counts[STATUS_SENDING],
+        'progress': round(done * 100.0 / total, 1) if total else 100.0,
+        'created_at': job['created_at'].isoformat() if job['created_at'] else None,
+        'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None
+    }
+
+class TokenBucket:
+    """Limitador de velocidad global (thread-safe)"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Detiene todos los envíos (p. ej. tras un RetryAfter de Telegram)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+class StubSender:
+    """Emisor local para pruebas: registra los envíos y puede simular fallos"""
+
+    def __init__(self, failures=None):
+        # failures: {chat_id: [excepción, ...]} que se lanzan en orden
+        self.failures = {chat_id: list(errors) for chat_id, errors in (failures or {}).items()}
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def __call__(self, chat_id, text, parse_mode=None):
+        with self._lock:
+            errors = self.failures.get(chat_id)
+            if errors:
+                raise errors.pop(0)
+            self.sent.append((chat_id, text, parse_mode))
+
+def telegram_sender():
+    """Emisor real basado en el bot de Telegram
+
+    Si send_message es asíncrono, las corrutinas de todos los hilos se
+    ejecutan en un único bucle de eventos propio del emisor, que conserva
+    la sesión HTTP del bot entre mensajes.
+    """
+    from bot.main import TelegramBot
+    bot = TelegramBot()
+    loop = None
+    loop_lock = threading.Lock()
+
+    def event_loop():
+        nonlocal loop
+        with loop_lock:
+            if loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='broadcast-loop', daemon=True).start()
+            return loop
+
+    def send(chat_id, text, parse_mode=None):
+        result = bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run_coroutine_threadsafe(result, event_loop()).result()
+        return result
+    return send
+
+class BroadcastEngine:
+    """Procesa la bandeja de salida con un grupo de hilos
+
+    Un hilo despachador reclama lotes de envíos pendientes (UPDATE
+    condicional, seguro entre procesos) y los reparte a los trabajadores.
+    Cada envío respeta el límite global y el ritmo por chat; los errores se
+    reintentan con espera exponencial o con el retry_after de Telegram.
+
+    Los hilos solo arrancan en el proceso que obtiene lock_path; si ese
+    proceso muere, el sistema libera el bloqueo y otro worker lo releva.
+    """
+
+    def __init__(self, session_factory, sender_factory=telegram_sender, workers=WORKERS,
+                 rate=GLOBAL_RATE, poll_interval=2.0, lock_path=LEADER_LOCK):
+        self._session_factory = session_factory
+        self._sender_factory = sender_factory
+        self._sender = None
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.bucket = TokenBucket(rate)
+        self._queue = []
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._chat_last_sent = {}
+        self._chat_lock = threading.Lock()
+        self._threads = []
+        self._leader = None
+        self._lock_path = lock_path
+        self._pid = None
+        self._stopping = False
+
+    # --- ciclo de vida -------------------------------------------------
+
+    def ensure_started(self):
+        """Arranca la elección del despachador una vez por proceso (los hilos no sobreviven al fork)"""
+        with self._condition:
+            if self._pid == os.getpid() and self._leader is not None and self._leader.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._threads = []
+            self._leader = threading.Thread(target=self._leader_loop, name='broadcast-leader', daemon=True)
+            self._leader.start()
+
+    @property
+    def is_leader(self):
+        return bool(self._threads) and self._pid == os.getpid()
+
+    def _leader_loop(self):
+        """Espera a ganar el bloqueo y entonces arranca el despachador y los trabajadores"""
+        from .filelock import FileLock
+
+        lock = FileLock(self._lock_path)
+        while not self._stopping:
+            try:
+                ensure_private_dir(os.path.dirname(self._lock_path) or '.')
+                if lock.acquire(blocking=False):
+                    break
+            except OSError as e:
+                logger.error(f"Error obteniendo el bloqueo de envíos masivos {self._lock_path}: {e}")
+            time.sleep(ELECTION_INTERVAL)
+        else:
+            return
+
+        threads = [threading.Thread(target=self._dispatch_loop, name='broadcast-dispatcher', daemon=True)]
+        threads += [
+            threading.Thread(target=self._worker_loop, name=f'broadcast-worker-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        with self._condition:
+            self._threads = threads
+        for thread in threads:
+            thread.start()
+        logger.info(f"Motor de envíos masivos iniciado con {self.workers} hilos en el proceso {self._pid}")
+
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            lock.release()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._wake.set()
+
+    def wake(self):
+        """Avisa al despachador de que hay trabajo nuevo"""
+        self._wake.set()
+
+    # --- despacho ------------------------------------------------------
+
+    def _sender_fn(self):
+        if self._sender is None:
+            self._sender = self._sender_factory()
+        return self._sender
+
+    def _requeue_stale(self, db):
+        db.execute(broadcast_outbox.update().where(and_(
+            broadcast_outbox.c.status == STATUS_SENDING,
+            broadcast_outbox.c.claimed_at < datetime.utcnow() - STALE_CLAIM
+        )).values(status=STATUS_PENDING, claimed_at=None))
+        db.commit()
+
+    def claim_batch(self, db, limit=BATCH_SIZE):
+        """Reclama envíos pendientes; solo devuelve los que este proceso ganó"""
+        t = broadcast_outbox
+        now = datetime.utcnow()
+        candidates = db.execute(
+            select(t.c.id, t.c.job_id, t.c.chat_id, t.c.attempts)
+            .where(t.c.status == STATUS_PENDING, t.c.next_attempt_at <= now)
+            .order_by(t.c.next_attempt_at, t.c.id)
+            .limit(limit)
+        ).all()
+
+        claimed = []
+        for row in candidates:
+            result = db.execute(t.update().where(and_(
+                t.c.id == row.id, t.c.status == STATUS_PENDING
+            )).values(status=STATUS_SENDING, claimed_at=now))
+            if result.rowcount == 1:
+                claimed.append(row)
+        db.commit()
+
+        if not claimed:
+            return []
+        job_ids = {row.job_id for row in claimed}
+        jobs = {
+            job.id: job for job in db.execute(
+                select(broadcast_jobs.c.id, broadcast_jobs.c.message, broadcast_jobs.c.parse_mode)
+                .where(broadcast_jobs.c.id.in_(job_ids))
+            )
+        }
+        return [(row, jobs[row.job_id]) for row in claimed if row.job_id in jobs]
+
+    def _dispatch_loop(self):
+        db = self._session_factory()
+        last_requeue = None
+
+        while not self._stopping:
+            now = time.monotonic()
+            if last_requeue is None or now - last_requeue >= REQUEUE_INTERVAL:
+                last_requeue = now
+                try:
+                    self._requeue_stale(db)
+                except Exception as e:
+                    logger.error(f"Error recuperando envíos interrumpidos: {e}")
+                    db.rollback()
+            try:
+                with self._condition:
+                    backlog = len(self._queue)
+                batch = self.claim_batch(db) if backlog < self.workers * 2 else []
+                if batch:
+                    with self._condition:
+                        self._queue.extend(batch)
+                        self._condition.notify_all()
+                    continue
+                self._finish_jobs(db)
+            except Exception as e:
+                logger.error(f"Error en el despachador de envíos masivos: {e}")
+                db.rollback()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        db.close()
+
+    def _finish_jobs(self, db):
+        """Marca como terminados los trabajos sin envíos pendientes"""
+        open_items = select(broadcast_outbox.c.id).where(and_(
+            broadcast_outbox.c.job_id == broadcast_jobs.c.id,
+            broadcast_outbox.c.status.in_([STATUS_PENDING, STATUS_SENDING])
+        )).exists()
+        result = db.execute(broadcast_jobs.update().where(and_(
+            broadcast_jobs.c.status == JOB_QUEUED, ~open_items
+        )).values(status=JOB_DONE, finished_at=datetime.utcnow()))
+        db.commit()
+        if result.rowcount:
+            logger.info(f"{result.rowcount} envíos masivos completados")
+
+    # --- envío ---------------------------------------------------------
+
+    def _pace_chat(self, chat_id):
+        """Espera lo necesario para respetar el ritmo por chat"""
+        interval = GROUP_CHAT_INTERVAL if chat_id < 0 else PRIVATE_CHAT_INTERVAL
+        with self._chat_lock:
+            now = time.monotonic()
+            ready_at = self._chat_last_sent.get(chat_id, 0) + interval
+            self._chat_last_sent[chat_id] = max(now, ready_at)
+        if ready_at > now:
+            time.sleep(ready_at - now)
+
+    def _worker_loop(self):
+        db = self._session_factory()
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    break
+                item, job = self._queue.pop(0)
+            if not self._queue:
+                self.wake()
+            try:
+                self.deliver(db, item, job)
+            except Exception as e:
+                logger.error(f"Error registrando envío {item.id}: {e}")
+                db.rollback()
+        db.close()
+
+    def deliver(self, db, item, job):
+        """Envía un mensaje y registra el resultado en la bandeja de salida"""
+        t = broadcast_outbox
+        self._pace_chat(item.chat_id)
+        self.bucket.acquire()
+        try:
+            self._sender_fn()(item.chat_id, job.message, job.parse_mode)
+        except Exception as send_err:
+            attempts = item.attempts + 1
+            retry_after = getattr(send_err, 'retry_after', None)
+            if retry_after is not None:
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                # El control de flood de Telegram afecta a todo el bot y no cuenta como fallo
+                self.bucket.pause(retry_after)
+                attempts = item.attempts
+                delay = retry_after
+            else:
+                delay = min(2 ** attempts, 300)
+
+            if attempts >= MAX_ATTEMPTS:
+                values = {'status': STATUS_FAILED}
+                logger.error(f"Envío a {item.chat_id} descartado tras {attempts} intentos: {send_err}")
+            else:
+                values = {
+                    'status': STATUS_PENDING,
+                    'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay)
+                }
+            db.execute(t.update().where(t.c.id == item.id).values(
+                attempts=attempts, last_error=str(send_err)[:500], claimed_at=None, **values
+            ))
+            db.commit()
+            return False
+
+        db.execute(t.update().where(t.c.id == item.id).values(
+            status=STATUS_SENT, attempts=item.attempts + 1, sent_at=datetime.utcnow()
+        ))
+        db.commit()
+        return True
+
+def _default_session():
+    from .dbsession import make_session
+    return make_session()
+
+broadcast_engine = BroadcastEngine(_default_session)
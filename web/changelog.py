@@ -0,0 +1,245 @@
+"""
+Registro de cambios de patrones de IA (ai_pattern_changes)
+Guarda altas, modificaciones y borrados para los respaldos diferenciales.
+Lo alimentan triggers de ai_patterns (PostgreSQL y SQLite), así que recoge
+las escrituras de la web y del bot por igual.
+
+Lo leen también los índices TF-IDF de cada worker y los snapshots publicados,
+cada uno desde su propio punto. Por eso solo se borran entradas con más de
+AI_CHANGES_RETENTION_HOURS de antigüedad y se anota hasta dónde se borró: quien
+pida cambios anteriores recibe ChangeLogGap y debe reconstruir desde la tabla.
+
+max(id) sirve de marca de agua porque los identificadores se asignan en orden
+de commit: en PostgreSQL el trigger se difiere al commit y toma un bloqueo
+consultivo que se libera cuando la transacción ya es visible; en SQLite el
+escritor conserva el bloqueo de escritura hasta el commit.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import Table, Column, MetaData, Integer, String, Text, DateTime, func, select
+
+logger = logging.getLogger('web')
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+# Borrado masivo o cambios sin registrar: el siguiente respaldo debe ser completo
+OP_TRUNCATE = 'truncate'
+# Marca de poda: pattern_id guarda el último identificador borrado
+OP_PRUNE = 'prune'
+
+# Antigüedad mínima de las entradas que se pueden borrar
+RETENTION = timedelta(hours=float(os.environ.get('AI_CHANGES_RETENTION_HOURS', 24)))
+
+metadata = MetaData()
+
+ai_pattern_changes = Table(
+    'ai_pattern_changes', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('pattern_id', Integer, index=True),
+    Column('pattern', Text),
+    Column('op', String(16), nullable=False),
+    Column('changed_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+TRIGGER_PREFIX = 'lba_changes'
+
+# Columnas cuyo cambio se registra; los contadores uses/last_used que actualiza
+# el bot en cada respuesta no cuentan como cambio del patrón
+CONTENT_COLUMNS = ('pattern', 'response', 'confidence')
+
+# Bloqueo consultivo de PostgreSQL que ordena los identificadores por commit
+ORDER_LOCK_KEY = 0x6c626163
+
+class ChangeLogGap(Exception):
+    """Los cambios pedidos ya se borraron del registro"""
+
+def record_change(connection, op, pattern_id=None, pattern=None):
+    """Añade una entrada al registro usando la conexión de la transacción actual
+
+    En PostgreSQL toma el bloqueo de ORDER_LOCK_KEY hasta el commit, como los triggers.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(f"SELECT pg_advisory_xact_lock({ORDER_LOCK_KEY})")
+    connection.execute(ai_pattern_changes.insert().values(
+        pattern_id=pattern_id,
+        pattern=pattern,
+        op=op,
+        changed_at=datetime.utcnow()
+    ))
+
+def _postgresql_triggers(quote, table):
+    function = TRIGGER_PREFIX
+    target = quote(ai_pattern_changes.name)
+    columns = f"{target} (pattern_id, pattern, op, changed_at)"
+    # Hasta el commit nadie más obtiene un identificador: max(id) no salta cambios sin confirmar
+    return [
+        f"""CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock({ORDER_LOCK_KEY});
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO {columns} VALUES (NULL, NULL, '{OP_TRUNCATE}', now());
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO {columns} VALUES (OLD.id, OLD.pattern, '{OP_DELETE}', now());
+    ELSE
+        INSERT INTO {columns} VALUES (NEW.id, NEW.pattern, '{OP_UPSERT}', now());
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql""",
+        f"DROP TRIGGER IF EXISTS {function} ON {quote(table)}",
+        # Trigger de restricción diferido: se ejecuta al hacer commit, no al escribir la fila
+        f"CREATE CONSTRAINT TRIGGER {function} AFTER INSERT OR "
+        f"UPDATE OF {', '.join(quote(column) for column in CONTENT_COLUMNS)} OR DELETE ON {quote(table)} "
+        f"DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE PROCEDURE {function}()",
+        f"DROP TRIGGER IF EXISTS {function}_truncate ON {quote(table)}",
+        f"CREATE TRIGGER {function}_truncate AFTER TRUNCATE ON {quote(table)} "
+        f"FOR EACH STATEMENT EXECUTE PROCEDURE {function}()"
+    ]
+
+def _sqlite_triggers(quote, table):
+    target = quote(ai_pattern_changes.name)
+    statements = []
+    for event_name, row, op in (('INSERT', 'NEW', OP_UPSERT), ('UPDATE', 'NEW', OP_UPSERT),
+                                ('DELETE', 'OLD', OP_DELETE)):
+        name = f"{TRIGGER_PREFIX}_{event_name.lower()}"
+        condition = ''
+        if event_name == 'UPDATE':
+            changed = ' OR '.join(f"OLD.{quote(c)} IS NOT NEW.{quote(c)}" for c in CONTENT_COLUMNS)
+            condition = f"WHEN {changed} "
+        statements.append(f"DROP TRIGGER IF EXISTS {name}")
+        statements.append(
+            f"CREATE TRIGGER {name} AFTER {event_name} ON {quote(table)} FOR EACH ROW {condition}BEGIN\n"
+            f"INSERT INTO {target} (pattern_id, pattern, op, changed_at) "
+            f"VALUES ({row}.id, {row}.pattern, '{op}', CURRENT_TIMESTAMP);\nEND"
+        )
+    return statements
+
+_TRIGGER_BUILDERS = {
+    'postgresql': _postgresql_triggers,
+    'sqlite': _sqlite_triggers
+}
+
+# Triggers que deben existir para fiarse del registro
+_EXPECTED_TRIGGERS = {
+    'postgresql': 2,
+    'sqlite': 3
+}
+
+def install_change_triggers(db):
+    """Crea los triggers de ai_patterns que alimentan ai_pattern_changes
+
+    Al vivir en la base de datos registran también lo que aprende el proceso
+    del bot. Como los cambios anteriores a su instalación no constan, se anota
+    un borrado masivo y el siguiente respaldo será completo. Devuelve False si
+    el dialecto no está soportado.
+    """
+    from shared.database import AIPattern
+
+    ensure_changelog_table(db.get_bind())
+    connection = db.connection()
+    builder = _TRIGGER_BUILDERS.get(connection.dialect.name)
+    if builder is None:
+        db.commit()
+        logger.warning(
+            f"El dialecto {connection.dialect.name} no admite los triggers de ai_pattern_changes: "
+            f"los respaldos serán siempre completos"
+        )
+        return False
+
+    quote = connection.dialect.identifier_preparer.quote
+    for statement in builder(quote, AIPattern.__table__.name):
+        connection.exec_driver_sql(statement)
+    record_change(connection, OP_TRUNCATE)
+    db.commit()
+    logger.info("Triggers de ai_pattern_changes instalados")
+    return True
+
+def change_log_trusted(db):
+    """True si los triggers del registro están instalados en la base de datos
+
+    Sin ellos los cambios hechos por el bot no constan y el registro no sirve
+    para construir diferenciales.
+    """
+    connection = db.connection()
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        query = ("SELECT count(*) FROM pg_trigger "
+                 f"WHERE tgname LIKE '{TRIGGER_PREFIX}%' AND NOT tgisinternal")
+    elif dialect == 'sqlite':
+        query = f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE '{TRIGGER_PREFIX}%'"
+    else:
+        return False
+    return (connection.exec_driver_sql(query).scalar() or 0) >= _EXPECTED_TRIGGERS[dialect]
+
+def ensure_changelog_table(bind):
+    """Crea la tabla ai_pattern_changes si no existe"""
+    metadata.create_all(bind=bind, tables=[ai_pattern_changes], checkfirst=True)
+
+def last_change_id(db):
+    """Identificador del último cambio registrado (0 si no hay ninguno)
+
+    Los cambios que se confirmen después tendrán siempre un identificador mayor.
+    """
+    return db.execute(select(func.max(ai_pattern_changes.c.id))).scalar() or 0
+
+def pruned_up_to(db):
+    """Último identificador que puede faltar por la poda (0 si nunca se ha podado)"""
+    t = ai_pattern_changes
+    return db.execute(select(func.max(t.c.pattern_id)).where(t.c.op == OP_PRUNE)).scalar() or 0
+
+def changes_since(db, after_id, until_id):
+    """Último cambio de cada patrón en el intervalo (after_id, until_id]
+
+    Devuelve (truncado, cambios) donde cambios es una lista de
+    (pattern_id, patrón, operación) ordenada por identificador de cambio.
+    Lanza ChangeLogGap si parte del intervalo ya se podó.
+    """
+    pruned = pruned_up_to(db)
+    if after_id < pruned:
+        raise ChangeLogGap(f"ai_pattern_changes está podado hasta {pruned} y se pidieron cambios desde {after_id}")
+
+    t = ai_pattern_changes
+    rows = db.execute(
+        select(t.c.id, t.c.pattern_id, t.c.pattern, t.c.op)
+        .where(t.c.id > after_id, t.c.id <= until_id)
+        .order_by(t.c.id)
+    )
+
+    truncated = False
+    latest = {}
+    for change_id, pattern_id, pattern, op in rows:
+        if op == OP_PRUNE:
+            continue
+        if op == OP_TRUNCATE:
+            # Todo lo anterior queda anulado por el borrado masivo
+            truncated = True
+            latest = {}
+            continue
+        latest[pattern_id] = (change_id, pattern, op)
+
+    changes = sorted(
+        ((change_id, pattern_id, pattern, op) for pattern_id, (change_id, pattern, op) in latest.items()),
+        key=lambda item: item[0]
+    )
+    return truncated, [(pattern_id, pattern, op) for _, pattern_id, pattern, op in changes]
+
+def prune_changes(db, up_to_id):
+    """Elimina las entradas ya cubiertas por una instantánea completa y más
+    antiguas que RETENTION, y anota el límite con una marca OP_PRUNE
+
+    Se conserva al menos la última: SQLite reutiliza los identificadores si la
+    tabla queda vacía y los cambios nuevos quedarían por debajo de up_to_id.
+    Devuelve el último identificador borrado (0 si no se borró nada).
+    """
+    t = ai_pattern_changes
+    cutoff = datetime.utcnow() - RETENTION
+    bound = db.execute(
+        select(func.max(t.c.id)).where(t.c.id < up_to_id, t.c.changed_at < cutoff)
+    ).scalar()
+    if not bound:
+        return 0
+    db.execute(t.delete().where(t.c.id <= bound))
+    record_change(db.connection(), OP_PRUNE, pattern_id=bound)
+    db.commit()
+    return bound
@@ -0,0 +1,158 @@
+"""
+Auditoría de consultas SQL
+Cuenta las consultas y el tiempo de base de datos de cada solicitud (tanto
+de db como de las sesiones de get_db), detecta patrones N+1 y registra las
+consultas lentas con el SQL normalizado en su propio fichero (SLOW_QUERY_LOG)
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('web')
+slow_logger = logging.getLogger('web.slow_queries')
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+# Veces que una misma forma de consulta puede repetirse antes de marcarla como N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM_LIST_RE = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+|%s)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+|%s)\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+_installed = False
+_slow_log_handler = None
+_budgets = threading.local()
+
+def normalize_sql(statement):
+    """Forma de la consulta sin literales ni listas de parámetros"""
+    sql = _STRING_RE.sub('?', statement)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _PARAM_LIST_RE.sub('(?)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+class QueryAudit:
+    """Consultas ejecutadas durante una solicitud"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.shapes[normalize_sql(statement)] += 1
+
+    def n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Formas de consulta repetidas al menos threshold veces"""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+class QueryBudgetExceeded(AssertionError):
+    """Un bloque ejecutó más consultas de las permitidas"""
+
+@contextmanager
+def query_budget(max_queries):
+    """Cuenta las consultas del bloque en este hilo y falla si superan max_queries
+
+    Pensado para pruebas: with query_budget(10): client.get('/dashboard')
+    """
+    audit = QueryAudit()
+    stack = getattr(_budgets, 'stack', None)
+    if stack is None:
+        stack = _budgets.stack = []
+    stack.append(audit)
+    try:
+        yield audit
+    finally:
+        stack.remove(audit)
+    if audit.count > max_queries:
+        shapes = '\n'.join(f"  {count}x {shape}" for shape, count in audit.shapes.most_common(5))
+        raise QueryBudgetExceeded(f"{audit.count} consultas (máximo {max_queries}):\n{shapes}")
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start_time')
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+
+    for audit in getattr(_budgets, 'stack', ()):
+        audit.record(statement, duration)
+
+    in_request = has_request_context()
+    if in_request:
+        audit = g.get('db_audit')
+        if audit is not None:
+            audit.record(statement, duration)
+
+    if duration * 1000 >= SLOW_QUERY_MS and slow_logger.isEnabledFor(logging.WARNING):
+        endpoint = request.endpoint if in_request else None
+        slow_logger.warning(f"Consulta lenta ({duration * 1000:.1f} ms) en {endpoint or 'segundo plano'}: {normalize_sql(statement)}")
+
+def _handle_error(context):
+    # after_cursor_execute no se llama si la consulta falla: se descarta su inicio
+    connection = context.connection
+    if connection is None or context.execution_context is None:
+        return
+    starts = connection.info.get('query_start_time')
+    if starts:
+        starts.pop()
+
+def setup_slow_query_log(formatter, path=SLOW_QUERY_LOG):
+    """Escribe las consultas lentas en path a través de la cola de logs (una vez por proceso)
+
+    No se propagan a app.log: el fichero es el registro de consultas lentas.
+    """
+    global _slow_log_handler
+    if _slow_log_handler is None:
+        from .logpipeline import setup_queued_logging
+        _slow_log_handler = setup_queued_logging(path, formatter, [slow_logger], level=logging.WARNING)
+        slow_logger.propagate = False
+    return _slow_log_handler
+
+def install_query_auditor():
+    """Escucha la ejecución de cursores de todos los motores (db y get_db)"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _installed = True
+    logger.info("Auditoría de consultas SQL instalada")
+
+def query_audit_middleware(app, header=None):
+    """Resumen de consultas por solicitud: cabecera X-DB-Queries y aviso de N+1"""
+    if header is None:
+        header = app.debug or os.environ.get('DB_AUDIT_HEADER') == '1'
+    install_query_auditor()
+
+    @app.before_request
+    def start_query_audit():
+        g.db_audit = QueryAudit()
+
+    @app.after_request
+    def finish_query_audit(response):
+        audit = g.get('db_audit')
+        if audit is None:
+            return response
+
+        suspects = audit.n_plus_one()
+        for shape, count in suspects:
+            logger.warning(f"Posible N+1 en {request.endpoint}: {count}x {shape}")
+        if header:
+            response.headers['X-DB-Queries'] = (
+                f"count={audit.count}; time={audit.total_time * 1000:.1f}ms; n+1={len(suspects)}"
+            )
+        return response
@@ -0,0 +1,121 @@
+"""
+Sesiones de base de datos por solicitud sobre un único pool de conexiones
+Las consultas a los modelos del bot usan el mismo motor que db (Flask-SQLAlchemy)
+y la sesión de cada solicitud se cierra en teardown_appcontext
+"""
+import os
+import time
+import logging
+from flask import g, has_app_context
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from .metrics import registry
+
+logger = logging.getLogger('web')
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+DB_POOL_WAIT = registry.histogram(
+    'db_pool_checkout_wait_seconds',
+    'Tiempo de espera para obtener una conexión del pool'
+)
+DB_POOL_CHECKED_OUT = registry.gauge(
+    'db_pool_checked_out',
+    'Conexiones del pool en uso'
+)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide la espera de cada checkout y las conexiones en uso"""
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - start_time)
+        DB_POOL_CHECKED_OUT.inc()
+        return connection
+
+    def _do_return_conn(self, record):
+        DB_POOL_CHECKED_OUT.dec()
+        super()._do_return_conn(record)
+
+def engine_options(database_url):
+    """Opciones del motor compartido (SQLALCHEMY_ENGINE_OPTIONS)"""
+    options = {
+        'pool_pre_ping': True,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+    if database_url.startswith('sqlite'):
+        # SQLite usa su propio pool y no acepta los parámetros de libpq
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'connect_args': {
+            'connect_timeout': 10,  # Timeout de conexión en segundos
+            'keepalives': 1,        # Mantener conexión viva
+            'keepalives_idle': 30,  # Tiempo de inactividad antes de enviar keepalive
+            'keepalives_interval': 10,  # Intervalo entre keepalives
+            'keepalives_count': 5   # Número de keepalives fallidos antes de cerrar
+        }
+    })
+    return options
+
+_session_factory = sessionmaker()
+_bound = False
+
+def make_session():
+    """Nueva sesión sobre el pool compartido (el llamador debe cerrarla)
+
+    Para hilos en segundo plano; dentro de una solicitud usar request_db().
+    """
+    if not _bound:
+        from shared.database import get_db
+        return get_db()
+    return _session_factory()
+
+def request_db():
+    """Sesión de la solicitud actual; se cierra sola al terminar"""
+    if not has_app_context():
+        raise RuntimeError("request_db() requiere un contexto de aplicación")
+    session = g.get('bot_db')
+    if session is None:
+        session = g.bot_db = make_session()
+    return session
+
+def init_db_sessions(app, engine):
+    """Enlaza las sesiones del bot al motor de db y registra el cierre por solicitud"""
+    global _bound
+
+    from shared.database import get_db
+    bot_session = get_db()
+    try:
+        bot_url = bot_session.get_bind().url
+    finally:
+        bot_session.close()
+
+    if str(bot_url) == str(engine.url):
+        _session_factory.configure(bind=engine)
+        _bound = True
+        logger.info("Sesiones del bot enlazadas al pool compartido")
+    else:
+        # Bases de datos distintas: se mantiene el motor de shared.database
+        logger.warning("shared.database usa otra URL de base de datos; no se comparte el pool")
+
+    @app.teardown_appcontext
+    def close_request_db(exc):
+        session = g.pop('bot_db', None)
+        if session is None:
+            return
+        try:
+            if exc is not None:
+                session.rollback()
+        finally:
+            session.close()
@@ -0,0 +1,96 @@
+"""
+Bloqueo entre procesos basado en fcntl.flock
+Lo usan los respaldos, el entrenamiento y la publicación de índices, que
+pueden lanzarse a la vez desde varios workers de gunicorn o desde la CLI.
+
+El sistema operativo libera el bloqueo al cerrar el descriptor o al morir el
+proceso, así que no quedan ficheros huérfanos que haya que limpiar a mano.
+"""
+import os
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se serializa dentro del proceso
+    fcntl = None
+
+logger = logging.getLogger('web')
+
+# Respaldo sin fcntl: un threading.Lock por ruta
+_local_locks = {}
+_local_guard = threading.Lock()
+
+class FileLock:
+    """Bloqueo exclusivo sobre path; cada acquire() abre su propio descriptor,
+    por lo que también excluye a otros hilos del mismo proceso
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._local = None
+
+    def acquire(self, blocking=True):
+        """Devuelve True si se obtiene el bloqueo (False solo si blocking=False)"""
+        if fcntl is None:
+            with _local_guard:
+                self._local = _local_locks.setdefault(self.path, threading.Lock())
+            return self._local.acquire(blocking)
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except Exception:
+            os.close(fd)
+            raise
+
+        # El pid solo es informativo: el bloqueo lo mantiene el descriptor
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if fcntl is None:
+            if self._local is not None:
+                self._local.release()
+                self._local = None
+            return
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            # No se borra el fichero: otro proceso podría tenerlo ya abierto
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def detach(self):
+        """Cierra un descriptor heredado tras fork() sin liberar el bloqueo del padre"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._local = None
+
+    @property
+    def locked(self):
+        return self._fd is not None or self._local is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def is_locked(path):
+    """True si otro descriptor (de este u otro proceso) tiene el bloqueo de path"""
+    probe = FileLock(path)
+    if probe.acquire(blocking=False):
+        probe.release()
+        return False
+    return True
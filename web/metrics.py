@@ -0,0 +1,306 @@
+"""
+Métricas de latencia en memoria y exportación en formato Prometheus
+Histogramas de cubetas logarítmicas fijas por proceso; cada proceso vuelca
+su estado a un directorio compartido y /metrics suma todos los volcados.
+
+Cada proceso mantiene un bloqueo sobre su volcado mientras vive. Al recoger,
+los histogramas de los procesos terminados se acumulan en TOMBSTONE_FILE y
+sus volcados se borran, así que el directorio no crece con cada reinicio.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from bisect import bisect_left
+from .filelock import FileLock, is_locked
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+METRICS_DIR = os.environ.get('METRICS_DIR', run_path('metrics'))
+FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# Histogramas acumulados de los procesos ya terminados
+TOMBSTONE_FILE = 'tombstone.json'
+COLLECT_LOCK = 'collect.lock'
+
+# Cubetas logarítmicas (factor raíz de 2) de 1 ms a ~23 s
+BUCKETS = tuple(0.001 * 2 ** (i / 2) for i in range(30))
+INF_LABEL = 'le="+Inf"'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    """Histograma de memoria fija por combinación de etiquetas"""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        self.registry.ensure_flusher()
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), list(counts), total] for labels, (counts, total) in self._series.items()]
+
+class Gauge:
+    """Valor instantáneo por proceso (solo cuenta mientras el proceso vive)"""
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        self.registry.ensure_flusher()
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+class MetricsRegistry:
+    """Conjunto de métricas del proceso y su volcado a METRICS_DIR"""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._pid = None
+        self._name = None
+        self._alive_lock = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        metric = self._metrics[name] = Histogram(self, name, documentation, labelnames, buckets)
+        return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        metric = self._metrics[name] = Gauge(self, name, documentation, labelnames)
+        return metric
+
+    def ensure_flusher(self):
+        # Los hilos no sobreviven al fork de gunicorn: un volcador por proceso
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Lo heredado del proceso padre ya está en su propio volcado
+                for metric in self._metrics.values():
+                    metric.reset()
+            if self._alive_lock is not None:
+                self._alive_lock.detach()
+            self._pid = os.getpid()
+            # Un pid reutilizado no debe pisar el volcado de un proceso anterior
+            self._name = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+            alive_lock = FileLock(os.path.join(self.directory, f"{self._name}.lock"))
+            try:
+                ensure_private_dir(self.directory)
+                acquired = alive_lock.acquire(blocking=False)
+            except OSError as e:
+                acquired = False
+                logger.error(f"Error creando el bloqueo de métricas en {self.directory}: {e}")
+            if not acquired:
+                # Sin bloqueo vivo, collect() daría el volcado por muerto y lo sumaría
+                # al acumulado en cada volcado: las métricas de este proceso no se publican
+                self._alive_lock = None
+                return
+            self._alive_lock = alive_lock
+            self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error volcando métricas: {e}")
+
+    def snapshot(self):
+        return {
+            name: {
+                'type': metric.kind,
+                'help': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(metric.buckets) if metric.kind == 'histogram' else None,
+                'series': metric.snapshot()
+            }
+            for name, metric in self._metrics.items()
+        }
+
+    def flush(self):
+        """Escribe el estado del proceso de forma atómica en METRICS_DIR/<pid>-<id>.json
+
+        No escribe nada si el proceso no tiene su bloqueo de vida.
+        """
+        self.ensure_flusher()
+        if self._alive_lock is None:
+            return
+        path = os.path.join(self.directory, f"{self._name}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pid': self._pid, 'metrics': self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _merge(merged, metrics, gauges=True):
+        for name, metric in metrics.items():
+            target = merged.setdefault(name, dict(metric, series={}))
+            for entry in metric['series']:
+                labels = tuple(entry[0])
+                if metric['type'] == 'histogram':
+                    counts, total = target['series'].get(labels, ([0] * len(entry[1]), 0.0))
+                    target['series'][labels] = ([a + b for a, b in zip(counts, entry[1])], total + entry[2])
+                elif gauges:
+                    target['series'][labels] = target['series'].get(labels, 0) + entry[1]
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def collect(self):
+        """Suma los volcados de todos los procesos
+
+        Los histogramas de procesos ya terminados pasan a TOMBSTONE_FILE para
+        que los contadores no retrocedan; los gauges solo cuentan en procesos vivos.
+        """
+        self.flush()
+        tombstone_path = os.path.join(self.directory, TOMBSTONE_FILE)
+        with FileLock(os.path.join(self.directory, COLLECT_LOCK)):
+            tombstone = self._read(tombstone_path) or {'metrics': {}}
+            merged = {}
+            dead = []
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json') or filename == TOMBSTONE_FILE:
+                    continue
+                path = os.path.join(self.directory, filename)
+                dump = self._read(path)
+                if dump is None:
+                    continue
+                lock_path = path[:-len('.json')] + '.lock'
+                if filename[:-len('.json')] == self._name or is_locked(lock_path):
+                    self._merge(merged, dump['metrics'])
+                else:
+                    dead.append((path, lock_path, dump))
+
+            if dead:
+                folded = {}
+                self._merge(folded, tombstone['metrics'], gauges=False)
+                for _, _, dump in dead:
+                    self._merge(folded, dump['metrics'], gauges=False)
+                tombstone = {'metrics': {
+                    name: dict(metric, series=[[list(labels), counts, total]
+                                               for labels, (counts, total) in metric['series'].items()])
+                    for name, metric in folded.items() if metric['type'] == 'histogram'
+                }}
+                tmp_path = f"{tombstone_path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(tombstone, f)
+                os.replace(tmp_path, tombstone_path)
+                # Solo se borran cuando su contenido ya está en la lápida
+                for path, lock_path, _ in dead:
+                    for stale in (path, lock_path):
+                        try:
+                            os.remove(stale)
+                        except FileNotFoundError:
+                            pass
+                logger.info(f"Métricas de {len(dead)} procesos terminados acumuladas en {TOMBSTONE_FILE}")
+
+            self._merge(merged, tombstone['metrics'], gauges=False)
+        if self._alive_lock is None:
+            # Sin volcado propio: lo de este proceso se suma desde memoria
+            self._merge(merged, self.snapshot())
+        return merged
+
+    def render(self):
+        """Métricas agregadas en el formato de texto de Prometheus"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labelnames = metric['labelnames']
+            if metric['type'] == 'histogram':
+                for labels, (counts, total) in sorted(metric['series'].items()):
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'], counts):
+                        cumulative += count
+                        le = f'le="{bound:.6g}"'
+                        lines.append(f"{name}_bucket{_labels(labelnames, labels, le)} {cumulative}")
+                    cumulative += counts[-1]
+                    lines.append(f"{name}_bucket{_labels(labelnames, labels, INF_LABEL)} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labelnames, labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labelnames, labels)} {cumulative}")
+            else:
+                if not metric['series'] and not labelnames:
+                    lines.append(f"{name} 0")
+                for labels, value in sorted(metric['series'].items()):
+                    lines.append(f"{name}{_labels(labelnames, labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds',
+    'Duración de las solicitudes HTTP',
+    ('endpoint', 'method', 'status')
+)
+REQUESTS_IN_FLIGHT = registry.gauge(
+    'http_requests_in_flight',
+    'Solicitudes HTTP en curso'
+)
+FUNCTION_LATENCY = registry.histogram(
+    'function_duration_seconds',
+    'Duración de las funciones medidas con performance_logger',
+    ('function',)
+)
+DB_LATENCY = registry.histogram(
+    'db_operation_duration_seconds',
+    'Duración de las operaciones medidas con db_logger',
+    ('operation', 'table')
+)
@@ -2,11 +2,21 @@
 Middleware para la aplicación web
 Proporciona funcionalidad para logging, monitoreo y seguridad
 """
+import os
 import time
+import zlib
+import gzip
+import hashlib
 import logging
+import threading
 from functools import wraps
-from flask import request, g, session
+from flask import request, g, session, current_app, render_template
+from flask_login import current_user
 from datetime import datetime
+from .metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, FUNCTION_LATENCY, DB_LATENCY
+from .profiling import profiling_middleware
+from .dbaudit import query_audit_middleware
+from .rundir import run_path, ensure_private_dir
 
 # Configurar logger para API
 logger = logging.getLogger('web')
@@ -18,6 +28,8 @@ def api_logger_middleware(app):
         # Guardar tiempo de inicio para calcular duración
         g.start_time = time.time()
         g.request_id = f"{int(time.time())}-{id(request)}"
+        g.in_flight = True
+        REQUESTS_IN_FLIGHT.inc()
         
         logger.info(f"Inicio de solicitud: {request.method} {request.path}")
         
@@ -29,6 +41,7 @@ def api_logger_middleware(app):
         # Calcular tiempo de respuesta
         duration = time.time() - g.start_time
         status_code = response.status_code
+        REQUEST_LATENCY.observe(duration, request.endpoint or 'unknown', request.method, str(status_code))
         
         # Obtener ID del usuario si está autenticado
         user_id = session.get('user_id', None) if session else None
@@ -62,6 +75,12 @@ def api_logger_middleware(app):
         
         return response
 
+    @app.teardown_request
+    def teardown_request(exc):
+        # Se ejecuta también cuando la vista lanza una excepción
+        if g.pop('in_flight', False):
+            REQUESTS_IN_FLIGHT.dec()
+
 def performance_logger(endpoint_name=None):
     """Decorador para medir y registrar el rendimiento de funciones específicas"""
     def decorator(f):
@@ -72,6 +91,7 @@ def performance_logger(endpoint_name=None):
             start_time = time.time()
             result = f(*args, **kwargs)
             duration = time.time() - start_time
+            FUNCTION_LATENCY.observe(duration, function_name)
             
             # Registrar tiempo de ejecución
             perf_logger = logging.getLogger('performance')
@@ -108,8 +128,9 @@ def db_logger(operation=None, table=None):
                 db_table = args[0].__tablename__
             elif not db_table and len(args) > 0 and hasattr(args[0], '__class__') and hasattr(args[0].__class__, '__tablename__'):
                 db_table = args[0].__class__.__tablename__
-            else:
+            elif not db_table:
                 db_table = "unknown_table"
+            DB_LATENCY.observe(duration, op, db_table)
             
             # Registrar operación
             db_logger = logging.getLogger('database')
@@ -137,10 +158,165 @@ def db_logger(operation=None, table=None):
         return decorated_function
     return decorator
 
+# Tamaño mínimo (bytes) a partir del cual se comprime la respuesta
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+# Segundos que una respuesta cacheada sigue siendo válida por defecto
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 5))
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+# Fichero cuya fecha de modificación vacía la caché de todos los workers
+RESPONSE_CACHE_STAMP = os.environ.get(
+    'RESPONSE_CACHE_STAMP', run_path('response_cache.stamp')
+)
+
+# Vistas a las que se aplica la capa de ETag y compresión: las APIs de estadísticas
+RESPONSE_LAYER_ENDPOINTS = frozenset({'get_stats', 'get_bot_stats_api', 'get_ai_stats_api'})
+
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+_response_cache_stamp = None
+
+def _accepted_encoding():
+    """Codificación preferida que acepta el cliente (gzip antes que deflate)"""
+    accept = request.accept_encodings
+    for encoding in ('gzip', 'deflate'):
+        if accept[encoding]:
+            return encoding
+    return None
+
+def _compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(data, COMPRESS_LEVEL)
+
+def response_layer_middleware(app, min_size=COMPRESS_MIN_SIZE, endpoints=RESPONSE_LAYER_ENDPOINTS):
+    """ETag por contenido, respuestas 304 y compresión gzip/deflate
+
+    Solo actúa sobre las vistas de endpoints y en respuestas GET 200
+    completas (no en streaming) que no traigan ya su propia ETag.
+    """
+    @app.after_request
+    def apply_response_layer(response):
+        if request.endpoint not in endpoints:
+            return response
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return response
+        if response.is_streamed or response.direct_passthrough:
+            return response
+        if response.headers.get('ETag') or response.headers.get('Content-Encoding'):
+            return response
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        data = response.get_data()
+        encoding = _accepted_encoding() if len(data) >= min_size else None
+
+        # La ETag identifica también la codificación, porque el cuerpo cambia
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        if encoding:
+            etag = f"{etag}-{encoding}"
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            response.set_data(b'')
+            response.headers.pop('Content-Length', None)
+            return response
+
+        if encoding:
+            response.set_data(_compress(data, encoding))
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+def cached_response(ttl=RESPONSE_CACHE_TTL):
+    """Decorador que guarda la respuesta por usuario y URL durante ttl segundos
+
+    Debe ir debajo de login_required para que solo se cacheen respuestas
+    de usuarios autenticados. Solo se guardan las respuestas 200.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            global _response_cache_stamp
+            user_id = current_user.get_id() if current_user.is_authenticated else None
+            key = (user_id, request.endpoint, request.full_path)
+            now = time.monotonic()
+
+            stamp = _read_cache_stamp()
+            with _response_cache_lock:
+                if stamp != _response_cache_stamp:
+                    # Otro worker vació la caché
+                    _response_cache.clear()
+                    _response_cache_stamp = stamp
+                entry = _response_cache.get(key)
+            if entry and entry[0] > now:
+                _, body, status, headers = entry
+                return current_app.response_class(body, status=status, headers=headers)
+
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                entry = (now + ttl, response.get_data(), response.status_code, list(response.headers.items()))
+                with _response_cache_lock:
+                    if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+                        for stale in [k for k, v in _response_cache.items() if v[0] <= now]:
+                            del _response_cache[stale]
+                        if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+                            _response_cache.pop(next(iter(_response_cache)))
+                    _response_cache[key] = entry
+            return response
+        return decorated_function
+    return decorator
+
+def _read_cache_stamp():
+    try:
+        return os.stat(RESPONSE_CACHE_STAMP).st_mtime_ns
+    except OSError:
+        return None
+
+def clear_response_cache():
+    """Vacía la caché de respuestas de todos los workers (p. ej. tras modificar datos)
+
+    Este proceso la vacía en el acto; los demás, en su siguiente consulta a
+    la caché, al ver que RESPONSE_CACHE_STAMP ha cambiado.
+    """
+    try:
+        ensure_private_dir(os.path.dirname(RESPONSE_CACHE_STAMP) or '.')
+        with open(RESPONSE_CACHE_STAMP, 'a'):
+            pass
+        os.utime(RESPONSE_CACHE_STAMP, None)
+    except OSError as e:
+        logger.error(f"No se pudo marcar la caché de respuestas como vacía: {e}")
+    global _response_cache_stamp
+    with _response_cache_lock:
+        _response_cache.clear()
+        _response_cache_stamp = _read_cache_stamp()
+
+def admin_required(f):
+    """Decorador que limita una vista a administradores (usar debajo de login_required)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not getattr(current_user, 'is_admin', False):
+            logger.warning(f"Acceso denegado a {request.path} para {current_user.get_id()}")
+            return render_template('error.html', error="Acceso restringido a administradores"), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 def setup_middleware(app):
     """Configura todos los middleware necesarios para la aplicación"""
     # Registrar middleware de logging
     api_logger_middleware(app)
+
+    # ETag, 304 y compresión de respuestas
+    response_layer_middleware(app)
+
+    # Perfilado bajo demanda (?_profile=) y por muestreo (PROFILE_SAMPLE)
+    profiling_middleware(app)
+
+    # Consultas SQL por solicitud, N+1 y consultas lentas
+    query_audit_middleware(app)
     
     # Configurar otras métricas y middleware si es necesario
     logger.info("Middleware configurado exitosamente")
\ No newline at end of file
@@ -0,0 +1,602 @@
+"""
+Snapshots binarios y versionados del índice TF-IDF de patrones
+Cada versión es un directorio con arrays .npy (vocabulario, matriz CSR,
+metadatos por patrón e índice invertido) y un header.json con el formato y la
+versión. Los workers los abren con mmap, así que todos los procesos comparten
+las mismas páginas físicas en lugar de construir cada uno su copia.
+
+Las versiones se publican escribiendo en un directorio temporal que se
+renombra de forma atómica y actualizando después el puntero CURRENT; los
+workers ven el cambio en su siguiente sincronización y cambian de índice.
+
+    python -m web.modelstore publish
+    python -m web.modelstore info
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import shutil
+import logging
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime
+import numpy as np
+from .tfidf import Match, BATCH_MAX_PRODUCTS, tokenize, _tf_weight
+from .postings import PostingsSnapshot, expand_ranges, top_k_per_row
+from .filelock import FileLock
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+# Directorio de los snapshots ('' los desactiva: cada worker construye su índice en memoria)
+MODEL_DIR = os.environ.get('AI_MODEL_DIR', run_path('model'))
+# Versiones que se conservan en disco (los workers pueden seguir leyendo una anterior)
+MODEL_KEEP = int(os.environ.get('AI_MODEL_KEEP', 3))
+# Cambios sobre el snapshot (altas, modificaciones y borrados) antes de publicar uno nuevo
+OVERLAY_MAX = int(os.environ.get('AI_MODEL_OVERLAY_MAX', 5000))
+
+FORMAT = 'lba-tfidf'
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = 'publish.lock'
+
+_VERSION_RE = re.compile(r'^v(\d+)$')
+
+# Arrays de cada versión y su tipo
+_ARRAYS = {
+    # Vocabulario: tabla de cadenas y tabla hash (crc32, sondeo lineal) término -> id
+    'term_offsets': np.int64,
+    'term_bytes': np.uint8,
+    'term_hash': np.int32,
+    'df': np.int32,
+    'idf': np.float32,
+    # Matriz CSR patrones x términos; weights ya normalizado por fila
+    'indptr': np.int64,
+    'indices': np.int32,
+    'tf': np.float32,
+    'weights': np.float32,
+    # Metadatos por patrón, ordenados por id (búsqueda binaria)
+    'ids': np.int64,
+    'confidence': np.float64,
+    'pattern_offsets': np.int64,
+    'pattern_bytes': np.uint8,
+    'response_offsets': np.int64,
+    'response_bytes': np.uint8,
+    'response_null': np.bool_,
+    # Índice invertido (ver PostingsSnapshot)
+    'ptr': np.int64,
+    'weight_slots': np.int32,
+    'weight_values': np.float32,
+    'slot_slots': np.int32,
+    'slot_values': np.float32,
+    'max_weight': np.float32
+}
+
+class SnapshotError(Exception):
+    """Snapshot ilegible o de un formato no soportado"""
+
+def _term_hash(data):
+    return zlib.crc32(data)
+
+def _string_table(values):
+    """(offsets, bytes) de una lista de cadenas codificadas en utf-8"""
+    encoded = [(value or '').encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8), encoded
+
+def _hash_table(encoded):
+    """Tabla hash de direccionamiento abierto con el id de cada término (-1 = vacío)"""
+    size = 8
+    while size < 2 * len(encoded):
+        size *= 2
+    mask = size - 1
+    table = [-1] * size
+    for term_id, data in enumerate(encoded):
+        position = _term_hash(data) & mask
+        while table[position] != -1:
+            position = (position + 1) & mask
+        table[position] = term_id
+    return np.array(table, dtype=np.int32)
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_snapshot(index, path, version, change_id):
+    """Escribe el índice como snapshot en path (que no debe existir) y devuelve el header"""
+    data = index.arrays()
+    ids = np.array(data['ids'], dtype=np.int64)
+    n_patterns, n_terms = len(ids), len(data['terms'])
+
+    # Los patrones se ordenan por id para encontrarlos con búsqueda binaria
+    order = np.argsort(ids, kind='stable')
+    lengths = data['lengths'][order].astype(np.int64)
+    entries = expand_ranges(data['starts'][order], lengths)
+    indptr = np.zeros(n_patterns + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(lengths)
+    indices = data['cols'][entries]
+    weights = data['weights'][entries]
+    postings = PostingsSnapshot(np.repeat(np.arange(n_patterns), lengths), indices, weights, n_patterns, n_terms)
+
+    payload = [data['payload'][slot] for slot in order]
+    term_offsets, term_bytes, encoded_terms = _string_table(data['terms'])
+    pattern_offsets, pattern_bytes, _ = _string_table([pattern for pattern, _, _ in payload])
+    response_offsets, response_bytes, _ = _string_table([response for _, response, _ in payload])
+
+    arrays = {
+        'term_offsets': term_offsets,
+        'term_bytes': term_bytes,
+        'term_hash': _hash_table(encoded_terms),
+        'df': data['df'],
+        'idf': data['idf'],
+        'indptr': indptr,
+        'indices': indices,
+        'tf': data['tf'][entries],
+        'weights': weights,
+        'ids': ids[order],
+        'confidence': np.array(
+            [np.nan if confidence is None else confidence for _, _, confidence in payload], dtype=np.float64
+        ),
+        'pattern_offsets': pattern_offsets,
+        'pattern_bytes': pattern_bytes,
+        'response_offsets': response_offsets,
+        'response_bytes': response_bytes,
+        'response_null': np.array([response is None for _, response, _ in payload], dtype=np.bool_)
+    }
+    arrays.update(postings.arrays())
+
+    os.makedirs(path)
+    files = {}
+    for name, dtype in _ARRAYS.items():
+        array = np.ascontiguousarray(arrays[name], dtype=dtype)
+        with open(os.path.join(path, f"{name}.npy"), 'wb') as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+        files[name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    header = {
+        'format': FORMAT,
+        'format_version': FORMAT_VERSION,
+        'version': version,
+        'change_id': change_id,
+        'created_at': datetime.now().isoformat(),
+        'patterns': n_patterns,
+        'terms': n_terms,
+        'nnz': int(indptr[-1]),
+        'files': files
+    }
+    with open(os.path.join(path, HEADER_FILE), 'w', encoding='utf-8') as f:
+        json.dump(header, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_dir(path)
+    return header
+
+class StringTable:
+    """Cadenas utf-8 consecutivas en un buffer con sus offsets (mapeados de disco)"""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+class MappedModel:
+    """Una versión del snapshot abierta con mmap y validada contra su header"""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, HEADER_FILE), encoding='utf-8') as f:
+                self.header = json.load(f)
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f"Header ilegible en {path}: {e}")
+        if self.header.get('format') != FORMAT or self.header.get('format_version') != FORMAT_VERSION:
+            raise SnapshotError(
+                f"Formato no soportado en {path}: "
+                f"{self.header.get('format')} v{self.header.get('format_version')}"
+            )
+
+        self.arrays = {}
+        for name, dtype in _ARRAYS.items():
+            spec = self.header['files'].get(name)
+            if spec is None:
+                raise SnapshotError(f"Falta {name} en {path}")
+            file_path = os.path.join(path, f"{name}.npy")
+            # mmap no admite regiones vacías
+            array = np.load(file_path, mmap_mode='r' if math.prod(spec['shape']) else None)
+            if array.dtype != np.dtype(dtype) or list(array.shape) != spec['shape']:
+                raise SnapshotError(f"{name} no coincide con el header en {path}")
+            self.arrays[name] = array
+
+        self.version = self.header['version']
+        self.change_id = self.header['change_id']
+        self.n_patterns = self.header['patterns']
+        self.terms = StringTable(self.arrays['term_offsets'], self.arrays['term_bytes'])
+        self.patterns = StringTable(self.arrays['pattern_offsets'], self.arrays['pattern_bytes'])
+        self.responses = StringTable(self.arrays['response_offsets'], self.arrays['response_bytes'])
+        self.postings = PostingsSnapshot.from_arrays(self.arrays, self.n_patterns, self.header['nnz'])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def term_id(self, term):
+        """Id de un término o -1 si no está en el vocabulario"""
+        table = self.arrays['term_hash']
+        data = term.encode('utf-8')
+        mask = len(table) - 1
+        position = _term_hash(data) & mask
+        while True:
+            term_id = int(table[position])
+            if term_id < 0:
+                return -1
+            if self.terms.raw(term_id) == data:
+                return term_id
+            position = (position + 1) & mask
+
+    def slot(self, pattern_id):
+        """Posición de un patrón en el snapshot o None"""
+        ids = self.arrays['ids']
+        try:
+            pattern_id = int(pattern_id)
+        except (TypeError, ValueError):
+            return None
+        slot = int(np.searchsorted(ids, pattern_id))
+        if slot < len(ids) and ids[slot] == pattern_id:
+            return slot
+        return None
+
+    def payload(self, slot):
+        confidence = float(self.arrays['confidence'][slot])
+        response = None if self.arrays['response_null'][slot] else self.responses[slot]
+        return self.patterns[slot], response, None if math.isnan(confidence) else confidence
+
+class SnapshotIndex:
+    """Índice de solo lectura sobre un MappedModel con los cambios posteriores en memoria
+
+    Misma interfaz que TfidfIndex. Los borrados se marcan en una máscara propia
+    del proceso y las altas o modificaciones van a un índice pequeño en memoria
+    (overlay) puntuado con el IDF del snapshot; los términos que el snapshot no
+    conoce reciben el IDF de un término con un solo documento. Cuando el overlay
+    crece más de OVERLAY_MAX conviene publicar un snapshot nuevo.
+    """
+
+    def __init__(self, model):
+        self._lock = threading.RLock()
+        self.model = model
+        self.version = model.version
+        self.change_id = model.change_id
+        self._alive = np.ones(model.n_patterns, dtype=np.bool_)
+        self._removed = 0
+        self._overlay = {}
+        self._overlay_postings = {}
+
+    def __len__(self):
+        return self.model.n_patterns - self._removed + len(self._overlay)
+
+    def __contains__(self, pattern_id):
+        if pattern_id in self._overlay:
+            return True
+        slot = self.model.slot(pattern_id)
+        return slot is not None and bool(self._alive[slot])
+
+    @property
+    def vocabulary_size(self):
+        return len(self.model.terms)
+
+    @property
+    def needs_rebuild(self):
+        return len(self._overlay) + self._removed > OVERLAY_MAX
+
+    def _idf(self, term_id):
+        if term_id >= 0:
+            return float(self.model.arrays['idf'][term_id])
+        # Término que solo aparece en el overlay: IDF de df = 1
+        return math.log((1.0 + len(self)) / 2.0) + 1.0
+
+    def _vector(self, counts, overlay_only):
+        """Vector normalizado {término: (id en el snapshot, peso)}
+
+        overlay_only: incluir los términos desconocidos solo si aparecen en el overlay
+        """
+        vector = {}
+        for term, count in counts.items():
+            term_id = self.model.term_id(term)
+            if term_id < 0 and overlay_only and term not in self._overlay_postings:
+                continue
+            vector[term] = (term_id, _tf_weight(count) * self._idf(term_id))
+        norm = math.sqrt(sum(weight * weight for _, weight in vector.values()))
+        if norm > 0:
+            vector = {term: (term_id, weight / norm) for term, (term_id, weight) in vector.items()}
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._alive[:] = False
+            self._removed = self.model.n_patterns
+            self._overlay = {}
+            self._overlay_postings = {}
+
+    def _remove(self, pattern_id):
+        entry = self._overlay.pop(pattern_id, None)
+        if entry is not None:
+            for term in entry[0]:
+                postings = self._overlay_postings[term]
+                del postings[pattern_id]
+                if not postings:
+                    del self._overlay_postings[term]
+            return True
+        slot = self.model.slot(pattern_id)
+        if slot is not None and self._alive[slot]:
+            self._alive[slot] = False
+            self._removed += 1
+            return True
+        return False
+
+    def add(self, pattern_id, pattern, response=None, confidence=None, counts=None):
+        """Añade o reemplaza un patrón en el overlay"""
+        with self._lock:
+            entry = self._overlay.get(pattern_id)
+            if entry is not None and entry[1] == (pattern, response, confidence):
+                return
+            slot = self.model.slot(pattern_id)
+            if entry is None and slot is not None and self._alive[slot] \
+                    and self.model.payload(slot) == (pattern, response, confidence):
+                return
+            self._remove(pattern_id)
+
+            if counts is None:
+                counts = Counter(tokenize(pattern))
+            vector = {term: weight for term, (_, weight) in self._vector(counts, overlay_only=False).items()}
+            self._overlay[pattern_id] = (vector, (pattern, response, confidence))
+            for term, weight in vector.items():
+                self._overlay_postings.setdefault(term, {})[pattern_id] = weight
+
+    def update(self, pattern_id, pattern, response=None, confidence=None):
+        self.add(pattern_id, pattern, response, confidence)
+
+    def delete(self, pattern_id):
+        with self._lock:
+            return self._remove(pattern_id)
+
+    def _overlay_matches(self, vector, min_score):
+        scores = Counter()
+        for term, (_, weight) in vector.items():
+            for pattern_id, value in self._overlay_postings.get(term, {}).items():
+                scores[pattern_id] += weight * value
+        return [
+            Match(pattern_id, *self._overlay[pattern_id][1], score)
+            for pattern_id, score in scores.items() if score >= min_score and score > 0
+        ]
+
+    def _base_match(self, slot, score):
+        return Match(int(self.model.arrays['ids'][slot]), *self.model.payload(slot), float(score))
+
+    @staticmethod
+    def _top(matches, k):
+        matches.sort(key=lambda match: -match.score)
+        return matches[:k]
+
+    def search(self, text, k=5, min_score=0.0):
+        """Los k patrones más similares al texto, de mayor a menor puntuación"""
+        k = max(int(k), 1)
+        with self._lock:
+            vector = self._vector(Counter(tokenize(text)), overlay_only=True)
+            if not vector:
+                return []
+            known = [(term_id, weight) for term_id, weight in vector.values() if term_id >= 0]
+            matches = self._overlay_matches(vector, min_score)
+            if known:
+                term_ids = np.array([term_id for term_id, _ in known], dtype=np.int32)
+                query = np.array([weight for _, weight in known], dtype=np.float32)
+                slots, scores = self.model.postings.candidates(term_ids, query, min_score, self._alive)
+                keep = scores > 0
+                slots, scores = slots[keep], scores[keep]
+                if len(slots) > k:
+                    top = np.argpartition(-scores, k - 1)[:k]
+                    slots, scores = slots[top], scores[top]
+                matches += [self._base_match(slot, score) for slot, score in zip(slots, scores)]
+            return self._top(matches, k)
+
+    def search_batch(self, texts, k=5, min_score=0.0):
+        """search() para varios textos con un solo producto disperso contra el snapshot"""
+        k = max(int(k), 1)
+        texts = list(texts)
+        results = [[] for _ in texts]
+        with self._lock:
+            rows, cols, values = [], [], []
+            for row, text in enumerate(texts):
+                vector = self._vector(Counter(tokenize(text)), overlay_only=True)
+                if self._overlay:
+                    results[row] = self._overlay_matches(vector, min_score)
+                for term_id, weight in vector.values():
+                    if term_id >= 0:
+                        rows.append(row)
+                        cols.append(term_id)
+                        values.append(weight)
+
+            q_rows = np.array(rows, dtype=np.int64)
+            q_cols = np.array(cols, dtype=np.int32)
+            q_values = np.array(values, dtype=np.float32)
+            snapshot = self.model.postings
+            for first, last in snapshot.batch_chunks(q_rows, q_cols, len(texts), BATCH_MAX_PRODUCTS):
+                chunk = (q_rows[first:last], q_cols[first:last], q_values[first:last])
+                products = snapshot.products(*chunk, min_score, self._alive)
+                top = top_k_per_row(snapshot, *products, snapshot.n_slots, k, min_score)
+                for row, slot, score in zip(*top):
+                    results[row].append(self._base_match(slot, score))
+        return [self._top(matches, k) for matches in results]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'patterns': len(self),
+                'terms': len(self.model.terms),
+                'nnz': self.model.header['nnz'],
+                'version': self.version,
+                'overlay_patterns': len(self._overlay),
+                'removed_patterns': self._removed,
+                'mapped_bytes': self.model.nbytes
+            }
+
+class ModelStore:
+    """Directorio de versiones del snapshot y su puntero CURRENT"""
+
+    def __init__(self, directory=MODEL_DIR, keep=MODEL_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def versions(self):
+        """Versiones publicadas en disco, de menor a mayor"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(int(match.group(1)) for match in map(_VERSION_RE.match, names) if match)
+
+    def current_version(self):
+        """Versión a la que apunta CURRENT (0 si no hay ninguna); solo lee un fichero pequeño"""
+        try:
+            with open(self._path(CURRENT_FILE)) as f:
+                match = _VERSION_RE.match(f.read().strip())
+        except OSError:
+            return 0
+        return int(match.group(1)) if match else 0
+
+    def publish(self, index, change_id):
+        """Escribe el índice como versión nueva y mueve CURRENT a ella
+
+        Devuelve la versión publicada, o None si otro proceso está publicando.
+        """
+        return self.rebuild(lambda: (index, change_id))
+
+    def rebuild(self, build):
+        """Como publish(), pero build() -> (índice, change_id) solo se llama si este
+        proceso consigue el bloqueo de publicación
+        """
+        if not self.enabled:
+            return None
+        ensure_private_dir(self.directory)
+        lock = FileLock(self._path(LOCK_FILE))
+        if not lock.acquire(blocking=False):
+            return None
+        try:
+            index, change_id = build()
+            start_time = time.time()
+            version = max(self.versions() + [self.current_version()]) + 1
+            tmp_path = self._path(f".tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+            try:
+                header = write_snapshot(index, tmp_path, version, change_id)
+                # El directorio completo aparece de una vez con su nombre definitivo
+                os.rename(tmp_path, self._path(f"v{version:06d}"))
+            except Exception:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+            current_tmp = self._path(f"{CURRENT_FILE}.{os.getpid()}.tmp")
+            with open(current_tmp, 'w') as f:
+                f.write(f"v{version:06d}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(current_tmp, self._path(CURRENT_FILE))
+            _fsync_dir(self.directory)
+            self.prune()
+        finally:
+            lock.release()
+
+        logger.info(
+            f"Snapshot del modelo v{version} publicado: {header['patterns']} patrones, "
+            f"{header['nnz']} entradas en {time.time() - start_time:.4f}s"
+        )
+        return version
+
+    def prune(self):
+        """Borra las versiones más antiguas que las últimas self.keep y los
+        directorios .tmp-* que dejó una publicación interrumpida
+
+        Se llama con el bloqueo de publicación, así que ningún .tmp-* está en uso.
+        Los procesos que aún tengan mapeada una versión borrada siguen leyéndola
+        hasta que cambien de índice.
+        """
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-'):
+                shutil.rmtree(self._path(name), ignore_errors=True)
+        current = self.current_version()
+        for version in self.versions()[:-self.keep or None]:
+            if version != current:
+                shutil.rmtree(self._path(f"v{version:06d}"), ignore_errors=True)
+
+    def load(self, version=None):
+        """SnapshotIndex de una versión (la actual por defecto) o None si no hay ninguna válida"""
+        if not self.enabled:
+            return None
+        version = version or self.current_version()
+        if not version:
+            return None
+        try:
+            return SnapshotIndex(MappedModel(self._path(f"v{version:06d}")))
+        except (SnapshotError, OSError, ValueError) as e:
+            logger.error(f"No se pudo cargar el snapshot del modelo v{version}: {e}")
+            return None
+
+model_store = ModelStore()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshots del índice TF-IDF de patrones")
+    parser.add_argument('command', choices=['publish', 'info'])
+    args = parser.parse_args(argv)
+
+    if not model_store.enabled:
+        print("AI_MODEL_DIR está vacío: snapshots desactivados")
+        return 1
+
+    if args.command == 'publish':
+        from .ai_engine import ai_engine
+        version = model_store.rebuild(ai_engine.build_index)
+        if version is None:
+            print("Otro proceso está publicando un snapshot")
+            return 1
+        print(f"Publicada la versión {version} en {model_store.directory}")
+        return 0
+
+    index = model_store.load()
+    if index is None:
+        print(f"No hay snapshots en {model_store.directory}")
+        return 1
+    print(json.dumps(dict(index.model.header, files=sorted(index.model.header['files'])), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Consulta paginada de patrones de IA
+Paginación por clave (keyset) con filtros y proyección de columnas
+"""
+import json
+import base64
+import logging
+from datetime import datetime
+from sqlalchemy import or_, and_, desc, func, literal_column
+
+logger = logging.getLogger('web')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+SORTS = ('uses', 'confidence', 'created_at')
+
+# Valor con el que se ordenan los NULL: menor que cualquier valor real, así quedan al final
+NULL_SENTINELS = {
+    'uses': '-1',
+    'confidence': '-1',
+    'created_at': "'1970-01-01 00:00:00.000000'"
+}
+
+LIKE_ESCAPE = '\\'
+
+def sort_expression(sort):
+    """coalesce(columna, centinela): la misma expresión que indexa ix_ai_patterns_<sort>_keyset"""
+    from shared.database import AIPattern
+    return func.coalesce(getattr(AIPattern, sort), literal_column(NULL_SENTINELS[sort]))
+
+def escape_like(text):
+    """Escapa los comodines de LIKE para buscar el texto literal"""
+    return text.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace('%', LIKE_ESCAPE + '%').replace('_', LIKE_ESCAPE + '_')
+
+def encode_cursor(value, pattern_id):
+    """Codifica la posición (valor de orden, id) como cursor opaco"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, pattern_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor, sort):
+    """Decodifica un cursor generado por encode_cursor"""
+    try:
+        value, pattern_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if sort == 'created_at':
+            value = datetime.fromisoformat(value)
+        return value, int(pattern_id)
+    except Exception:
+        raise ValueError("Cursor no válido")
+
+def query_patterns(db, after=None, limit=DEFAULT_LIMIT, q=None, sort='uses',
+                   min_confidence=None, max_confidence=None):
+    """Devuelve una página de patrones ordenada por sort (desc) e id (desc)"""
+    from shared.database import AIPattern
+
+    if sort not in SORTS:
+        raise ValueError(f"Orden no válido: {sort}")
+    limit = max(1, min(int(limit), MAX_LIMIT))
+
+    # Con coalesce los NULL no rompen la comparación del cursor; la expresión
+    # coincide con la de los índices ix_ai_patterns_<sort>_keyset
+    sort_col = sort_expression(sort)
+    query = db.query(
+        AIPattern.id,
+        AIPattern.pattern,
+        AIPattern.response,
+        AIPattern.confidence,
+        AIPattern.uses,
+        AIPattern.created_at,
+        sort_col.label('sort_key')
+    )
+
+    if q:
+        like = f"%{escape_like(q)}%"
+        query = query.filter(or_(
+            AIPattern.pattern.ilike(like, escape=LIKE_ESCAPE),
+            AIPattern.response.ilike(like, escape=LIKE_ESCAPE)
+        ))
+    if min_confidence is not None:
+        query = query.filter(AIPattern.confidence >= min_confidence)
+    if max_confidence is not None:
+        query = query.filter(AIPattern.confidence <= max_confidence)
+
+    if after:
+        value, last_id = decode_cursor(after, sort)
+        query = query.filter(or_(
+            sort_col < value,
+            and_(sort_col == value, AIPattern.id < last_id)
+        ))
+
+    rows = query.order_by(desc(sort_col), desc(AIPattern.id)).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1].sort_key, rows[-1].id) if has_more and rows else None
+
+    return {
+        'items': [{
+            'id': row.id,
+            'pattern': row.pattern,
+            'response': row.response,
+            'confidence': row.confidence,
+            'uses': row.uses,
+            'created_at': row.created_at.isoformat() if row.created_at else None
+        } for row in rows],
+        'next_cursor': next_cursor
+    }
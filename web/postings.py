@@ -0,0 +1,305 @@
+"""
+Índice invertido de patrones para búsquedas sublineales
+Instantánea de las entradas de TfidfIndex agrupadas por término, con dos
+órdenes por término: por peso ascendente (para recortar las listas con las
+cotas de MaxScore) y por fila (para completar la puntuación de los candidatos).
+
+Solo acelera el índice TF-IDF del panel (ai_engine.match() y
+/api/ai/respond_batch). Las respuestas del bot las sigue eligiendo SimpleAI
+(bot/ai_module) con su propio recorrido de patrones, que esta poda no toca.
+
+Benchmark contra la puntuación exhaustiva sobre un corpus sintético:
+
+    python -m web.postings --patterns 1000000 --queries 200
+"""
+import sys
+import time
+import argparse
+import numpy as np
+
+# Margen para que el redondeo de float32 no descarte candidatos en el umbral
+_EPSILON = 1e-6
+
+def expand_ranges(starts, lengths):
+    """Concatena los rangos [start, start + length) como un solo array de índices"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.asarray(starts, dtype=np.int64) - (np.cumsum(lengths) - lengths)
+    return np.repeat(offsets, lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+
+class PostingsSnapshot:
+    """Listas de postings por término construidas a partir de arrays COO"""
+
+    def __init__(self, rows, cols, weights, n_slots, n_terms):
+        self.n_slots = n_slots
+        self.n_terms = n_terms
+        # Las entradas añadidas después (filas >= n_slots) se puntúan aparte
+        self.nnz = len(rows)
+
+        live = weights > 0
+        rows, cols, weights = rows[live], cols[live], weights[live]
+
+        counts = np.bincount(cols, minlength=n_terms)
+        self.ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.ptr[1:])
+
+        by_weight = np.lexsort((weights, cols))
+        self.weight_slots = rows[by_weight]
+        self.weight_values = weights[by_weight]
+
+        by_slot = np.lexsort((rows, cols))
+        self.slot_slots = rows[by_slot]
+        self.slot_values = weights[by_slot]
+
+        self.max_weight = np.zeros(n_terms, dtype=np.float32)
+        nonempty = counts > 0
+        self.max_weight[nonempty] = self.weight_values[self.ptr[1:][nonempty] - 1]
+
+    @classmethod
+    def from_arrays(cls, arrays, n_slots, nnz):
+        """Instantánea sobre arrays ya construidos (por ejemplo, mapeados de disco)"""
+        snapshot = cls.__new__(cls)
+        snapshot.n_slots = n_slots
+        snapshot.nnz = nnz
+        snapshot.ptr = arrays['ptr']
+        snapshot.n_terms = len(snapshot.ptr) - 1
+        snapshot.weight_slots = arrays['weight_slots']
+        snapshot.weight_values = arrays['weight_values']
+        snapshot.slot_slots = arrays['slot_slots']
+        snapshot.slot_values = arrays['slot_values']
+        snapshot.max_weight = arrays['max_weight']
+        return snapshot
+
+    def arrays(self):
+        return {
+            'ptr': self.ptr,
+            'weight_slots': self.weight_slots,
+            'weight_values': self.weight_values,
+            'slot_slots': self.slot_slots,
+            'slot_values': self.slot_values,
+            'max_weight': self.max_weight
+        }
+
+    def truncated_start(self, term_id, min_weight):
+        """Primera posición de la lista de term_id con peso >= min_weight"""
+        start, end = self.ptr[term_id], self.ptr[term_id + 1]
+        # weight_values es ascendente dentro del término: los pesos altos quedan al final
+        return start + np.searchsorted(self.weight_values[start:end], min_weight, side='left')
+
+    def candidates(self, term_ids, query, threshold, alive):
+        """Filas con puntuación >= threshold y sus puntuaciones exactas
+
+        MaxScore: los términos cuya cota superior conjunta no alcanza el umbral
+        no generan candidatos; en el resto, cada lista se recorta al peso mínimo
+        con el que una fila aún podría llegar al umbral.
+        """
+        known = term_ids < self.n_terms
+        term_ids, query = term_ids[known], query[known]
+        if not len(term_ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        bounds = query * self.max_weight[term_ids]
+        total = float(bounds.sum())
+        threshold = threshold - _EPSILON
+        if total < threshold:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        order = np.argsort(bounds)
+        non_essential = np.cumsum(bounds[order]) < threshold
+        essential = order[~non_essential]
+
+        pieces = []
+        for position in essential:
+            term_id = term_ids[position]
+            start, end = self.ptr[term_id], self.ptr[term_id + 1]
+            min_weight = (threshold - (total - bounds[position])) / query[position]
+            if min_weight > 0:
+                start = self.truncated_start(term_id, min_weight)
+            pieces.append(self.weight_slots[start:end])
+
+        slots = np.unique(np.concatenate(pieces)) if pieces else np.zeros(0, dtype=np.int32)
+        slots = slots[alive[slots]]
+        scores = np.zeros(len(slots), dtype=np.float64)
+        if not len(slots):
+            return slots, scores
+
+        for term_id, weight in zip(term_ids, query):
+            start, end = self.ptr[term_id], self.ptr[term_id + 1]
+            if start == end:
+                continue
+            segment = self.slot_slots[start:end]
+            positions = np.searchsorted(segment, slots)
+            positions[positions == len(segment)] = 0
+            hit = segment[positions] == slots
+            scores[hit] += weight * self.slot_values[start + positions[hit]]
+
+        keep = scores >= threshold
+        return slots[keep], scores[keep]
+
+    def products(self, q_rows, q_cols, q_values, min_score, alive):
+        """Productos consulta x posting de una matriz de consultas, recortados con MaxScore
+
+        Devuelve (filas, slots, valores) de las entradas esenciales y, aparte,
+        las entradas no esenciales (cuya cota conjunta no alcanza min_score):
+        esas no generan candidatos y solo completan la puntuación de los que
+        ya existen (ver complete()).
+        """
+        known = q_cols < self.n_terms
+        q_rows, q_cols, q_values = q_rows[known], q_cols[known], q_values[known]
+        starts = self.ptr[q_cols]
+        lengths = self.ptr[q_cols + 1] - starts
+        essential = np.ones(len(q_cols), dtype=np.bool_)
+
+        if min_score > 0 and len(q_cols):
+            threshold = min_score - _EPSILON
+            bounds = q_values * self.max_weight[q_cols]
+            totals = np.bincount(q_rows, weights=bounds)
+
+            # Por consulta, las entradas de menor cota cuya suma no llega al umbral
+            order = np.lexsort((bounds, q_rows))
+            cumulative = np.cumsum(bounds[order])
+            row_first = np.searchsorted(q_rows[order], q_rows[order], side='left')
+            row_offset = np.concatenate(([0.0], cumulative))[row_first]
+            essential[order] = cumulative - row_offset >= threshold
+
+            # Peso mínimo con el que una fila aún podría alcanzar el umbral
+            min_weights = (threshold - (totals[q_rows] - bounds)) / q_values
+            for entry in np.flatnonzero(essential & (min_weights > 0)):
+                start = self.truncated_start(q_cols[entry], min_weights[entry])
+                lengths[entry] -= start - starts[entry]
+                starts[entry] = start
+
+        lookups = (q_rows[~essential], q_cols[~essential], q_values[~essential])
+        q_rows, starts, lengths, q_values = q_rows[essential], starts[essential], lengths[essential], q_values[essential]
+        index = expand_ranges(starts, lengths)
+        rows = np.repeat(q_rows, lengths)
+        slots = self.weight_slots[index].astype(np.int64)
+        values = np.repeat(q_values, lengths) * self.weight_values[index]
+        keep = alive[slots]
+        return rows[keep], slots[keep], values[keep], lookups
+
+    def complete(self, keys, scores, width, lookups):
+        """Suma a los candidatos (claves fila * width + slot) las entradas no esenciales"""
+        for row, term_id, weight in zip(*lookups):
+            first, last = np.searchsorted(keys, (row * width, (row + 1) * width))
+            if first == last:
+                continue
+            start, end = self.ptr[term_id], self.ptr[term_id + 1]
+            if start == end:
+                continue
+            segment = self.slot_slots[start:end]
+            candidates = keys[first:last] - row * width
+            positions = np.searchsorted(segment, candidates)
+            positions[positions == len(segment)] = 0
+            hit = segment[positions] == candidates
+            scores[first:last][hit] += weight * self.slot_values[start + positions[hit]]
+
+    def batch_chunks(self, q_rows, q_cols, n_queries, max_products):
+        """Rangos de entradas de consultas consecutivas con como máximo max_products productos"""
+        known = q_cols < self.n_terms
+        sizes = np.bincount(
+            q_rows[known],
+            weights=self.ptr[q_cols[known] + 1] - self.ptr[q_cols[known]],
+            minlength=n_queries
+        )
+        bounds = [0]
+        total = 0
+        for row, size in enumerate(sizes):
+            if total and total + size > max_products:
+                bounds.append(row)
+                total = 0
+            total += size
+        bounds.append(n_queries)
+        entry_bounds = np.searchsorted(q_rows, bounds)
+        return list(zip(entry_bounds[:-1], entry_bounds[1:]))
+
+def top_k_per_row(snapshot, rows, slots, values, lookups, width, k, min_score):
+    """Suma los productos por (consulta, slot) y devuelve los k mejores de cada consulta
+
+    Devuelve (filas, slots, puntuaciones) ordenados por consulta y puntuación.
+    """
+    if not len(rows):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.float64)
+
+    # Suma por (consulta, patrón): el producto disperso en sí
+    keys, inverse = np.unique(rows * width + slots, return_inverse=True)
+    scores = np.bincount(inverse, weights=values)
+    snapshot.complete(keys, scores, width, lookups)
+
+    keep = (scores >= min_score) & (scores > 0)
+    keys, scores = keys[keep], scores[keep]
+    rows, slots = keys // width, keys % width
+
+    order = np.lexsort((-scores, rows))
+    rows, slots, scores = rows[order], slots[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    top = rank < k
+    return rows[top], slots[top], scores[top]
+
+def _synthetic_corpus(n_patterns, vocabulary, length, seed):
+    """Patrones con términos de frecuencia Zipf"""
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, vocabulary + 1)
+    probabilities = 1.0 / ranks
+    probabilities /= probabilities.sum()
+    lengths = rng.integers(max(1, length // 2), length * 2, size=n_patterns)
+    terms = rng.choice(vocabulary, size=int(lengths.sum()), p=probabilities)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    return rng, [' '.join(f"t{term}" for term in terms[offsets[i]:offsets[i + 1]]) for i in range(n_patterns)]
+
+def benchmark(n_patterns=1000000, n_queries=200, vocabulary=50000, length=6, k=5, threshold=0.7, seed=7):
+    """Compara latencia y recall del índice invertido con la puntuación exhaustiva"""
+    from .tfidf import TfidfIndex
+
+    rng, corpus = _synthetic_corpus(n_patterns, vocabulary, length, seed)
+    start_time = time.perf_counter()
+    index = TfidfIndex.from_rows((i, pattern, None, None) for i, pattern in enumerate(corpus))
+    build_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    index.postings()
+    postings_seconds = time.perf_counter() - start_time
+
+    # Consultas derivadas de patrones existentes, con una palabra cambiada
+    queries = []
+    for position in rng.integers(0, n_patterns, size=n_queries):
+        words = corpus[position].split()
+        words[rng.integers(0, len(words))] = f"t{rng.integers(0, vocabulary)}"
+        queries.append(' '.join(words))
+
+    timings = {'exhaustive': [], 'pruned': []}
+    found = expected = 0
+    for query in queries:
+        start_time = time.perf_counter()
+        exact = index.search(query, k=k, min_score=threshold, prune=False)
+        timings['exhaustive'].append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        pruned = index.search(query, k=k, min_score=threshold, prune=True)
+        timings['pruned'].append(time.perf_counter() - start_time)
+
+        exact_ids = {match.pattern_id for match in exact}
+        expected += len(exact_ids)
+        found += len(exact_ids & {match.pattern_id for match in pruned})
+
+    print(f"Corpus: {n_patterns} patrones, {index.vocabulary_size} términos, {index.stats()['nnz']} entradas")
+    print(f"Construcción: {build_seconds:.1f}s; índice invertido: {postings_seconds:.2f}s")
+    for mode, values in timings.items():
+        values = np.array(values) * 1000
+        print(f"{mode:<11} p50={np.percentile(values, 50):8.2f} ms  p95={np.percentile(values, 95):8.2f} ms")
+    print(f"Recall@{k} (umbral {threshold}): {found / expected if expected else 1.0:.4f} ({found}/{expected})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del índice invertido de patrones")
+    parser.add_argument('--patterns', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--length', type=int, default=6, help="Longitud media de los patrones")
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.7, help="Equivalente a MIN_CONFIDENCE")
+    args = parser.parse_args(argv)
+    benchmark(args.patterns, args.queries, args.vocabulary, args.length, args.k, args.threshold)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
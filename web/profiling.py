@@ -0,0 +1,215 @@
+"""
+Perfilado bajo demanda de solicitudes
+Un administrador puede perfilar una solicitud con ?_profile=pstats|collapsed
+(o la cabecera X-Profile) y PROFILE_SAMPLE perfila 1 de cada N solicitudes
+de los endpoints indicados. Los perfiles se guardan en PROFILE_DIR.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+import itertools
+from collections import Counter
+from datetime import datetime
+from flask import request, g
+from flask_login import current_user
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', run_path('profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
+# Intervalo de muestreo (segundos) del modo collapsed
+SAMPLE_INTERVAL = 0.001
+
+MODES = ('pstats', 'collapsed')
+EXTENSIONS = {'pstats': '.pstats', 'collapsed': '.collapsed'}
+
+def parse_sample_config(value):
+    """Convierte 'dashboard=100,get_stats=50' en {'dashboard': 100, 'get_stats': 50}"""
+    config = {}
+    for item in (value or '').split(','):
+        endpoint, _, every = item.strip().partition('=')
+        if endpoint and every.isdigit() and int(every) > 0:
+            config[endpoint] = int(every)
+    return config
+
+SAMPLE_EVERY = parse_sample_config(os.environ.get('PROFILE_SAMPLE'))
+_sample_counters = {endpoint: itertools.count(1) for endpoint in SAMPLE_EVERY}
+
+class StackSampler:
+    """Muestrea la pila de un hilo y acumula pilas colapsadas (formato flamegraph)"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+def _requested_mode():
+    """Modo pedido explícitamente por un administrador, o None"""
+    mode = request.args.get('_profile') or request.headers.get('X-Profile')
+    if not mode:
+        return None
+    mode = mode if mode in MODES else 'pstats'
+    if current_user.is_authenticated and getattr(current_user, 'is_admin', False):
+        return mode
+    return None
+
+def _sampled():
+    every = SAMPLE_EVERY.get(request.endpoint)
+    return bool(every) and next(_sample_counters[request.endpoint]) % every == 0
+
+def _prune(directory):
+    metas = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in metas[:-PROFILE_KEEP] if PROFILE_KEEP else []:
+        base = name[:-len('.json')]
+        for ext in ('.json',) + tuple(EXTENSIONS.values()):
+            try:
+                os.remove(os.path.join(directory, base + ext))
+            except FileNotFoundError:
+                pass
+
+def list_profiles(directory=PROFILE_DIR):
+    """Metadatos de los perfiles guardados, del más reciente al más antiguo"""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def profile_path(filename, directory=PROFILE_DIR):
+    """Ruta de un fichero de perfil, o None si el nombre no es válido"""
+    if os.path.basename(filename) != filename or not filename.endswith(tuple(EXTENSIONS.values())):
+        return None
+    path = os.path.join(directory, filename)
+    return path if os.path.isfile(path) else None
+
+def top_functions(path, limit=25):
+    """Resumen de un .pstats ordenado por tiempo acumulado"""
+    stats = pstats.Stats(path)
+    rows = []
+    for (filename, line, name), (_, nc, tt, ct, _) in stats.stats.items():
+        rows.append({
+            'function': f"{name} ({os.path.basename(filename)}:{line})",
+            'calls': nc,
+            'total_time': tt,
+            'cumulative_time': ct
+        })
+    rows.sort(key=lambda row: row['cumulative_time'], reverse=True)
+    return rows[:limit]
+
+def profiling_middleware(app):
+    """Activa el perfilador para las solicitudes pedidas o muestreadas"""
+    @app.before_request
+    def start_profile():
+        mode = _requested_mode()
+        trigger = 'manual'
+        if mode is None:
+            if not _sampled():
+                return
+            mode, trigger = 'pstats', 'sample'
+
+        try:
+            if mode == 'pstats':
+                profiler = cProfile.Profile()
+                profiler.enable()
+            else:
+                profiler = StackSampler(threading.get_ident())
+                profiler.start()
+        except ValueError as e:
+            # Otro perfilador ya está activo en este hilo
+            logger.warning(f"No se pudo iniciar el perfilador: {e}")
+            return
+        g.profile = (mode, trigger, profiler, time.time())
+
+    @app.after_request
+    def stop_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+
+        mode, trigger, profiler, start_time = profile
+        if mode == 'pstats':
+            profiler.disable()
+        else:
+            profiler.stop()
+        duration = time.time() - start_time
+
+        try:
+            ensure_private_dir(PROFILE_DIR)
+            base = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:8]}"
+            filename = base + EXTENSIONS[mode]
+            if mode == 'pstats':
+                profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+            else:
+                profiler.dump(os.path.join(PROFILE_DIR, filename))
+
+            meta = {
+                'file': filename,
+                'mode': mode,
+                'trigger': trigger,
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'status': response.status_code,
+                'duration': duration,
+                'user': current_user.username if current_user.is_authenticated else None,
+                'created_at': datetime.now().isoformat()
+            }
+            with open(os.path.join(PROFILE_DIR, base + '.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            _prune(PROFILE_DIR)
+
+            response.headers['X-Profile-File'] = filename
+            logger.info(f"Perfil {mode} guardado: {filename} ({duration:.4f}s)")
+        except Exception as e:
+            logger.error(f"Error guardando el perfil: {e}")
+        return response
+
+    @app.teardown_request
+    def discard_profile(exc):
+        # La vista lanzó una excepción antes de after_request: no dejar el perfilador activo
+        profile = g.pop('profile', None)
+        if profile is not None:
+            mode, _, profiler, _ = profile
+            if mode == 'pstats':
+                profiler.disable()
+            else:
+                profiler.stop()
@@ -0,0 +1,227 @@
+"""
+Tabla de contadores agregados (group_stats_rollup)
+Mantiene los totales de moderación y actividad al escribir en vez de al leer,
+con triggers de la base de datos (PostgreSQL y SQLite):
+
+    python -m web.rollup
+"""
+import os
+import logging
+from sqlalchemy import Table, Column, MetaData, String, Integer, DateTime, func, select, cast, case
+from datetime import datetime
+
+logger = logging.getLogger('web')
+
+# Fila con los contadores globales
+GLOBAL_KEY = '__global__'
+# En PostgreSQL los triggers reparten el total global en filas '__global__:<n>'
+# según el backend, para que los escritores concurrentes no se serialicen en una
+# sola fila; read_global_counters() las suma
+GLOBAL_SHARDS = int(os.environ.get('ROLLUP_SHARDS', 16))
+
+COUNTERS = ('warnings', 'actions', 'messages', 'users')
+
+metadata = MetaData()
+
+group_stats_rollup = Table(
+    'group_stats_rollup', metadata,
+    Column('group_id', String(64), primary_key=True),
+    Column('warnings', Integer, nullable=False, default=0),
+    Column('actions', Integer, nullable=False, default=0),
+    Column('messages', Integer, nullable=False, default=0),
+    Column('users', Integer, nullable=False, default=0),
+    Column('updated_at', DateTime, default=datetime.utcnow)
+)
+
+# Marca que escribe rebuild_rollup(): sin ella el rollup no se usa
+BUILT_KEY = '__built__'
+
+TRIGGER_PREFIX = 'lba_rollup'
+
+def _sources():
+    """(modelo, contador, columna de grupo o None) de cada tabla que alimenta el rollup"""
+    from shared.database import ModAction, Warning, User as BotUser, Message
+
+    sources = []
+    for model, counter in ((Warning, 'warnings'), (ModAction, 'actions'),
+                           (Message, 'messages'), (BotUser, 'users')):
+        column = None
+        if counter != 'users':
+            column = getattr(model, 'group_id', None)
+            if column is None:
+                column = getattr(model, 'chat_id', None)
+        sources.append((model, counter, column))
+    return sources
+
+def _postgresql_triggers(quote, table, counter, group_column):
+    function = f"{TRIGGER_PREFIX}_{table}"
+    target = quote(group_stats_rollup.name)
+    zeros = {name: '0' for name in COUNTERS}
+
+    def upsert(key, delta, initial):
+        values = dict(zeros, **{counter: initial})
+        return (
+            f"INSERT INTO {target} (group_id, {', '.join(COUNTERS)}, updated_at) "
+            f"VALUES ({key}, {', '.join(values[name] for name in COUNTERS)}, now()) "
+            f"ON CONFLICT (group_id) DO UPDATE SET {counter} = {target}.{counter} + {delta}, updated_at = now();"
+        )
+
+    # Un fragmento puede quedar negativo (borrado en un backend nuevo); solo cuenta la suma
+    global_key = f"'{GLOBAL_KEY}:' || (pg_backend_pid() % {GLOBAL_SHARDS})"
+    group_body = ''
+    if group_column is not None:
+        column = quote(group_column)
+        group_body = f"""
+    IF TG_OP = 'INSERT' THEN
+        row_group := NEW.{column}::text;
+    ELSE
+        row_group := OLD.{column}::text;
+    END IF;
+    IF row_group IS NOT NULL THEN
+        {upsert('row_group', 'delta', 'GREATEST(delta, 0)')}
+    END IF;"""
+
+    return [
+        f"""CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+DECLARE
+    delta integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    row_group text;
+BEGIN
+    {upsert(global_key, 'delta', 'delta')}{group_body}
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql""",
+        f"DROP TRIGGER IF EXISTS {function} ON {quote(table)}",
+        f"CREATE TRIGGER {function} AFTER INSERT OR DELETE ON {quote(table)} "
+        f"FOR EACH ROW EXECUTE PROCEDURE {function}()"
+    ]
+
+def _sqlite_triggers(quote, table, counter, group_column):
+    target = quote(group_stats_rollup.name)
+    statements = []
+    for event_name, row, delta in (('INSERT', 'NEW', 1), ('DELETE', 'OLD', -1)):
+        name = f"{TRIGGER_PREFIX}_{table}_{event_name.lower()}"
+        # Las escrituras en SQLite ya están serializadas: basta una fila global
+        keys = [f"'{GLOBAL_KEY}'"]
+        if group_column is not None:
+            keys.append(f"CAST({row}.{quote(group_column)} AS TEXT)")
+        body = []
+        for key in keys:
+            # INSERT OR IGNORE + UPDATE no compite con otros escritores
+            body.append(
+                f"INSERT OR IGNORE INTO {target} (group_id, {', '.join(COUNTERS)}, updated_at) "
+                f"SELECT {key}, {', '.join('0' for _ in COUNTERS)}, CURRENT_TIMESTAMP WHERE {key} IS NOT NULL;"
+            )
+            body.append(
+                f"UPDATE {target} SET {counter} = {counter} + ({delta}), updated_at = CURRENT_TIMESTAMP "
+                f"WHERE group_id = {key};"
+            )
+        statements.append(f"DROP TRIGGER IF EXISTS {name}")
+        statements.append(
+            f"CREATE TRIGGER {name} AFTER {event_name} ON {quote(table)} FOR EACH ROW BEGIN\n"
+            + '\n'.join(body) + "\nEND"
+        )
+    return statements
+
+_TRIGGER_BUILDERS = {
+    'postgresql': _postgresql_triggers,
+    'sqlite': _sqlite_triggers
+}
+
+def install_rollup_triggers(connection):
+    """Crea los triggers que mantienen group_stats_rollup en la propia base de datos
+
+    Al vivir en la base de datos cuentan las escrituras de cualquier proceso
+    (bot o web) y también los borrados masivos. Devuelve False si el dialecto
+    no está soportado; entonces las estadísticas se calculan desde las tablas.
+    """
+    builder = _TRIGGER_BUILDERS.get(connection.dialect.name)
+    if builder is None:
+        return False
+    quote = connection.dialect.identifier_preparer.quote
+    for model, counter, column in _sources():
+        group_column = column.property.columns[0].name if column is not None else None
+        for statement in builder(quote, model.__table__.name, counter, group_column):
+            connection.exec_driver_sql(statement)
+    return True
+
+def ensure_rollup_table(bind):
+    """Crea la tabla group_stats_rollup si no existe"""
+    metadata.create_all(bind=bind, tables=[group_stats_rollup], checkfirst=True)
+
+def rebuild_rollup(db):
+    """Instala los triggers y recalcula group_stats_rollup desde las tablas originales
+
+    Todo ocurre en una transacción: en PostgreSQL, CREATE TRIGGER bloquea las
+    escrituras en cada tabla hasta el commit, así que ninguna fila queda sin
+    contar entre el recuento y la activación de los triggers.
+    """
+    ensure_rollup_table(db.get_bind())
+    db.execute(group_stats_rollup.delete())
+    if not install_rollup_triggers(db.connection()):
+        db.commit()
+        logger.warning(
+            f"El dialecto {db.get_bind().dialect.name} no admite los triggers de group_stats_rollup: "
+            f"las estadísticas se calcularán desde las tablas"
+        )
+        return 0
+
+    rows = {}
+    totals = {name: 0 for name in COUNTERS}
+    for model, counter, column in _sources():
+        if column is None:
+            totals[counter] = db.query(func.count(model.id)).scalar() or 0
+            continue
+        for group_id, total in db.query(column, func.count(model.id)).group_by(column):
+            totals[counter] += total
+            if group_id is not None:
+                row = rows.setdefault(str(group_id), {name: 0 for name in COUNTERS})
+                row[counter] += total
+    rows[GLOBAL_KEY] = totals
+    rows[BUILT_KEY] = {name: 0 for name in COUNTERS}
+
+    now = datetime.utcnow()
+    db.execute(group_stats_rollup.insert(), [
+        dict(group_id=key, updated_at=now, **row) for key, row in rows.items()
+    ])
+    db.commit()
+    logger.info(f"group_stats_rollup reconstruida con {len(rows)} filas")
+    return len(rows)
+
+def read_global_counters(db):
+    """Devuelve los contadores globales o None si rebuild_rollup() aún no se ha ejecutado
+
+    Suma la fila global y sus fragmentos '__global__:<n>' en la misma consulta.
+    """
+    t = group_stats_rollup
+    is_global = (t.c.group_id == GLOBAL_KEY) | t.c.group_id.startswith(f"{GLOBAL_KEY}:", autoescape=True)
+    row = db.execute(
+        select(
+            func.count(case((t.c.group_id == BUILT_KEY, 1))),
+            func.count(case((t.c.group_id == GLOBAL_KEY, 1))),
+            *[func.coalesce(func.sum(case((is_global, t.c[name]), else_=0)), 0) for name in COUNTERS]
+        ).where((t.c.group_id == BUILT_KEY) | is_global)
+    ).one()
+    if not row[0] or not row[1]:
+        return None
+    return dict(zip(COUNTERS, row[2:]))
+
+def read_group_counters(db):
+    """Devuelve (grupo, advertencias, acciones) uniendo groups con el rollup"""
+    from shared.database import Group
+    t = group_stats_rollup
+    return db.query(
+        Group,
+        func.coalesce(t.c.warnings, 0),
+        func.coalesce(t.c.actions, 0)
+    ).outerjoin(t, t.c.group_id == cast(Group.chat_id, String)).all()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    from shared.database import get_db
+    session = get_db()
+    try:
+        count = rebuild_rollup(session)
+        print(f"group_stats_rollup reconstruida: {count} filas")
+    finally:
+        session.close()
@@ -1,23 +1,49 @@
-from flask import render_template, jsonify, request, redirect, url_for, flash, session
+from flask import render_template, jsonify, request, redirect, url_for, flash, session, Response, make_response, send_file, stream_with_context
 from flask_login import login_required, login_user, logout_user, current_user
 from .app import db, User
-from bot.ai_module import SimpleAI
-from shared.database import get_db, Group, ModAction, Warning, User as BotUser, Message
+from .ai_engine import ai_engine, respond_stream, BATCH_MAX_MESSAGES
+from .dbsession import request_db, make_session
+from .stats import (rollup_counters, get_moderation_totals, get_bot_totals, get_group_stats, get_confidence_distribution, get_top_patterns,
+                    collect_stats, collect_bot_stats, collect_ai_stats, collect_snapshot,
+                    default_stats, default_bot_stats, default_ai_stats)
+from .stream import StatsBroadcaster
+from .patterns import query_patterns, DEFAULT_LIMIT
+from .backup import start_backup, stream_backup, BACKUP_PREFIX, BACKUP_SUFFIX
+from .changelog import record_change, OP_TRUNCATE
+from .broadcast import enqueue_broadcast, get_broadcast_progress, broadcast_engine
+from .activity import get_activity_series, parse_range, BUCKETS
+from .testjobs import test_runner, stream_job
+from .wiki import wiki_cache
+from .middleware import cached_response, clear_response_cache, admin_required
+from .profiling import list_profiles, profile_path, top_functions, SAMPLE_EVERY as PROFILE_SAMPLE_EVERY
+from .metrics import registry as metrics_registry
 from datetime import datetime, timedelta
-import markdown2
 import os
-import pytest
+import hashlib
+import secrets
 import sys
 import logging
 import traceback
 import json
-from io import StringIO
-from sqlalchemy import func, desc
+from sqlalchemy import desc
 
 # Configuración de logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+def _stats_snapshot():
+    """Productor del canal SSE: una sesión y un cálculo por intervalo"""
+    db = make_session()
+    try:
+        return collect_snapshot(db)
+    finally:
+        db.close()
+
+stats_broadcaster = StatsBroadcaster(
+    _stats_snapshot,
+    interval=int(os.environ.get('STATS_STREAM_INTERVAL', 30))
+)
+
 def register_routes(app):
     @app.route('/')
     def index():
@@ -31,13 +57,14 @@ def register_routes(app):
             }
             
             try:
-                db = get_db()
+                db = request_db()
+                from shared.database import Group
                 # Estadísticas básicas del sistema
                 data['total_groups'] = db.query(Group).count()
                 
                 # Obtener datos del motor de IA
                 try:
-                    ai = SimpleAI()
+                    ai = ai_engine.get()
                     ai_stats = ai.get_stats()
                     data['total_patterns'] = ai_stats.get('patterns', 0)
                     data['total_messages'] = ai_stats.get('messages', 0)
@@ -45,7 +72,6 @@ def register_routes(app):
                 except Exception as ai_err:
                     logger.error(f"Error obteniendo stats de IA para index: {ai_err}")
                 
-                db.close()
             except Exception as db_err:
                 logger.error(f"Error de base de datos en index: {db_err}")
             
@@ -107,15 +133,14 @@ def register_routes(app):
             try:
                 # Obtener estadísticas del bot
                 logger.debug("Obteniendo estadísticas del bot...")
-                db = get_db()
-                data['total_groups'] = db.query(Group).count()
-                data['total_actions'] = db.query(ModAction).count()
-                data['total_warnings'] = db.query(Warning).count()
+                db = request_db()
+                counters = rollup_counters(db)
+                data.update(get_moderation_totals(db, counters))
                 
                 # Obtener stats de IA
                 logger.debug("Obteniendo estadísticas de IA...")
                 try:
-                    ai = SimpleAI()
+                    ai = ai_engine.get()
                     data['ai_stats'] = ai.get_stats()
                 except Exception as ai_err:
                     logger.error(f"Error obteniendo stats de IA: {ai_err}")
@@ -124,33 +149,10 @@ def register_routes(app):
                 # Obtener grupos activos
                 logger.debug("Obteniendo datos de grupos...")
                 try:
-                    groups = db.query(Group).all()
-                    group_stats = []
-                    for group in groups:
-                        try:
-                            group_data = {
-                                'title': group.title or 'Sin nombre',
-                                'chat_id': getattr(group, 'chat_id', 'N/A'),
-                                'warnings': 0,
-                                'actions': 0,
-                                'auto_mod': getattr(group, 'auto_mod', False)
-                            }
-                            
-                            if hasattr(group, 'chat_id'):
-                                warnings = db.query(Warning).filter_by(group_id=str(group.chat_id)).count()
-                                actions = db.query(ModAction).filter_by(group_id=str(group.chat_id)).count()
-                                group_data['warnings'] = warnings
-                                group_data['actions'] = actions
-                                
-                            group_stats.append(group_data)
-                        except Exception as group_err:
-                            logger.error(f"Error procesando grupo: {group_err}")
-                            continue
-                    data['group_stats'] = group_stats
+                    data['group_stats'] = get_group_stats(db, counters)
                 except Exception as groups_err:
                     logger.error(f"Error obteniendo grupos: {groups_err}")
             
-                db.close()
             except Exception as db_err:
                 logger.error(f"Error de base de datos en dashboard: {db_err}")
                 logger.error(traceback.format_exc())
@@ -177,12 +179,28 @@ def register_routes(app):
 
     @app.route('/wiki')
     def wiki():
-        """Renderiza la wiki del proyecto"""
+        """Renderiza la wiki del proyecto desde la caché, respondiendo 304 si no cambió"""
         try:
-            with open('WIKI.md', 'r', encoding='utf-8') as f:
-                content = f.read()
-            html_content = markdown2.markdown(content)
-            return render_template('wiki.html', content=html_content)
+            page = wiki_cache.get()
+
+            # La barra de navegación depende de la sesión, así que la ETag también
+            viewer = current_user.get_id() if current_user.is_authenticated else 'anon'
+            etag = hashlib.sha256(f"{page.etag}:{viewer}".encode('utf-8')).hexdigest()[:32]
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = bool(request.if_modified_since and request.if_modified_since >= page.last_modified)
+
+            # Los mensajes flash pendientes obligan a renderizar la página
+            if not_modified and not session.get('_flashes'):
+                response = Response(status=304)
+            else:
+                response = make_response(render_template('wiki.html', content=page.content, toc=page.toc))
+            response.set_etag(etag)
+            response.last_modified = page.last_modified
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Cookie')
+            return response
         except Exception as e:
             app.logger.error(f"Error al cargar la wiki: {e}")
             return render_template('error.html', error="Error al cargar la wiki"), 500
@@ -190,121 +208,52 @@ def register_routes(app):
     @app.route('/test')
     @login_required
     def run_tests():
-        """Ejecuta las pruebas del proyecto y muestra los resultados"""
+        """Lanza las pruebas en segundo plano (o reutiliza el resultado en caché) y muestra su salida"""
         try:
-            import subprocess
-            import tempfile
-            
-            logger.info(f"Ejecutando tests solicitados por {current_user.username}")
-            
-            # Ejecutar pruebas en un proceso separado para no interferir con la app
-            with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as output_file:
-                output_file_path = output_file.name
-                
-            try:
-                # Ejecutar pytest como un proceso separado y capturar su salida
-                process = subprocess.run(
-                    ['python', '-m', 'pytest', 'test', '-v'],
-                    capture_output=True,
-                    text=True,
-                    timeout=30  # Timeout de 30 segundos
-                )
-                
-                test_output = process.stdout + "\n\n" + process.stderr
-                success = process.returncode == 0
-                
-                # Guardar la salida completa para debugging
-                with open(output_file_path, 'w') as f:
-                    f.write(test_output)
-                
-                logger.info(f"Tests ejecutados con resultado: {'éxito' if success else 'fallo'}")
-            except subprocess.TimeoutExpired:
-                logger.error("Timeout al ejecutar tests")
-                test_output = "ERROR: Timeout al ejecutar las pruebas (más de 30 segundos)"
-                success = False
-            
-            # Manejo de salida muy larga
-            if len(test_output) > 10000:
-                test_output = test_output[:5000] + "\n\n... [Output truncado] ...\n\n" + test_output[-5000:]
-            
-            return render_template('test.html',
-                                success=success,
-                                output=test_output)
+            force = request.args.get('force') == '1'
+            job = test_runner.start(requested_by=current_user.username, force=force)
+            logger.info(f"Tests solicitados por {current_user.username}: ejecución {job.id} ({job.status})")
+            return render_template('test.html', job=job)
         except Exception as e:
             logger.error(f"Error ejecutando tests: {e}")
             logger.error(traceback.format_exc())
             return render_template('error.html', error="Error al ejecutar las pruebas"), 500
 
+    @app.route('/test/stream/<job_id>')
+    @login_required
+    def test_stream(job_id):
+        """Canal SSE con la salida de una ejecución de pruebas (reanudable con Last-Event-ID)"""
+        job = test_runner.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Ejecución no encontrada'}), 404
+
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            offset = int(last_event_id) if last_event_id else 0
+        except ValueError:
+            offset = 0
+
+        return Response(
+            stream_job(job, offset),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
     @app.route('/api/stats')
     @login_required
+    @cached_response()
     def get_stats():
         try:
             logger.info(f"Solicitud de API stats por usuario: {current_user.username}")
             
-            # Inicializar valores por defecto
-            stats = {
-                'total_groups': 0,
-                'total_actions': 0,
-                'total_warnings': 0,
-                'total_users': 0,
-                'total_messages': 0,
-                'grupos_activos': 0,
-                'advertencias': 0,
-                'patrones_aprendidos': 0,
-                'precisión': 0,
-                'ai_stats': {
-                    'patterns': 0,
-                    'responses': 0,
-                    'accuracy': 0
-                },
-                'group_stats': []
-            }
-            
+            # Contadores a cero si la base de datos falla, como espera la plantilla
+            stats = default_stats()
             try:
-                # Datos de base de datos
-                db = get_db()
-                stats['total_groups'] = db.query(Group).count()
-                stats['total_actions'] = db.query(ModAction).count()
-                stats['total_warnings'] = db.query(Warning).count()
-                stats['grupos_activos'] = stats['total_groups']
-                stats['advertencias'] = stats['total_warnings']
-                
-                # Datos de IA
-                try:
-                    ai = SimpleAI()
-                    ai_data = ai.get_stats()
-                    stats['ai_stats'] = ai_data
-                    stats['patrones_aprendidos'] = ai_data.get('patterns', 0)
-                    stats['precisión'] = ai_data.get('accuracy', 0)
-                except Exception as ai_err:
-                    logger.error(f"Error obteniendo stats de IA en API: {ai_err}")
-                
-                # Datos de grupos
-                try:
-                    groups = db.query(Group).all()
-                    group_data = []
-                    for group in groups:
-                        try:
-                            g_data = {
-                                'title': getattr(group, 'title', 'Sin nombre'),
-                                'chat_id': getattr(group, 'chat_id', 'N/A'),
-                                'warnings': 0,
-                                'actions': 0
-                            }
-                            
-                            if hasattr(group, 'chat_id'):
-                                g_data['warnings'] = db.query(Warning).filter_by(group_id=str(group.chat_id)).count()
-                                g_data['actions'] = db.query(ModAction).filter_by(group_id=str(group.chat_id)).count()
-                                
-                            group_data.append(g_data)
-                        except Exception as group_err:
-                            logger.error(f"Error procesando grupo en API: {group_err}")
-                    
-                    stats['group_stats'] = group_data
-                except Exception as groups_err:
-                    logger.error(f"Error obteniendo grupos en API: {groups_err}")
-                
-                db.close()
+                db = request_db()
+                stats = collect_stats(db)
             except Exception as db_err:
                 logger.error(f"Error de base de datos en API stats: {db_err}")
                 logger.error(traceback.format_exc())
@@ -318,6 +267,74 @@ def register_routes(app):
             logger.error(traceback.format_exc())
             return jsonify({'success': False, 'error': str(e)})
 
+    @app.route('/api/stream')
+    @login_required
+    def stats_stream():
+        """Canal SSE con las estadísticas del panel (reanudable con Last-Event-ID)"""
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or None
+            
+        logger.info(f"Conexión SSE de {current_user.username} (Last-Event-ID={last_event_id})")
+        return Response(
+            stats_broadcaster.subscribe(last_event_id),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    @app.route('/metrics')
+    def metrics():
+        """Métricas de todos los procesos en formato Prometheus
+
+        Requiere una sesión de administrador o, para el scraper, la cabecera
+        "Authorization: Bearer <METRICS_TOKEN>".
+        """
+        token = os.environ.get('METRICS_TOKEN')
+        authorized = bool(token) and secrets.compare_digest(
+            request.headers.get('Authorization', ''), f"Bearer {token}"
+        )
+        if not authorized and not (current_user.is_authenticated and getattr(current_user, 'is_admin', False)):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        try:
+            return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+        except Exception as e:
+            logger.error(f"Error generando métricas: {e}")
+            return Response('Error generando métricas\n', status=500, mimetype='text/plain')
+
+    @app.route('/admin/profiles')
+    @login_required
+    @admin_required
+    def admin_profiles():
+        """Lista los perfiles capturados y muestra el resumen del seleccionado"""
+        try:
+            profiles = list_profiles()
+            selected = request.args.get('show')
+            summary = None
+            if selected and selected.endswith('.pstats'):
+                path = profile_path(selected)
+                if path:
+                    summary = top_functions(path)
+            return render_template('admin_profiles.html',
+                                   profiles=profiles,
+                                   selected=selected,
+                                   summary=summary,
+                                   sample_every=PROFILE_SAMPLE_EVERY)
+        except Exception as e:
+            logger.error(f"Error listando perfiles: {e}")
+            logger.error(traceback.format_exc())
+            return render_template('error.html', error="Error al cargar los perfiles"), 500
+
+    @app.route('/admin/profiles/<filename>')
+    @login_required
+    @admin_required
+    def download_profile(filename):
+        """Descarga un perfil (.pstats o .collapsed)"""
+        path = profile_path(filename)
+        if path is None:
+            return render_template('error.html', error=404), 404
+        return send_file(path, as_attachment=True, download_name=filename)
+
     @app.route('/logout')
     @login_required
     def logout():
@@ -348,35 +365,58 @@ def register_routes(app):
         """Renderiza la página de gestión de conocimiento"""
         try:
             logger.info(f"Acceso a gestión de conocimiento por usuario: {current_user.username}")
-            patterns = []
+            page = {'items': [], 'next_cursor': None}
             
             try:
-                # Inicializar el SimpleAI
-                ai = SimpleAI()
-                
-                # Obtener patrones de la base de datos
-                db = get_db()
-                
-                # Consultar patrones desde la tabla AIPattern
-                from shared.database import AIPattern
-                patterns_data = db.query(AIPattern).all()
-                
-                patterns = [(p.pattern, p.response, p.confidence) for p in patterns_data]
-                
-                db.close()
-                logger.info(f"Cargados {len(patterns)} patrones para la vista de conocimiento")
+                # Solo la primera página; el resto se carga desde /api/patterns
+                db = request_db()
+                page = query_patterns(db)
+                logger.info(f"Cargados {len(page['items'])} patrones para la vista de conocimiento")
                 
             except Exception as e:
                 logger.error(f"Error cargando patrones: {str(e)}")
                 logger.error(traceback.format_exc())
                 flash('Error al cargar los patrones de conocimiento', 'error')
                 
-            return render_template('knowledge.html', patterns=patterns)
+            return render_template('knowledge.html', patterns=page['items'], next_cursor=page['next_cursor'])
         except Exception as e:
             logger.error(f"Error general en knowledge: {str(e)}")
             logger.error(traceback.format_exc())
             return render_template('error.html', error="Error al cargar la base de conocimiento"), 500
             
+    @app.route('/api/patterns')
+    @login_required
+    def list_patterns():
+        """API paginada de patrones (?after=<cursor>&limit=100&q=...&sort=uses|confidence|created_at)"""
+        try:
+            try:
+                min_confidence = request.args.get('min_confidence', type=float)
+                max_confidence = request.args.get('max_confidence', type=float)
+                limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+                
+                db = request_db()
+                page = query_patterns(
+                    db,
+                    after=request.args.get('after'),
+                    limit=limit,
+                    q=request.args.get('q', '').strip() or None,
+                    sort=request.args.get('sort', 'uses'),
+                    min_confidence=min_confidence,
+                    max_confidence=max_confidence
+                )
+            except ValueError as param_err:
+                return jsonify({'success': False, 'error': str(param_err)}), 400
+                
+            return jsonify({
+                'success': True,
+                'patterns': page['items'],
+                'next_cursor': page['next_cursor']
+            })
+        except Exception as e:
+            logger.error(f"Error general en API patterns: {str(e)}")
+            logger.error(traceback.format_exc())
+            return jsonify({'success': False, 'error': 'Error interno del servidor'})
+            
     @app.route('/api/add_pattern', methods=['POST'])
     @login_required
     def add_pattern():
@@ -402,9 +442,14 @@ def register_routes(app):
                 return jsonify({'success': False, 'error': 'La confianza debe estar entre 0 y 1'})
                 
             try:
-                # Inicializar AI y guardar patrón
-                ai = SimpleAI()
+                # SimpleAI aprende el patrón en memoria y lo guarda; el trigger de
+                # ai_patterns lo anota en ai_pattern_changes con su id y sync_index()
+                # lo añade al índice sin reconstruir ni SimpleAI ni el índice
+                ai = ai_engine.get()
                 success = ai.learn(pattern, response, confidence)
+                if success:
+                    ai_engine.sync_index()
+                    clear_response_cache()
                 
                 if success:
                     logger.info(f"Patrón añadido exitosamente: '{pattern[0:30]}...'")
@@ -423,6 +468,56 @@ def register_routes(app):
             logger.error(traceback.format_exc())
             return jsonify({'success': False, 'error': 'Error interno del servidor'})
             
+    @app.route('/api/ai/respond_batch', methods=['POST'])
+    @login_required
+    def respond_batch():
+        """Respuestas de IA para varios mensajes en una sola llamada
+
+        JSON: {"messages": [...], "k": 3, "min_confidence": 0.7}
+        NDJSON (Content-Type: application/x-ndjson): un mensaje por línea y la
+        respuesta se devuelve en streaming, sin límite de tamaño del lote;
+        k y min_confidence van entonces en la query string.
+        """
+        try:
+            k = request.args.get('k', 3, type=int)
+            min_confidence = request.args.get('min_confidence', type=float)
+
+            if request.mimetype == 'application/x-ndjson':
+                logger.info(f"Lote NDJSON de IA solicitado por usuario: {current_user.username}")
+                return Response(
+                    stream_with_context(respond_stream(request.stream, k=k, min_score=min_confidence)),
+                    mimetype='application/x-ndjson'
+                )
+
+            payload = request.get_json(silent=True) or {}
+            messages = payload.get('messages')
+            if not isinstance(messages, list) or not all(isinstance(message, str) for message in messages):
+                return jsonify({'success': False, 'error': 'messages debe ser una lista de textos'}), 400
+            if len(messages) > BATCH_MAX_MESSAGES:
+                return jsonify({
+                    'success': False,
+                    'error': f'Máximo {BATCH_MAX_MESSAGES} mensajes por llamada; usa application/x-ndjson para lotes mayores'
+                }), 413
+
+            k = int(payload.get('k', k))
+            if payload.get('min_confidence') is not None:
+                min_confidence = float(payload['min_confidence'])
+
+            results = ai_engine.match_batch(messages, k=k, min_score=min_confidence)
+            return jsonify({
+                'success': True,
+                'results': [{
+                    'message': message,
+                    'responses': [match._asdict() for match in matches]
+                } for message, matches in zip(messages, results)]
+            })
+        except (TypeError, ValueError) as param_err:
+            return jsonify({'success': False, 'error': str(param_err)}), 400
+        except Exception as e:
+            logger.error(f"Error general en respond_batch: {str(e)}")
+            logger.error(traceback.format_exc())
+            return jsonify({'success': False, 'error': 'Error interno del servidor'})
+            
     @app.route('/api/update_pattern', methods=['POST'])
     @login_required
     def update_pattern():
@@ -450,14 +545,13 @@ def register_routes(app):
                 
             try:
                 # Actualizar en la base de datos
-                db = get_db()
+                db = request_db()
                 from shared.database import AIPattern
                 
                 # Buscar el patrón original
                 existing = db.query(AIPattern).filter_by(pattern=original_pattern).first()
                 
                 if not existing:
-                    db.close()
                     return jsonify({'success': False, 'error': 'El patrón original no existe'})
                     
                 # Si solo cambia la respuesta o confianza, actualizar
@@ -465,13 +559,16 @@ def register_routes(app):
                     existing.response = response
                     existing.confidence = confidence
                     db.commit()
-                    db.close()
+                    ai_engine.index_upsert(existing)
+                    clear_response_cache()
                     logger.info(f"Patrón actualizado exitosamente: '{pattern[0:30]}...'")
                     return jsonify({'success': True})
                     
                 # Si cambia el patrón, eliminar y crear nuevo
+                original_id = existing.id
                 db.delete(existing)
                 db.commit()
+                ai_engine.index_delete(original_id)
                 
                 # Crear nuevo con el patrón actualizado
                 new_pattern = AIPattern(
@@ -484,7 +581,8 @@ def register_routes(app):
                 )
                 db.add(new_pattern)
                 db.commit()
-                db.close()
+                ai_engine.index_upsert(new_pattern)
+                clear_response_cache()
                 
                 logger.info(f"Patrón actualizado exitosamente (con cambio de texto): '{pattern[0:30]}...'")
                 return jsonify({'success': True})
@@ -513,20 +611,21 @@ def register_routes(app):
                 
             try:
                 # Eliminar de la base de datos
-                db = get_db()
+                db = request_db()
                 from shared.database import AIPattern
                 
                 # Buscar el patrón
                 existing = db.query(AIPattern).filter_by(pattern=pattern).first()
                 
                 if not existing:
-                    db.close()
                     return jsonify({'success': False, 'error': 'El patrón no existe'})
                     
                 # Eliminar
+                pattern_id = existing.id
                 db.delete(existing)
                 db.commit()
-                db.close()
+                ai_engine.index_delete(pattern_id)
+                clear_response_cache()
                 
                 logger.info(f"Patrón eliminado exitosamente: '{pattern[0:30]}...'")
                 return jsonify({'success': True})
@@ -656,12 +755,11 @@ def register_routes(app):
             
             try:
                 # Obtener estadísticas del bot
-                db = get_db()
+                db = request_db()
+                from shared.database import User as BotUser, Message
                 
                 # Contadores básicos
-                data['total_users'] = db.query(BotUser).count()
-                data['total_groups'] = db.query(Group).count()
-                data['total_messages'] = db.query(Message).count()
+                data.update(get_bot_totals(db))
                 
                 # Usuarios activos (últimos 7 días)
                 week_ago = datetime.now() - timedelta(days=7)
@@ -710,17 +808,11 @@ def register_routes(app):
                     logger.error(f"Error obteniendo mensajes recientes: {msg_err}")
                     data['recent_messages'] = []
                 
-                # Datos de actividad por día de la semana
-                now = datetime.now()
-                for i in range(7):
-                    day = now - timedelta(days=i)
-                    count = db.query(Message).filter(
-                        func.date(Message.created_at) == day.date()
-                    ).count()
-                    # Guardar en orden inverso (el día más reciente primero)
-                    data['activity_data'][6-i] = count
-                
-                db.close()
+                # Datos de actividad de los últimos 7 días
+                series = get_activity_series(db, timedelta(days=7), 'day')
+                data['activity_days'] = series['labels']
+                data['activity_data'] = series['data']
+                
             except Exception as db_err:
                 logger.error(f"Error de base de datos en bot_stats: {db_err}")
                 logger.error(traceback.format_exc())
@@ -752,81 +844,27 @@ def register_routes(app):
             if add_signature:
                 message_content += f"\n\n_Enviado desde el panel de administración por {current_user.username}_"
                 
-            # Aquí iría la lógica de envío usando el Bot API
-            from bot.main import TelegramBot
+            # Encolar el envío; el motor en segundo plano lo procesa con límite de velocidad
             try:
-                bot = TelegramBot()
-                sent_count = 0
-                
-                # Obtener destinatarios según tipo seleccionado
-                db = get_db()
-                
-                if recipient_type == 'all':
-                    # Todos los usuarios
-                    users = db.query(BotUser).all()
-                    for user in users:
-                        if hasattr(user, 'telegram_id') and user.telegram_id:
-                            try:
-                                # Enviar mensaje - usando el bot directamente con sus métodos públicos
-                                if hasattr(bot, 'send_message'):
-                                    bot.send_message(
-                                        chat_id=user.telegram_id,
-                                        text=message_content,
-                                        parse_mode='Markdown'
-                                    )
-                                    sent_count += 1
-                                else:
-                                    logger.error(f"El objeto bot no tiene el método send_message")
-                            except Exception as send_err:
-                                logger.error(f"Error enviando mensaje a {user.telegram_id}: {send_err}")
-                    
-                elif recipient_type == 'active':
-                    # Solo usuarios activos (últimos 7 días)
-                    week_ago = datetime.now() - timedelta(days=7)
-                    users = db.query(BotUser).filter(
-                        BotUser.created_at >= week_ago
-                    ).all()
-                    
-                    for user in users:
-                        if hasattr(user, 'telegram_id') and user.telegram_id:
-                            try:
-                                if hasattr(bot, 'send_message'):
-                                    bot.send_message(
-                                        chat_id=user.telegram_id,
-                                        text=message_content,
-                                        parse_mode='Markdown'
-                                    )
-                                    sent_count += 1
-                                else:
-                                    logger.error(f"El objeto bot no tiene el método send_message")
-                            except Exception as send_err:
-                                logger.error(f"Error enviando mensaje a {user.telegram_id}: {send_err}")
+                db = request_db()
+                job_id = enqueue_broadcast(
+                    db,
+                    message_content,
+                    recipient_type,
+                    parse_mode='Markdown',
+                    created_by=current_user.username
+                )
                     
-                elif recipient_type == 'groups':
-                    # Todos los grupos
-                    groups = db.query(Group).all()
-                    for group in groups:
-                        if hasattr(group, 'telegram_id') and group.telegram_id:
-                            try:
-                                if hasattr(bot, 'send_message'):
-                                    bot.send_message(
-                                        chat_id=group.telegram_id,
-                                        text=message_content,
-                                        parse_mode='Markdown'
-                                    )
-                                    sent_count += 1
-                                else:
-                                    logger.error(f"El objeto bot no tiene el método send_message")
-                            except Exception as send_err:
-                                logger.error(f"Error enviando mensaje a grupo {group.telegram_id}: {send_err}")
-                
-                db.close()
-                
-                logger.info(f"Mensaje enviado exitosamente a {sent_count} destinatarios")
-                flash(f'Mensaje enviado a {sent_count} destinatarios', 'success')
+                broadcast_engine.ensure_started()
+                broadcast_engine.wake()
                 
+                logger.info(f"Envío masivo {job_id} encolado por {current_user.username}")
+                flash(f'Envío masivo #{job_id} en cola; el progreso está en /api/broadcast/{job_id}', 'success')
+                
+            except ValueError as type_err:
+                flash(str(type_err), 'error')
             except Exception as bot_err:
-                logger.error(f"Error con el bot de Telegram: {bot_err}")
+                logger.error(f"Error encolando envío masivo: {bot_err}")
                 logger.error(traceback.format_exc())
                 flash('Error al enviar mensajes masivos', 'error')
                 
@@ -837,46 +875,39 @@ def register_routes(app):
             flash('Error al procesar la solicitud de envío masivo', 'error')
             return redirect(url_for('bot_stats'))
             
+    @app.route('/api/broadcast/<int:job_id>')
+    @login_required
+    def get_broadcast_progress_api(job_id):
+        """API con el progreso de un envío masivo"""
+        try:
+            db = request_db()
+            progress = get_broadcast_progress(db, job_id)
+                
+            if progress is None:
+                return jsonify({'success': False, 'error': 'El envío no existe'}), 404
+                
+            return jsonify({
+                'success': True,
+                'broadcast': progress
+            })
+        except Exception as e:
+            logger.error(f"Error general en API broadcast: {e}")
+            logger.error(traceback.format_exc())
+            return jsonify({'success': False, 'error': str(e)})
+            
     @app.route('/api/bot-stats')
     @login_required
+    @cached_response()
     def get_bot_stats_api():
         """API para estadísticas del bot en tiempo real"""
         try:
             logger.info(f"Solicitud de API bot-stats por usuario: {current_user.username}")
             
-            stats = {
-                'total_users': 0,
-                'active_users': 0,
-                'total_groups': 0,
-                'total_messages': 0,
-                'activity_data': [0, 0, 0, 0, 0, 0, 0]
-            }
-            
+            # Contadores a cero si la base de datos falla, como espera la plantilla
+            stats = default_bot_stats()
             try:
-                # Obtener estadísticas actualizadas
-                db = get_db()
-                
-                stats['total_users'] = db.query(BotUser).count()
-                stats['total_groups'] = db.query(Group).count()
-                stats['total_messages'] = db.query(Message).count()
-                
-                # Usuarios activos (últimos 7 días)
-                week_ago = datetime.now() - timedelta(days=7)
-                stats['active_users'] = db.query(BotUser).filter(
-                    BotUser.created_at >= week_ago
-                ).count()
-                
-                # Datos de actividad por día de la semana
-                now = datetime.now()
-                for i in range(7):
-                    day = now - timedelta(days=i)
-                    count = db.query(Message).filter(
-                        func.date(Message.created_at) == day.date()
-                    ).count()
-                    # Guardar en orden inverso (el día más reciente primero)
-                    stats['activity_data'][6-i] = count
-                
-                db.close()
+                db = request_db()
+                stats = collect_bot_stats(db)
             except Exception as db_err:
                 logger.error(f"Error de base de datos en API bot-stats: {db_err}")
                 logger.error(traceback.format_exc())
@@ -890,6 +921,37 @@ def register_routes(app):
             logger.error(traceback.format_exc())
             return jsonify({'success': False, 'error': str(e)})
             
+    @app.route('/api/activity')
+    @login_required
+    def get_activity_api():
+        """API para la serie de actividad de mensajes (?range=30d&bucket=day)"""
+        try:
+            range_param = request.args.get('range', '7d')
+            bucket = request.args.get('bucket', 'day')
+            logger.info(f"Solicitud de API activity ({range_param}, {bucket}) por usuario: {current_user.username}")
+            
+            try:
+                span = parse_range(range_param)
+                if bucket not in BUCKETS:
+                    raise ValueError(f"Intervalo no válido: {bucket}")
+            except ValueError as param_err:
+                return jsonify({'success': False, 'error': str(param_err)}), 400
+                
+            db = request_db()
+            try:
+                series = get_activity_series(db, span, bucket)
+            except ValueError as series_err:
+                return jsonify({'success': False, 'error': str(series_err)}), 400
+                
+            return jsonify({
+                'success': True,
+                'series': series
+            })
+        except Exception as e:
+            logger.error(f"Error general en API activity: {e}")
+            logger.error(traceback.format_exc())
+            return jsonify({'success': False, 'error': str(e)})
+            
     # Rutas para estadísticas y configuración de IA
     @app.route('/ai-stats')
     @login_required
@@ -917,7 +979,7 @@ def register_routes(app):
             
             try:
                 # Obtener estadísticas de IA
-                ai = SimpleAI()
+                ai = ai_engine.get()
                 ai_stats = ai.get_stats()
                 
                 data['ai_stats'] = {
@@ -940,39 +1002,12 @@ def register_routes(app):
                     logger.error(f"Error obteniendo configuración de IA: {config_err}")
                     
                 # Obtener distribución de confianza
-                db = get_db()
-                from shared.database import AIPattern, Message
-                
-                # Distribución [0-20%, 21-40%, 41-60%, 61-80%, 81-100%]
-                confidence_ranges = [0.2, 0.4, 0.6, 0.8, 1.0]
-                
-                # Inicializar contadores
-                confidence_counts = [0, 0, 0, 0, 0]
-                
-                # Contar patrones en cada rango de confianza
-                patterns = db.query(AIPattern).all()
-                for pattern in patterns:
-                    for i, limit in enumerate(confidence_ranges):
-                        if pattern.confidence <= limit:
-                            confidence_counts[i] += 1
-                            break
-                            
-                data['confidence_distribution'] = confidence_counts
+                db = request_db()
+                data['confidence_distribution'] = get_confidence_distribution(db)
                 
                 # Obtener patrones más usados
-                top_patterns = db.query(AIPattern).order_by(
-                    desc(AIPattern.uses)
-                ).limit(10).all()
+                data['top_patterns'] = get_top_patterns(db)
                 
-                data['top_patterns'] = [{
-                    'pattern': pattern.pattern,
-                    'response': pattern.response,
-                    'confidence': pattern.confidence,
-                    'uses': pattern.uses,
-                    'last_used': pattern.last_used.strftime('%d/%m/%Y %H:%M') if pattern.last_used else None
-                } for pattern in top_patterns]
-                
-                db.close()
             except Exception as db_err:
                 logger.error(f"Error de base de datos en ai_stats: {db_err}")
                 logger.error(traceback.format_exc())
@@ -987,49 +1022,17 @@ def register_routes(app):
             
     @app.route('/api/ai-stats')
     @login_required
+    @cached_response()
     def get_ai_stats_api():
         """API para estadísticas de IA en tiempo real"""
         try:
             logger.info(f"Solicitud de API ai-stats por usuario: {current_user.username}")
             
-            stats = {
-                'patterns': 0,
-                'interactions': 0,
-                'accuracy': 0,
-                'avg_confidence': 0,
-                'confidence_distribution': [0, 0, 0, 0, 0]
-            }
-            
+            # Contadores a cero si la base de datos falla, como espera la plantilla
+            stats = default_ai_stats()
             try:
-                # Obtener estadísticas actualizadas
-                ai = SimpleAI()
-                ai_stats = ai.get_stats()
-                
-                stats['patterns'] = ai_stats.get('patterns', 0)
-                stats['interactions'] = ai_stats.get('interactions', 0)
-                stats['accuracy'] = ai_stats.get('accuracy', 0)
-                stats['avg_confidence'] = ai_stats.get('avg_confidence', 0)
-                
-                # Obtener distribución de confianza actualizada
-                db = get_db()
-                from shared.database import AIPattern
-                
-                # Distribución [0-20%, 21-40%, 41-60%, 61-80%, 81-100%]
-                confidence_ranges = [0.2, 0.4, 0.6, 0.8, 1.0]
-                
-                # Inicializar contadores
-                confidence_counts = [0, 0, 0, 0, 0]
-                
-                # Contar patrones en cada rango de confianza
-                patterns = db.query(AIPattern).all()
-                for pattern in patterns:
-                    for i, limit in enumerate(confidence_ranges):
-                        if pattern.confidence <= limit:
-                            confidence_counts[i] += 1
-                            break
-                
-                stats['confidence_distribution'] = confidence_counts
-                db.close()
+                db = request_db()
+                stats = collect_ai_stats(db)
             except Exception as db_err:
                 logger.error(f"Error de base de datos en API ai-stats: {db_err}")
                 logger.error(traceback.format_exc())
@@ -1101,16 +1104,22 @@ def register_routes(app):
             logger.info(f"Entrenamiento de IA solicitado por usuario: {current_user.username}")
             
             try:
-                # Obtener instancia de IA
-                ai = SimpleAI()
-                
-                # Realizar entrenamiento (lógica depende de la implementación)
-                # Podría ser usando datos históricos, de un archivo, etc.
-                success = True
-                message = "Entrenamiento completado correctamente"
+                # El entrenamiento corre en segundo plano; el progreso está en /api/train-ai/status
+                # (import diferido: arrastra NumPy y no debe pesar en el arranque)
+                from .training import trainer
+                status, started = trainer.start(
+                    make_session,
+                    requested_by=current_user.username,
+                    min_confidence=float(os.environ.get('MIN_CONFIDENCE', 0.7))
+                )
                 
-                logger.info("Entrenamiento de IA ejecutado exitosamente")
-                flash(message, 'success')
+                if started:
+                    if status['resumed_from']:
+                        flash(f"Entrenamiento reanudado desde {status['resumed_from']} mensajes", 'success')
+                    else:
+                        flash('Entrenamiento iniciado en segundo plano', 'success')
+                else:
+                    flash('Ya hay un entrenamiento en curso', 'info')
             except Exception as train_err:
                 logger.error(f"Error entrenando IA: {train_err}")
                 logger.error(traceback.format_exc())
@@ -1123,6 +1132,18 @@ def register_routes(app):
             flash('Error al procesar la solicitud de entrenamiento', 'error')
             return redirect(url_for('ai_stats'))
             
+    @app.route('/api/train-ai/status')
+    @login_required
+    def train_status():
+        """Progreso, velocidad (mensajes/s) y tiempo restante del entrenamiento"""
+        try:
+            from .training import trainer
+            return jsonify({'success': True, 'job': trainer.status()})
+        except Exception as e:
+            logger.error(f"Error general en train_status: {e}")
+            logger.error(traceback.format_exc())
+            return jsonify({'success': False, 'error': str(e)})
+            
     @app.route('/backup-ai', methods=['POST'])
     @login_required
     def backup_ai_knowledge():
@@ -1131,43 +1152,12 @@ def register_routes(app):
             logger.info(f"Respaldo de IA solicitado por usuario: {current_user.username}")
             
             try:
-                # Obtener datos de la base de datos
-                db = get_db()
-                from shared.database import AIPattern
-                
-                # Consultar todos los patrones
-                patterns = db.query(AIPattern).all()
-                
-                # Crear estructura de datos para el respaldo
-                backup_data = [{
-                    'pattern': p.pattern,
-                    'response': p.response,
-                    'confidence': p.confidence,
-                    'uses': p.uses,
-                    'created_at': p.created_at.isoformat() if p.created_at else None,
-                    'last_used': p.last_used.isoformat() if p.last_used else None
-                } for p in patterns]
-                
-                # Crear directorio de respaldos si no existe
+                # El respaldo se escribe en segundo plano leyendo por bloques
                 from config.config import Config
-                import os
-                backup_dir = Config.BACKUP_DIR
-                os.makedirs(backup_dir, exist_ok=True)
-                
-                # Generar nombre de archivo con timestamp
-                backup_file = os.path.join(
-                    backup_dir, 
-                    f"ai_knowledge_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                )
-                
-                # Guardar archivo
-                with open(backup_file, 'w', encoding='utf-8') as f:
-                    json.dump(backup_data, f, ensure_ascii=False, indent=4)
-                
-                logger.info(f"Respaldo de IA creado exitosamente: {backup_file}")
-                flash(f'Respaldo creado correctamente con {len(patterns)} patrones', 'success')
+                start_backup(make_session, Config.BACKUP_DIR)
                 
-                db.close()
+                logger.info(f"Respaldo de IA iniciado en {Config.BACKUP_DIR}")
+                flash('Respaldo iniciado; el archivo aparecerá en el directorio de respaldos al terminar', 'success')
             except Exception as backup_err:
                 logger.error(f"Error creando respaldo de IA: {backup_err}")
                 logger.error(traceback.format_exc())
@@ -1180,6 +1170,24 @@ def register_routes(app):
             flash('Error al procesar la solicitud de respaldo', 'error')
             return redirect(url_for('ai_stats'))
             
+    @app.route('/backup-ai/download')
+    @login_required
+    def download_ai_backup():
+        """Descarga un respaldo NDJSON.gz generado al vuelo"""
+        try:
+            logger.info(f"Descarga de respaldo de IA solicitada por usuario: {current_user.username}")
+            filename = f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}{BACKUP_SUFFIX}"
+            return Response(
+                stream_backup(make_session),
+                mimetype='application/gzip',
+                headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+            )
+        except Exception as e:
+            logger.error(f"Error general en download_ai_backup: {e}")
+            logger.error(traceback.format_exc())
+            flash('Error al descargar el respaldo de IA', 'error')
+            return redirect(url_for('ai_stats'))
+            
     @app.route('/reset-ai', methods=['POST'])
     @login_required
     def reset_ai():
@@ -1189,20 +1197,22 @@ def register_routes(app):
             
             try:
                 # Eliminar todos los patrones de la base de datos
-                db = get_db()
+                db = request_db()
                 from shared.database import AIPattern
                 
                 # Contar patrones para informar al usuario
                 pattern_count = db.query(AIPattern).count()
                 
-                # Eliminar todos los patrones
+                # Eliminar todos los patrones; la marca fuerza un respaldo completo después
                 db.query(AIPattern).delete()
+                record_change(db.connection(), OP_TRUNCATE)
                 db.commit()
+                ai_engine.index_clear()
+                clear_response_cache()
                 
                 logger.info(f"Sistema de IA reiniciado: {pattern_count} patrones eliminados")
                 flash(f'Sistema de IA reiniciado: {pattern_count} patrones eliminados', 'success')
                 
-                db.close()
             except Exception as reset_err:
                 logger.error(f"Error reiniciando IA: {reset_err}")
                 logger.error(traceback.format_exc())
@@ -0,0 +1,37 @@
+"""
+Directorio privado para el estado de ejecución compartido entre workers
+Snapshots del índice, métricas, ejecuciones de tests, entrenamientos,
+perfiles y ficheros de bloqueo. Por defecto vive en la carpeta instance/ de
+Flask (LBA_RUN_DIR lo cambia), no en /tmp: un directorio con nombre fijo en
+un /tmp compartido lo puede crear antes otro usuario y suplantar su contenido.
+"""
+import os
+import stat
+import logging
+
+logger = logging.getLogger('web')
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance')
+RUN_DIR = os.environ.get('LBA_RUN_DIR', os.path.join(INSTANCE_DIR, 'run'))
+
+def run_path(name):
+    """Ruta por defecto de name dentro de RUN_DIR"""
+    return os.path.join(RUN_DIR, name)
+
+def ensure_private_dir(directory):
+    """Crea directory con permisos 0700 si no existe y comprueba que es seguro usarlo
+
+    Lanza PermissionError (un OSError, como el de os.makedirs) si no es un
+    directorio propio o si otros usuarios pueden escribir en él.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{directory} no es un directorio")
+    # En Windows no hay uid y st_mode no refleja las ACL
+    if hasattr(os, 'getuid'):
+        if info.st_uid != os.getuid():
+            raise PermissionError(f"{directory} pertenece a otro usuario (uid {info.st_uid})")
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError(f"{directory} tiene permisos de escritura para otros usuarios")
+    return directory
@@ -0,0 +1,129 @@
+"""
+Arranque de la aplicación web
+Mide las fases de create_app(), perfila los imports de un arranque en frío
+y ofrece el comando de inicialización de la base de datos:
+
+    python -m web.startup init-db
+    python -m web.startup --profile-startup
+    python -m web.startup --budget 3
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Tiempo máximo (segundos) de un arranque en frío de create_app()
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', 5))
+
+_BOOT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from web.app import create_app
+imported = time.perf_counter()
+app = create_app()
+done = time.perf_counter()
+print('STARTUP ' + json.dumps({
+    'import': imported - start,
+    'create_app': done - imported,
+    'total': done - start,
+    'phases': app.config.get('STARTUP_TIMINGS', [])
+}))
+"""
+
+class StartupTimer:
+    """Acumula la duración de cada fase del arranque"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.start
+
+def _parse_importtime(stderr):
+    """Convierte la salida de -X importtime en [(módulo, propio, acumulado)] en segundos"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            own, cumulative, name = line[len('import time:'):].split('|')
+            modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+        except ValueError:
+            continue
+    return modules
+
+def measure_startup(importtime=False):
+    """Arranca create_app() en un intérprete nuevo y devuelve sus tiempos"""
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', _BOOT_SCRIPT]
+
+    env = dict(os.environ, BROADCAST_ENGINE='0')
+    process = subprocess.run(command, capture_output=True, text=True, env=env)
+    report = None
+    for line in process.stdout.splitlines():
+        if line.startswith('STARTUP '):
+            report = json.loads(line[len('STARTUP '):])
+    if report is None:
+        raise RuntimeError(f"create_app() falló:\n{process.stderr[-2000:]}")
+    if importtime:
+        report['modules'] = _parse_importtime(process.stderr)
+    return report
+
+def check_startup_budget(budget=STARTUP_BUDGET):
+    """Falla (AssertionError) si un arranque en frío supera el presupuesto
+
+    Pensado para usarse desde una prueba: check_startup_budget(3.0)
+    """
+    report = measure_startup()
+    assert report['total'] <= budget, (
+        f"create_app() tardó {report['total']:.2f}s (presupuesto {budget:.2f}s): {report['phases']}"
+    )
+    return report
+
+def _print_report(report, top):
+    print(f"Import de web.app: {report['import']:.3f}s")
+    print(f"create_app():      {report['create_app']:.3f}s")
+    print(f"Total:             {report['total']:.3f}s")
+    print("\nFases de create_app():")
+    for phase, seconds in report['phases']:
+        print(f"  {phase:<16} {seconds:.3f}s")
+    if report.get('modules'):
+        print(f"\nMódulos más lentos (acumulado, top {top}):")
+        for name, own, cumulative in sorted(report['modules'], key=lambda m: m[2], reverse=True)[:top]:
+            print(f"  {cumulative:8.3f}s  (propio {own:.3f}s)  {name}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arranque de la aplicación web")
+    parser.add_argument('command', nargs='?', choices=['init-db'], help="Inicializa el esquema y el usuario admin")
+    parser.add_argument('--profile-startup', action='store_true', help="Tiempo de import y arranque por módulo y fase")
+    parser.add_argument('--top', type=int, default=25, help="Módulos a mostrar con --profile-startup")
+    parser.add_argument('--budget', type=float, help="Falla si el arranque supera estos segundos")
+    args = parser.parse_args(argv)
+
+    if args.command == 'init-db':
+        from web.app import create_app, init_database
+        init_database(create_app(check_database=False))
+        print("Base de datos inicializada")
+        return 0
+
+    report = measure_startup(importtime=args.profile_startup)
+    _print_report(report, args.top)
+    if args.budget is not None and report['total'] > args.budget:
+        print(f"\nERROR: el arranque ({report['total']:.3f}s) supera el presupuesto de {args.budget:.3f}s")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
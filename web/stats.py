@@ -0,0 +1,315 @@
+"""
+Agregación de estadísticas para la aplicación web
+Calcula los contadores de moderación con un número fijo de consultas
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, cast, case, desc, Index, String
+from .rollup import read_global_counters, read_group_counters
+from .activity import get_activity_series
+from .ai_engine import ai_engine
+
+logger = logging.getLogger('web')
+
+# Marca de "contadores del rollup aún no leídos" (None significa que no hay rollup)
+_UNREAD = object()
+
+def rollup_counters(db):
+    """Lee los contadores globales del rollup sin romper si la tabla no existe"""
+    try:
+        return read_global_counters(db)
+    except Exception as e:
+        logger.warning(f"group_stats_rollup no disponible, se cuenta desde las tablas: {e}")
+        db.rollback()
+        return None
+
+def get_moderation_totals(db, counters=_UNREAD):
+    """Obtiene los totales de grupos, acciones y advertencias en una sola consulta
+
+    counters permite reutilizar los contadores del rollup ya leídos.
+    """
+    from shared.database import Group, ModAction, Warning
+    if counters is _UNREAD:
+        counters = rollup_counters(db)
+    if counters is not None:
+        return {
+            'total_groups': db.query(func.count(Group.id)).scalar() or 0,
+            'total_actions': counters['actions'],
+            'total_warnings': counters['warnings']
+        }
+
+    total_groups = db.query(func.count(Group.id)).scalar_subquery()
+    total_actions = db.query(func.count(ModAction.id)).scalar_subquery()
+    total_warnings = db.query(func.count(Warning.id)).scalar_subquery()
+
+    row = db.query(total_groups, total_actions, total_warnings).one()
+    return {
+        'total_groups': row[0] or 0,
+        'total_actions': row[1] or 0,
+        'total_warnings': row[2] or 0
+    }
+
+def get_bot_totals(db):
+    """Obtiene los totales de usuarios, grupos y mensajes del bot"""
+    from shared.database import Group, User as BotUser, Message
+    counters = rollup_counters(db)
+    if counters is not None:
+        return {
+            'total_users': counters['users'],
+            'total_groups': db.query(func.count(Group.id)).scalar() or 0,
+            'total_messages': counters['messages']
+        }
+
+    total_users = db.query(func.count(BotUser.id)).scalar_subquery()
+    total_groups = db.query(func.count(Group.id)).scalar_subquery()
+    total_messages = db.query(func.count(Message.id)).scalar_subquery()
+
+    row = db.query(total_users, total_groups, total_messages).one()
+    return {
+        'total_users': row[0] or 0,
+        'total_groups': row[1] or 0,
+        'total_messages': row[2] or 0
+    }
+
+def _count_group_stats(db):
+    """Calcula los contadores por grupo con GROUP BY sobre las tablas originales"""
+    from shared.database import Group, ModAction, Warning
+    warnings_sq = db.query(
+        Warning.group_id.label('group_id'),
+        func.count(Warning.id).label('total')
+    ).group_by(Warning.group_id).subquery()
+
+    actions_sq = db.query(
+        ModAction.group_id.label('group_id'),
+        func.count(ModAction.id).label('total')
+    ).group_by(ModAction.group_id).subquery()
+
+    # group_id se guarda como texto (str(chat_id)) en warnings y mod_actions
+    chat_key = cast(Group.chat_id, String)
+
+    return db.query(
+        Group,
+        func.coalesce(warnings_sq.c.total, 0),
+        func.coalesce(actions_sq.c.total, 0)
+    ).outerjoin(
+        warnings_sq, warnings_sq.c.group_id == chat_key
+    ).outerjoin(
+        actions_sq, actions_sq.c.group_id == chat_key
+    ).all()
+
+def get_group_stats(db, counters=_UNREAD):
+    """Obtiene advertencias y acciones de todos los grupos
+
+    Si group_stats_rollup está construida se leen O(grupos) filas; si no, los
+    contadores se calculan con GROUP BY group_id unido a la tabla de grupos.
+    En ambos casos el número de consultas no depende del número de grupos.
+    counters son los contadores globales ya leídos, si los hay.
+    """
+    if counters is _UNREAD:
+        counters = rollup_counters(db)
+    if counters is not None:
+        rows = read_group_counters(db)
+    else:
+        rows = _count_group_stats(db)
+
+    group_stats = []
+    for group, warnings, actions in rows:
+        group_stats.append({
+            'title': group.title or 'Sin nombre',
+            'chat_id': getattr(group, 'chat_id', 'N/A'),
+            'warnings': warnings,
+            'actions': actions,
+            'auto_mod': getattr(group, 'auto_mod', False)
+        })
+
+    logger.debug(f"Estadísticas agregadas para {len(group_stats)} grupos")
+    return group_stats
+
+# Límites superiores de los rangos [0-20%, 21-40%, 41-60%, 61-80%, 81-100%]
+CONFIDENCE_RANGES = [0.2, 0.4, 0.6, 0.8, 1.0]
+
+def _confidence_bucket(column):
+    """Expresión CASE que asigna cada confianza a su rango"""
+    return case(
+        *[(column <= limit, i) for i, limit in enumerate(CONFIDENCE_RANGES)],
+        else_=None
+    )
+
+def _distribution_from_values(values):
+    """Cuenta por rangos en Python (NumPy si está disponible)"""
+    try:
+        import numpy as np
+    except ImportError:
+        counts = [0] * len(CONFIDENCE_RANGES)
+        for value in values:
+            for i, limit in enumerate(CONFIDENCE_RANGES):
+                if value <= limit:
+                    counts[i] += 1
+                    break
+        return counts
+
+    array = np.fromiter(values, dtype=float)
+    indexes = np.searchsorted(CONFIDENCE_RANGES, array, side='left')
+    indexes = indexes[indexes < len(CONFIDENCE_RANGES)]
+    return np.bincount(indexes, minlength=len(CONFIDENCE_RANGES)).tolist()
+
+def get_confidence_distribution(db):
+    """Distribución de patrones por confianza calculada en la base de datos"""
+    from shared.database import AIPattern
+
+    bucket = _confidence_bucket(AIPattern.confidence).label('bucket')
+    try:
+        rows = db.query(bucket, func.count()).group_by(bucket).all()
+    except Exception as e:
+        logger.warning(f"Distribución de confianza no disponible en SQL, se calcula en Python: {e}")
+        db.rollback()
+        values = (c for (c,) in db.query(AIPattern.confidence).filter(
+            AIPattern.confidence.isnot(None)
+        ).yield_per(10000))
+        return _distribution_from_values(values)
+
+    counts = [0] * len(CONFIDENCE_RANGES)
+    for index, total in rows:
+        if index is not None:
+            counts[int(index)] = total
+    return counts
+
+def get_top_patterns(db, limit=10):
+    """Patrones más usados, leyendo solo las columnas necesarias (usa ix_ai_patterns_uses)"""
+    from shared.database import AIPattern
+
+    rows = db.query(
+        AIPattern.pattern,
+        AIPattern.response,
+        AIPattern.confidence,
+        AIPattern.uses,
+        AIPattern.last_used
+    ).order_by(desc(AIPattern.uses)).limit(limit).all()
+
+    return [{
+        'pattern': row.pattern,
+        'response': row.response,
+        'confidence': row.confidence,
+        'uses': row.uses,
+        'last_used': row.last_used.strftime('%d/%m/%Y %H:%M') if row.last_used else None
+    } for row in rows]
+
+def ensure_pattern_indexes(bind):
+    """Crea los índices de ai_patterns para los patrones más usados y la paginación por clave"""
+    from shared.database import AIPattern
+    from .patterns import SORTS, sort_expression
+
+    table = AIPattern.__table__
+    Index('ix_ai_patterns_uses', table.c.uses).create(bind=bind, checkfirst=True)
+    for sort in SORTS:
+        index = Index(f'ix_ai_patterns_{sort}_keyset', sort_expression(sort), table.c.id)
+        index.create(bind=bind, checkfirst=True)
+
+def default_stats():
+    """Contenido de /api/stats con todos los contadores a cero"""
+    return {
+        'total_groups': 0,
+        'total_actions': 0,
+        'total_warnings': 0,
+        'total_users': 0,
+        'total_messages': 0,
+        'grupos_activos': 0,
+        'advertencias': 0,
+        'patrones_aprendidos': 0,
+        'precisión': 0,
+        'ai_stats': {
+            'patterns': 0,
+            'responses': 0,
+            'accuracy': 0
+        },
+        'group_stats': []
+    }
+
+def collect_stats(db):
+    """Construye el contenido de /api/stats"""
+    stats = default_stats()
+    counters = rollup_counters(db)
+    stats.update(get_moderation_totals(db, counters))
+    stats['grupos_activos'] = stats['total_groups']
+    stats['advertencias'] = stats['total_warnings']
+
+    # Datos de IA
+    try:
+        ai_data = ai_engine.get().get_stats()
+        stats['ai_stats'] = ai_data
+        stats['patrones_aprendidos'] = ai_data.get('patterns', 0)
+        stats['precisión'] = ai_data.get('accuracy', 0)
+    except Exception as ai_err:
+        logger.error(f"Error obteniendo stats de IA en API: {ai_err}")
+
+    # Datos de grupos
+    try:
+        stats['group_stats'] = get_group_stats(db, counters)
+    except Exception as groups_err:
+        logger.error(f"Error obteniendo grupos en API: {groups_err}")
+
+    return stats
+
+def default_bot_stats():
+    """Contenido de /api/bot-stats con todos los contadores a cero"""
+    return {
+        'total_users': 0,
+        'active_users': 0,
+        'total_groups': 0,
+        'total_messages': 0,
+        'activity_data': [0, 0, 0, 0, 0, 0, 0]
+    }
+
+def collect_bot_stats(db):
+    """Construye el contenido de /api/bot-stats"""
+    from shared.database import User as BotUser
+    stats = default_bot_stats()
+    stats.update(get_bot_totals(db))
+
+    # Usuarios activos (últimos 7 días)
+    week_ago = datetime.now() - timedelta(days=7)
+    stats['active_users'] = db.query(func.count(BotUser.id)).filter(
+        BotUser.created_at >= week_ago
+    ).scalar() or 0
+
+    # Datos de actividad de los últimos 7 días
+    series = get_activity_series(db, timedelta(days=7), 'day')
+    stats['activity_days'] = series['labels']
+    stats['activity_data'] = series['data']
+
+    return stats
+
+def default_ai_stats():
+    """Contenido de /api/ai-stats con todos los contadores a cero"""
+    return {
+        'patterns': 0,
+        'interactions': 0,
+        'accuracy': 0,
+        'avg_confidence': 0,
+        'confidence_distribution': [0, 0, 0, 0, 0]
+    }
+
+def collect_ai_stats(db):
+    """Construye el contenido de /api/ai-stats"""
+    stats = default_ai_stats()
+    ai_stats = ai_engine.get().get_stats()
+    stats['patterns'] = ai_stats.get('patterns', 0)
+    stats['interactions'] = ai_stats.get('interactions', 0)
+    stats['accuracy'] = ai_stats.get('accuracy', 0)
+    stats['avg_confidence'] = ai_stats.get('avg_confidence', 0)
+
+    stats['confidence_distribution'] = get_confidence_distribution(db)
+    return stats
+
+def collect_snapshot(db):
+    """Instantánea completa de estadísticas para el canal SSE"""
+    snapshot = {}
+    for section, collect in (('stats', collect_stats),
+                             ('bot_stats', collect_bot_stats),
+                             ('ai_stats', collect_ai_stats)):
+        try:
+            snapshot[section] = collect(db)
+        except Exception as e:
+            logger.error(f"Error calculando la sección {section} de la instantánea: {e}")
+            db.rollback()
+    return snapshot
@@ -0,0 +1,152 @@
+"""
+Canal Server-Sent Events para las estadísticas del panel
+Un único productor por proceso calcula cada instantánea y la reparte a todos los clientes
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('web')
+
+def diff_snapshot(old, new):
+    """Devuelve solo los campos de cada sección que cambiaron"""
+    changes = {}
+    for section, values in new.items():
+        previous = old.get(section, {})
+        changed = {k: v for k, v in values.items() if previous.get(k) != v}
+        if changed:
+            changes[section] = changed
+    return changes
+
+def format_event(event_id, event, data):
+    """Serializa un evento en formato text/event-stream"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n"
+
+class StatsBroadcaster:
+    """Calcula instantáneas periódicas y las difunde a los suscriptores
+
+    El productor solo trabaja mientras hay clientes conectados, así que la
+    carga en la base de datos no depende del número de pestañas abiertas.
+    Los últimos eventos se guardan para reanudar con Last-Event-ID.
+
+    Los ids de evento son "<milisegundos>-<pid>": crecientes en todos los
+    workers y distintos entre ellos. Cada proceso calcula sus propias
+    diferencias, así que solo se reanuda desde un id que este proceso emitió;
+    si el cliente vuelve a conectar con otro worker recibe la instantánea completa.
+    """
+
+    def __init__(self, producer, interval=30, history=100, heartbeat=15):
+        self._producer = producer
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self._history = deque(maxlen=history)
+        self._condition = threading.Condition()
+        self._snapshot = {}
+        self._event_id = None
+        self._timestamp = 0
+        # Posición del último evento en este proceso (los ids no son consecutivos)
+        self._seq = 0
+        self._subscribers = 0
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Los hilos no sobreviven al fork de gunicorn: arrancar uno por proceso
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='stats-broadcaster', daemon=True)
+        self._thread.start()
+        logger.info(f"Productor de estadísticas iniciado en el proceso {self._pid}")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._subscribers == 0:
+                    self._condition.wait()
+
+            start_time = time.time()
+            try:
+                self.publish(self._producer())
+            except Exception as e:
+                logger.error(f"Error calculando instantánea de estadísticas: {e}")
+
+            elapsed = time.time() - start_time
+            time.sleep(max(self.interval - elapsed, 1))
+
+    def publish(self, snapshot):
+        """Registra una nueva instantánea y notifica los campos que cambiaron"""
+        with self._condition:
+            changes = diff_snapshot(self._snapshot, snapshot)
+            if not changes:
+                return None
+            self._snapshot = snapshot
+            self._timestamp = max(self._timestamp + 1, int(time.time() * 1000))
+            self._event_id = f"{self._timestamp}-{os.getpid()}"
+            self._seq += 1
+            self._history.append((self._seq, self._event_id, changes))
+            self._condition.notify_all()
+            return self._event_id
+
+    def _replay(self, last_event_id):
+        """(posición, eventos posteriores a last_event_id), o None si este proceso no lo emitió
+        o ya no está en el historial
+        """
+        if last_event_id is None:
+            return None
+        for seq, event_id, _ in self._history:
+            if event_id == last_event_id:
+                return seq, [(event_id, changes) for later, event_id, changes in self._history if later > seq]
+        return None
+
+    def subscribe(self, last_event_id=None):
+        """Generador de eventos SSE para un cliente"""
+        with self._condition:
+            self._subscribers += 1
+            self._ensure_started()
+            self._condition.notify_all()
+
+        try:
+            with self._condition:
+                replay = self._replay(last_event_id)
+                if replay is None:
+                    # Sin historial suficiente: enviar la instantánea completa
+                    if not self._snapshot:
+                        self._condition.wait(self.heartbeat)
+                    initial = [('snapshot', self._event_id, self._snapshot)] if self._snapshot else []
+                else:
+                    initial = [('update', event_id, changes) for event_id, changes in replay[1]]
+                cursor = self._seq
+
+            yield "retry: 5000\n\n"
+            for event, event_id, data in initial:
+                yield format_event(event_id, event, data)
+
+            while True:
+                with self._condition:
+                    if self._seq == cursor:
+                        self._condition.wait(self.heartbeat)
+                    pending = [(seq, event_id, changes) for seq, event_id, changes in self._history if seq > cursor]
+                    if pending and pending[0][0] != cursor + 1:
+                        # El cliente se quedó atrás más que el historial
+                        pending = None
+                        snapshot = self._snapshot
+                    else:
+                        pending = [(event_id, changes) for _, event_id, changes in pending]
+                    cursor = self._seq
+                    event_id = self._event_id
+
+                if pending is None:
+                    yield format_event(event_id, 'snapshot', snapshot)
+                elif pending:
+                    for event_id, changes in pending:
+                        yield format_event(event_id, 'update', changes)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            with self._condition:
+                self._subscribers -= 1
@@ -0,0 +1,17 @@
+"""
+Utilidades de pytest para la aplicación web
+Activar en las pruebas con: pytest_plugins = ['web.testing']
+"""
+import pytest
+from .dbaudit import query_budget as _query_budget, install_query_auditor
+
+@pytest.fixture
+def query_budget():
+    """Limita el número de consultas de un bloque
+
+    def test_dashboard(client, query_budget):
+        with query_budget(15):
+            client.get('/dashboard')
+    """
+    install_query_auditor()
+    return _query_budget
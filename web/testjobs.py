@@ -0,0 +1,364 @@
+"""
+Ejecución de pruebas en segundo plano para /test
+Reparte la suite en varios procesos, transmite la salida en vivo y guarda
+el resultado por hash del código fuente para no repetir ejecuciones.
+
+El estado y la salida de cada ejecución se escriben en TEST_JOBS_DIR, así
+que cualquier worker puede transmitir una ejecución lanzada por otro.
+"""
+import os
+import sys
+import json
+import time
+import re
+import uuid
+import hashlib
+import logging
+import threading
+import subprocess
+from datetime import datetime
+from .filelock import FileLock
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+TEST_DIR = 'test'
+TEST_TIMEOUT = int(os.environ.get('TEST_TIMEOUT', 300))
+SHARDS = int(os.environ.get('TEST_SHARDS', os.cpu_count() or 1))
+JOBS_DIR = os.environ.get('TEST_JOBS_DIR', run_path('test_jobs'))
+# Ejecuciones terminadas que se conservan en disco
+MAX_JOBS = int(os.environ.get('TEST_MAX_JOBS', 20))
+# Segundos durante los que se reutiliza la huella del código fuente
+TREE_HASH_TTL = float(os.environ.get('TEST_TREE_HASH_TTL', 30))
+# Límite de líneas guardadas por ejecución
+MAX_LINES = 100000
+# Espera entre lecturas del fichero de salida al transmitir
+STREAM_POLL = 0.5
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+SKIP_DIRS = {'.git', '__pycache__', '.venv', 'venv', '.pytest_cache', 'node_modules'}
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+
+def source_tree_hash(root='.'):
+    """Huella del código fuente: ruta, tamaño y fecha de cada fichero .py"""
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def shard_test_files(test_dir, shards):
+    """Reparte los ficheros de prueba en grupos de tamaño similar"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(test_dir):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for filename in filenames:
+            if filename.startswith('test_') and filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                files.append((os.path.getsize(path), path))
+
+    groups = [[0, []] for _ in range(max(1, min(shards, len(files))))]
+    for size, path in sorted(files, reverse=True):
+        group = min(groups, key=lambda g: g[0])
+        group[0] += size
+        group[1].append(path)
+    return [paths for _, paths in groups if paths]
+
+class TestJob:
+    """Ejecución de la suite: estado en <id>.json y salida en <id>.log
+
+    El proceso que la ejecuta mantiene el bloqueo <id>.lock; si muere, la
+    ejecución se da por terminada con fallo al leerla desde otro proceso.
+    """
+
+    def __init__(self, directory, tree_hash, requested_by=None, job_id=None):
+        self.directory = directory
+        self.id = job_id or uuid.uuid4().hex
+        self.tree_hash = tree_hash
+        self.requested_by = requested_by
+        self.status = STATUS_RUNNING
+        self.success = None
+        self.cached = False
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self._line_count = 0
+        self._log = None
+        self._run_lock = None
+        self._write_lock = threading.Lock()
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, self.id + suffix)
+
+    @property
+    def log_path(self):
+        return self._path('.log')
+
+    def begin(self):
+        """Toma el bloqueo de la ejecución y abre su fichero de salida"""
+        self._run_lock = FileLock(self._path('.lock'))
+        self._run_lock.acquire()
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        self.save()
+
+    def append(self, line):
+        with self._write_lock:
+            if self._log is None or self._line_count >= MAX_LINES:
+                return
+            # Una sola escritura por línea: los lectores nunca ven media línea con su salto
+            self._log.write(line.replace('\n', ' ') + '\n')
+            self._log.flush()
+            self._line_count += 1
+
+    def finish(self, success):
+        with self._write_lock:
+            self.success = success
+            self.status = STATUS_DONE
+            self.finished_at = datetime.now()
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        self.save()
+        if self._run_lock is not None:
+            self._run_lock.release()
+            self._run_lock = None
+
+    def save(self):
+        path = self._path('.json')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @property
+    def output(self):
+        try:
+            with open(self.log_path, encoding='utf-8') as f:
+                return f.read().rstrip('\n')
+        except OSError:
+            return ''
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tree_hash': self.tree_hash,
+            'requested_by': self.requested_by,
+            'status': self.status,
+            'success': self.success,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    @classmethod
+    def load(cls, directory, job_id):
+        """Lee una ejecución del disco; None si no existe"""
+        if not _JOB_ID_RE.match(job_id or ''):
+            return None
+        try:
+            with open(os.path.join(directory, f"{job_id}.json"), encoding='utf-8') as f:
+                data = json.load(f)
+            job = cls(directory, data['tree_hash'], data.get('requested_by'), job_id=data['id'])
+            job.status = data['status']
+            job.success = data['success']
+            job.started_at = datetime.fromisoformat(data['started_at'])
+            job.finished_at = datetime.fromisoformat(data['finished_at']) if data['finished_at'] else None
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if job.status == STATUS_RUNNING and not job._runner_alive():
+            job.status = STATUS_DONE
+            job.success = False
+        return job
+
+    def _runner_alive(self):
+        probe = FileLock(self._path('.lock'))
+        if probe.acquire(blocking=False):
+            probe.release()
+            return False
+        return True
+
+    def remove(self):
+        for suffix in ('.json', '.log', '.lock'):
+            try:
+                os.remove(self._path(suffix))
+            except FileNotFoundError:
+                pass
+
+class TestRunner:
+    """Lanza ejecuciones de pruebas y las recupera desde el disco en cualquier worker"""
+
+    def __init__(self, root='.', test_dir=TEST_DIR, shards=SHARDS, timeout=TEST_TIMEOUT,
+                 jobs_dir=JOBS_DIR, max_jobs=MAX_JOBS, tree_hash_ttl=TREE_HASH_TTL):
+        self.root = root
+        self.test_dir = test_dir
+        self.shards = shards
+        self.timeout = timeout
+        self.jobs_dir = jobs_dir
+        self.max_jobs = max_jobs
+        self.tree_hash_ttl = tree_hash_ttl
+        self._tree_hash = None
+        self._tree_hash_at = 0
+        self._lock = threading.Lock()
+
+    def tree_hash(self):
+        """source_tree_hash() reutilizada durante tree_hash_ttl segundos"""
+        with self._lock:
+            now = time.monotonic()
+            if self._tree_hash is None or now - self._tree_hash_at >= self.tree_hash_ttl:
+                self._tree_hash = source_tree_hash(self.root)
+                self._tree_hash_at = now
+            return self._tree_hash
+
+    def get(self, job_id):
+        return TestJob.load(self.jobs_dir, job_id)
+
+    def jobs(self):
+        """Ejecuciones guardadas, de la más reciente a la más antigua"""
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            return []
+        jobs = [self.get(name[:-len('.json')]) for name in names if name.endswith('.json')]
+        return sorted((job for job in jobs if job is not None), key=lambda job: job.started_at, reverse=True)
+
+    def _prune(self, jobs):
+        """Borra las ejecuciones terminadas que exceden max_jobs"""
+        finished = [job for job in jobs if job.status == STATUS_DONE]
+        for job in finished[self.max_jobs:]:
+            job.remove()
+
+    def start(self, requested_by=None, force=False):
+        """Devuelve el resultado en caché, la ejecución en curso o una nueva"""
+        tree_hash = self.tree_hash()
+        ensure_private_dir(self.jobs_dir)
+        with FileLock(os.path.join(self.jobs_dir, 'start.lock')):
+            jobs = self.jobs()
+            for job in jobs:
+                if job.tree_hash == tree_hash and (job.status == STATUS_RUNNING or not force):
+                    job.cached = job.status == STATUS_DONE
+                    return job
+
+            job = TestJob(self.jobs_dir, tree_hash, requested_by)
+            job.begin()
+            self._prune(jobs)
+
+        threading.Thread(target=self._run, args=(job,), name=f'test-job-{job.id[:8]}', daemon=True).start()
+        logger.info(f"Ejecución de pruebas {job.id} iniciada por {requested_by}")
+        return job
+
+    def _run(self, job):
+        start_time = time.time()
+        success = False
+        try:
+            success = self._run_shards(job, start_time)
+        except Exception as e:
+            job.append(f"ERROR: {e}")
+            logger.error(f"Error en la ejecución de pruebas {job.id}: {e}")
+        finally:
+            job.append(f"Pruebas terminadas en {time.time() - start_time:.1f}s")
+            job.finish(success)
+        logger.info(f"Ejecución de pruebas {job.id} terminada con resultado: {'éxito' if success else 'fallo'}")
+
+    def _run_shards(self, job, start_time):
+        shards = shard_test_files(os.path.join(self.root, self.test_dir), self.shards)
+        if not shards:
+            shards = [[self.test_dir]]
+        job.append(f"Ejecutando pruebas en {len(shards)} procesos (límite {self.timeout}s)")
+
+        processes = []
+        readers = []
+        for index, paths in enumerate(shards, 1):
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'pytest', '-v', *paths],
+                cwd=self.root,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1
+            )
+            prefix = f"[{index}] " if len(shards) > 1 else ''
+            reader = threading.Thread(target=self._pump, args=(job, process, prefix), daemon=True)
+            reader.start()
+            processes.append(process)
+            readers.append(reader)
+
+        success = True
+        deadline = start_time + self.timeout
+        for process in processes:
+            try:
+                process.wait(timeout=max(deadline - time.time(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                job.append(f"ERROR: Timeout al ejecutar las pruebas (más de {self.timeout} segundos)")
+            success = success and process.returncode == 0
+        for reader in readers:
+            reader.join()
+        return success
+
+    @staticmethod
+    def _pump(job, process, prefix):
+        for line in process.stdout:
+            job.append(prefix + line.rstrip('\n'))
+        process.stdout.close()
+
+def stream_job(job, offset=0, heartbeat=15, poll=STREAM_POLL):
+    """Genera la salida de una ejecución como eventos SSE a partir de la línea offset
+
+    Lee el fichero de salida, por lo que sirve aunque la ejecución corra en
+    otro worker; el estado se vuelve a leer del disco en cada espera.
+    """
+    yield "retry: 3000\n\n"
+    try:
+        log = open(job.log_path, encoding='utf-8')
+    except OSError:
+        log = None
+
+    try:
+        skipped = 0
+        while log is not None and skipped < offset and log.readline():
+            skipped += 1
+        offset = skipped
+
+        idle = 0.0
+        while True:
+            done = job.status == STATUS_DONE
+            sent = False
+            while log is not None:
+                position = log.tell()
+                line = log.readline()
+                if not line.endswith('\n'):
+                    # Línea todavía a medio escribir (o fin del fichero)
+                    log.seek(position)
+                    break
+                offset += 1
+                sent = True
+                yield f"id: {offset}\nevent: line\ndata: {json.dumps(line[:-1], ensure_ascii=False)}\n\n"
+
+            if done:
+                yield f"event: done\ndata: {json.dumps({'success': job.success, 'cached': job.cached})}\n\n"
+                return
+
+            if sent:
+                idle = 0.0
+            elif idle >= heartbeat:
+                idle = 0.0
+                yield ": keepalive\n\n"
+            time.sleep(poll)
+            idle += poll
+
+            current = TestJob.load(job.directory, job.id)
+            if current is None:
+                return
+            job.status, job.success = current.status, current.success
+    finally:
+        if log is not None:
+            log.close()
+
+test_runner = TestRunner()
@@ -0,0 +1,468 @@
+"""
+Índice TF-IDF incremental de patrones de IA
+Matriz dispersa en arrays de numpy (formato COO por filas) que admite altas,
+modificaciones y borrados de un solo patrón sin reconstruir el índice. El IDF
+se recalcula de forma perezosa y las filas borradas se compactan periódicamente.
+
+Lo usa el panel web a través de ai_engine; el emparejador de SimpleAI que
+responde en el bot es independiente y no pasa por este índice.
+"""
+import os
+import re
+import math
+import logging
+import threading
+from collections import Counter, namedtuple
+import numpy as np
+from .postings import PostingsSnapshot, expand_ranges, top_k_per_row
+
+logger = logging.getLogger('web')
+
+# Fracción de filas borradas que dispara la compactación
+COMPACT_RATIO = float(os.environ.get('AI_INDEX_COMPACT_RATIO', 0.25))
+COMPACT_MIN_DEAD = int(os.environ.get('AI_INDEX_COMPACT_MIN_DEAD', 1000))
+# Cambios (respecto a los patrones vivos) tolerados antes de recalcular el IDF
+IDF_REWEIGHT_RATIO = float(os.environ.get('AI_INDEX_IDF_REWEIGHT_RATIO', 0.1))
+# Patrones a partir de los cuales las búsquedas usan el índice invertido
+PRUNE_MIN_PATTERNS = int(os.environ.get('AI_INDEX_PRUNE_MIN', 10000))
+# Entradas nuevas (respecto a la instantánea) que obligan a reconstruir el índice invertido
+POSTINGS_REBUILD_RATIO = float(os.environ.get('AI_INDEX_POSTINGS_REBUILD_RATIO', 0.1))
+# Productos parciales (consulta x posting) que se materializan como máximo a la vez en search_batch
+BATCH_MAX_PRODUCTS = int(os.environ.get('AI_BATCH_MAX_PRODUCTS', 5000000))
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+Match = namedtuple('Match', 'pattern_id pattern response confidence score')
+
+def tokenize(text):
+    """Términos en minúsculas de un texto"""
+    return _TOKEN_RE.findall((text or '').lower())
+
+def _tf_weight(count):
+    # TF sublineal: 1 + log(tf)
+    return 1.0 + math.log(count)
+
+class _Buffer:
+    """Array de numpy que crece por duplicación (append amortizado O(1))"""
+
+    def __init__(self, dtype, capacity=1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            grown = np.zeros(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        return self.data[:self.size]
+
+    def replace(self, values):
+        self.data = np.array(values, dtype=self.data.dtype)
+        self.size = len(self.data)
+        if not self.size:
+            self.data = np.zeros(1024, dtype=self.data.dtype)
+
+class TfidfIndex:
+    """Índice TF-IDF de patrones con puntuación coseno vectorizada
+
+    Cada patrón ocupa una fila (slot). Las entradas no nulas se guardan como
+    arrays paralelos rows/cols/tf/weights; weights ya está normalizado por la
+    norma de la fila, así que el coseno con una consulta es una suma por filas.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Vacía el índice"""
+        with self._lock:
+            self._vocab = {}
+            self._df = _Buffer(np.int32)
+            self._idf = _Buffer(np.float32)
+            self._rows = _Buffer(np.int32)
+            self._cols = _Buffer(np.int32)
+            self._tf = _Buffer(np.float32)
+            self._weights = _Buffer(np.float32)
+            self._starts = _Buffer(np.int64)
+            self._lengths = _Buffer(np.int32)
+            self._alive = _Buffer(np.bool_)
+            self._ids = []
+            self._payload = []
+            self._slot_of = {}
+            self._dead = 0
+            self._pending = 0
+            self._postings = None
+            self.compactions = 0
+            self.reweights = 0
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, pattern_id):
+        return pattern_id in self._slot_of
+
+    @property
+    def vocabulary_size(self):
+        return len(self._vocab)
+
+    def _idf_value(self, df):
+        # IDF suavizado: log((1 + N) / (1 + df)) + 1
+        return math.log((1.0 + len(self._slot_of)) / (1.0 + df)) + 1.0
+
+    def _term_ids(self, counts, create):
+        term_ids = []
+        weights = []
+        for term, count in counts.items():
+            term_id = self._vocab.get(term)
+            if term_id is None:
+                if not create:
+                    continue
+                term_id = self._vocab[term] = len(self._vocab)
+                self._df.extend((0,))
+                self._idf.extend((0.0,))
+            term_ids.append(term_id)
+            weights.append(_tf_weight(count))
+        return np.array(term_ids, dtype=np.int32), np.array(weights, dtype=np.float32)
+
+    def add(self, pattern_id, pattern, response=None, confidence=None, counts=None):
+        """Añade o reemplaza un patrón; coste proporcional a su longitud
+
+        counts permite pasar las frecuencias de términos ya calculadas
+        (por ejemplo, por el pool de entrenamiento) en lugar de tokenizar.
+        """
+        with self._lock:
+            slot = self._slot_of.get(pattern_id)
+            if slot is not None:
+                if self._payload[slot] == (pattern, response, confidence):
+                    return
+                self._remove_slot(slot)
+                self._maybe_compact()
+
+            if counts is None:
+                counts = Counter(tokenize(pattern))
+            term_ids, tf = self._term_ids(counts, create=True)
+            slot = len(self._ids)
+            self._ids.append(pattern_id)
+            self._payload.append((pattern, response, confidence))
+            self._slot_of[pattern_id] = slot
+            self._alive.extend((True,))
+            self._starts.extend((self._rows.size,))
+            self._lengths.extend((len(term_ids),))
+
+            df = self._df.data
+            idf = self._idf.data
+            df[term_ids] += 1
+            # Los términos nuevos reciben su IDF al momento; el resto espera al recálculo
+            fresh = term_ids[idf[term_ids] == 0]
+            for term_id in fresh:
+                idf[term_id] = self._idf_value(df[term_id])
+
+            weights = tf * idf[term_ids]
+            norm = float(np.sqrt(np.dot(weights, weights)))
+            if norm > 0:
+                weights /= norm
+
+            self._rows.extend(np.full(len(term_ids), slot, dtype=np.int32))
+            self._cols.extend(term_ids)
+            self._tf.extend(tf)
+            self._weights.extend(weights)
+            self._pending += 1
+
+    def update(self, pattern_id, pattern, response=None, confidence=None):
+        """Alias de add(): reemplaza el patrón si ya existe"""
+        self.add(pattern_id, pattern, response, confidence)
+
+    def delete(self, pattern_id):
+        """Elimina un patrón; devuelve False si no estaba en el índice"""
+        with self._lock:
+            slot = self._slot_of.get(pattern_id)
+            if slot is None:
+                return False
+            self._remove_slot(slot)
+            self._maybe_compact()
+            return True
+
+    def _remove_slot(self, slot):
+        start = int(self._starts.data[slot])
+        end = start + int(self._lengths.data[slot])
+        self._df.data[self._cols.data[start:end]] -= 1
+        self._weights.data[start:end] = 0.0
+        self._alive.data[slot] = False
+        del self._slot_of[self._ids[slot]]
+        self._payload[slot] = None
+        self._dead += 1
+        self._pending += 1
+
+    def _maybe_compact(self):
+        if self._dead >= COMPACT_MIN_DEAD and self._dead > COMPACT_RATIO * len(self._ids):
+            self.compact()
+
+    def compact(self):
+        """Descarta las filas borradas y los términos sin documentos"""
+        with self._lock:
+            alive = self._alive.view()
+            keep_slots = np.flatnonzero(alive)
+            slot_map = np.full(len(alive), -1, dtype=np.int32)
+            slot_map[keep_slots] = np.arange(len(keep_slots), dtype=np.int32)
+
+            rows = self._rows.view()
+            keep = alive[rows]
+            df = self._df.view()
+            keep_terms = np.flatnonzero(df > 0)
+            term_map = np.full(len(df), -1, dtype=np.int32)
+            term_map[keep_terms] = np.arange(len(keep_terms), dtype=np.int32)
+
+            lengths = self._lengths.view()[keep_slots]
+            starts = np.zeros(len(keep_slots), dtype=np.int64)
+            if len(lengths):
+                starts[1:] = np.cumsum(lengths[:-1], dtype=np.int64)
+
+            self._rows.replace(slot_map[rows[keep]])
+            self._cols.replace(term_map[self._cols.view()[keep]])
+            self._tf.replace(self._tf.view()[keep])
+            self._weights.replace(np.zeros(int(keep.sum()), dtype=np.float32))
+            self._starts.replace(starts)
+            self._lengths.replace(lengths)
+            self._alive.replace(np.ones(len(keep_slots), dtype=np.bool_))
+
+            terms = sorted(self._vocab.items(), key=lambda item: item[1])
+            self._vocab = {term: int(term_map[term_id]) for term, term_id in terms if term_map[term_id] >= 0}
+            self._df.replace(df[keep_terms])
+            self._idf.replace(np.zeros(len(keep_terms), dtype=np.float32))
+
+            self._ids = [self._ids[slot] for slot in keep_slots]
+            self._payload = [self._payload[slot] for slot in keep_slots]
+            self._slot_of = {pattern_id: slot for slot, pattern_id in enumerate(self._ids)}
+            self._dead = 0
+            self.compactions += 1
+            self.reweight()
+
+    def reweight(self):
+        """Recalcula el IDF y las normas de todas las filas (O(nnz) vectorizado)"""
+        with self._lock:
+            df = self._df.view()
+            idf = (np.log((1.0 + len(self._slot_of)) / (1.0 + df)) + 1.0).astype(np.float32)
+            self._idf.data[:len(idf)] = idf
+
+            rows = self._rows.view()
+            weights = self._tf.view() * idf[self._cols.view()]
+            weights[~self._alive.view()[rows]] = 0.0
+            norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(self._ids)))
+            norms[norms == 0] = 1.0
+            self._weights.data[:len(weights)] = weights / norms[rows]
+            self._pending = 0
+            # Los pesos cambiaron: la instantánea invertida ya no sirve
+            self._postings = None
+            self.reweights += 1
+
+    def _maybe_reweight(self):
+        if self._pending and self._pending > IDF_REWEIGHT_RATIO * max(len(self._slot_of), 1):
+            self.reweight()
+
+    def query_vector(self, text):
+        """(términos, pesos normalizados) de un texto con el IDF actual"""
+        term_ids, tf = self._term_ids(Counter(tokenize(text)), create=False)
+        # Los términos cuyos patrones se borraron siguen en el vocabulario hasta
+        # compactar; con df = 0 solo inflarían la norma de la consulta
+        live = self._df.data[term_ids] > 0
+        term_ids, tf = term_ids[live], tf[live]
+        weights = tf * self._idf.data[term_ids]
+        norm = float(np.sqrt(np.dot(weights, weights)))
+        if norm > 0:
+            weights /= norm
+        return term_ids, weights
+
+    def scores(self, text):
+        """Similitud coseno del texto con cada fila del índice"""
+        with self._lock:
+            self._maybe_reweight()
+            term_ids, query = self.query_vector(text)
+            if not len(term_ids):
+                return np.zeros(len(self._ids), dtype=np.float32)
+            dense = np.zeros(len(self._vocab), dtype=np.float32)
+            dense[term_ids] = query
+            contributions = self._weights.view() * dense[self._cols.view()]
+            return np.bincount(self._rows.view(), weights=contributions, minlength=len(self._ids))
+
+    def postings(self):
+        """Índice invertido de las entradas actuales, reconstruido si quedó atrás"""
+        with self._lock:
+            snapshot = self._postings
+            if snapshot is None or self._rows.size - snapshot.nnz > POSTINGS_REBUILD_RATIO * max(snapshot.nnz, 1):
+                self._maybe_reweight()
+                snapshot = self._postings = PostingsSnapshot(
+                    self._rows.view(), self._cols.view(), self._weights.view(),
+                    len(self._ids), len(self._vocab)
+                )
+            return snapshot
+
+    def _pruned_scores(self, term_ids, query, min_score):
+        """Candidatos del índice invertido más las filas añadidas después de la instantánea"""
+        snapshot = self.postings()
+        slots, scores = snapshot.candidates(term_ids, query, min_score, self._alive.view())
+
+        start = snapshot.nnz
+        if self._rows.size > start:
+            cols = self._cols.view()[start:]
+            hit = np.isin(cols, term_ids)
+            if hit.any():
+                order = np.argsort(term_ids)
+                positions = np.searchsorted(term_ids[order], cols[hit])
+                contributions = self._weights.view()[start:][hit] * query[order][positions]
+                tail = np.bincount(
+                    self._rows.view()[start:][hit] - snapshot.n_slots,
+                    weights=contributions,
+                    minlength=len(self._ids) - snapshot.n_slots
+                )
+                tail_slots = np.flatnonzero(tail >= min_score)
+                slots = np.concatenate((slots, tail_slots + snapshot.n_slots))
+                scores = np.concatenate((scores, tail[tail_slots]))
+        return slots, scores
+
+    def search(self, text, k=5, min_score=0.0, prune=None):
+        """Los k patrones más similares al texto, de mayor a menor puntuación
+
+        Con prune (por defecto a partir de PRUNE_MIN_PATTERNS patrones) solo se
+        puntúan las filas que comparten términos con la consulta y pueden
+        alcanzar min_score; el resultado es el mismo que el exhaustivo.
+        """
+        k = max(int(k), 1)
+        with self._lock:
+            if prune is None:
+                prune = len(self._slot_of) >= PRUNE_MIN_PATTERNS
+            if prune:
+                self._maybe_reweight()
+                term_ids, query = self.query_vector(text)
+                if not len(term_ids):
+                    return []
+                slots, scores = self._pruned_scores(term_ids, query, min_score)
+                keep = scores > 0
+                slots, scores = slots[keep], scores[keep]
+            else:
+                all_scores = self.scores(text)
+                slots = np.flatnonzero(all_scores >= min_score)
+                slots = slots[all_scores[slots] > 0]
+                scores = all_scores[slots]
+
+            if len(slots) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                slots, scores = slots[top], scores[top]
+            order = np.argsort(-scores, kind='stable')
+            return [self._match(slot, score) for slot, score in zip(slots[order], scores[order])]
+
+    def query_matrix(self, texts):
+        """Vectoriza varios textos como una matriz dispersa (filas, términos, pesos)"""
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            term_ids, weights = self.query_vector(text)
+            rows.append(np.full(len(term_ids), row, dtype=np.int64))
+            cols.append(term_ids)
+            values.append(weights)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+    def _tail_products(self, snapshot, q_rows, q_cols, q_values):
+        """Productos contra las entradas añadidas después de la instantánea"""
+        start = snapshot.nnz
+        if self._rows.size <= start or not len(q_cols):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        tail_cols = self._cols.view()[start:]
+        order = np.argsort(q_cols, kind='stable')
+        sorted_cols = q_cols[order]
+        left = np.searchsorted(sorted_cols, tail_cols, side='left')
+        counts = np.searchsorted(sorted_cols, tail_cols, side='right') - left
+        matched = np.flatnonzero(counts)
+        entries = order[expand_ranges(left[matched], counts[matched])]
+        tail = start + np.repeat(matched, counts[matched])
+        values = q_values[entries] * self._weights.data[tail]
+        return q_rows[entries], self._rows.data[tail].astype(np.int64), values
+
+    def search_batch(self, texts, k=5, min_score=0.0):
+        """search() para varios textos con un solo producto disperso consultas x patrones
+
+        Devuelve una lista de resultados por texto, en el mismo orden. Los lotes
+        cuyos productos parciales superan BATCH_MAX_PRODUCTS se parten en tramos.
+        """
+        k = max(int(k), 1)
+        texts = list(texts)
+        results = [[] for _ in texts]
+        with self._lock:
+            self._maybe_reweight()
+            snapshot = self.postings()
+            q_rows, q_cols, q_values = self.query_matrix(texts)
+
+            for first, last in snapshot.batch_chunks(q_rows, q_cols, len(texts), BATCH_MAX_PRODUCTS):
+                chunk = (q_rows[first:last], q_cols[first:last], q_values[first:last])
+                self._collect_top(results, snapshot, chunk, k, min_score)
+        return results
+
+    def _collect_top(self, results, snapshot, chunk, k, min_score):
+        rows, slots, values, lookups = snapshot.products(*chunk, min_score, self._alive.view())
+        tail_rows, tail_slots, tail_values = self._tail_products(snapshot, *chunk)
+        top = top_k_per_row(
+            snapshot,
+            np.concatenate((rows, tail_rows)),
+            np.concatenate((slots, tail_slots)),
+            np.concatenate((values, tail_values)),
+            lookups, len(self._ids), k, min_score
+        )
+        for row, slot, score in zip(*top):
+            results[row].append(self._match(slot, score))
+
+    def arrays(self):
+        """Copia compactada del índice para escribirla en disco (ver modelstore)
+
+        Las filas quedan agrupadas por slot en orden: la fila del slot i ocupa
+        [starts[i], starts[i] + lengths[i]).
+        """
+        with self._lock:
+            self.compact()
+            return {
+                'terms': [term for term, _ in sorted(self._vocab.items(), key=lambda item: item[1])],
+                'df': self._df.view().copy(),
+                'idf': self._idf.view()[:len(self._vocab)].copy(),
+                'cols': self._cols.view().copy(),
+                'tf': self._tf.view().copy(),
+                'weights': self._weights.view().copy(),
+                'starts': self._starts.view().copy(),
+                'lengths': self._lengths.view().copy(),
+                'ids': list(self._ids),
+                'payload': list(self._payload)
+            }
+
+    def _match(self, slot, score):
+        pattern, response, confidence = self._payload[slot]
+        return Match(self._ids[slot], pattern, response, confidence, float(score))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'patterns': len(self._slot_of),
+                'terms': len(self._vocab),
+                'nnz': int(self._rows.size),
+                'dead_rows': self._dead,
+                'pending_changes': self._pending,
+                'compactions': self.compactions,
+                'reweights': self.reweights
+            }
+
+    @classmethod
+    def from_rows(cls, rows, counts=None):
+        """Construye el índice a partir de filas (id, patrón, respuesta, confianza)
+
+        counts: frecuencias de términos ya calculadas, por id de patrón
+        """
+        counts = counts or {}
+        index = cls()
+        with index._lock:
+            for pattern_id, pattern, response, confidence in rows:
+                index.add(pattern_id, pattern, response, confidence, counts.get(pattern_id))
+            index.reweight()
+        return index
@@ -0,0 +1,389 @@
+"""
+Entrenamiento de la IA en segundo plano para /train-ai
+Recorre los mensajes (chat_history) por bloques, tokeniza y vectoriza en un
+pool de procesos y aprende los pares mensaje/respuesta con confianza
+suficiente. Guarda puntos de control para reanudar un entrenamiento
+interrumpido y publica el resultado al terminar a través de SimpleAI.learn.
+
+El estado se escribe en AI_TRAIN_DIR para que cualquier worker pueda
+consultarlo y para que solo un proceso entrene a la vez.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from .tfidf import tokenize
+from .filelock import FileLock, is_locked
+from .rundir import run_path, ensure_private_dir
+
+logger = logging.getLogger('web')
+
+TRAIN_DIR = os.environ.get('AI_TRAIN_DIR', run_path('training'))
+# Mensajes leídos por bloque
+TRAIN_CHUNK = int(os.environ.get('AI_TRAIN_CHUNK', 2000))
+# Procesos de tokenización (0 = en el propio hilo de entrenamiento)
+TRAIN_WORKERS = int(os.environ.get('AI_TRAIN_WORKERS', max((os.cpu_count() or 2) - 1, 1)))
+# Segundos entre puntos de control
+CHECKPOINT_INTERVAL = float(os.environ.get('AI_TRAIN_CHECKPOINT_SECONDS', 30))
+# Veces que debe repetirse un mensaje para aprenderlo como patrón
+MIN_OCCURRENCES = int(os.environ.get('AI_TRAIN_MIN_OCCURRENCES', 2))
+
+STATUS_RUNNING = 'running'
+STATUS_PUBLISHING = 'publishing'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+# El proceso que entrenaba murió: el siguiente /train-ai reanuda desde el punto de control
+STATUS_INTERRUPTED = 'interrupted'
+
+STATUS_FILE = 'status.json'
+CHECKPOINT_FILE = 'checkpoint.json'
+# Pares aprendidos, una línea NDJSON por cambio; el punto de control guarda hasta qué byte vale
+LEARNED_FILE = 'learned.ndjson'
+LOCK_FILE = 'train.lock'
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def vectorize_chunk(rows, min_confidence):
+    """Tokeniza y cuenta los términos de un bloque de mensajes (se ejecuta en el pool)
+
+    Devuelve (clave, patrón, respuesta, confianza) de los mensajes con respuesta
+    y confianza >= min_confidence; la clave son los términos normalizados y
+    sirve para agrupar mensajes equivalentes.
+    """
+    vectors = []
+    for content, response, confidence in rows:
+        if not content or not response or (confidence or 0) < min_confidence:
+            continue
+        terms = tokenize(content)
+        if not terms:
+            continue
+        vectors.append((' '.join(terms), content.strip(), response.strip(), float(confidence)))
+    return vectors
+
+class TrainingJob:
+    """Progreso de un entrenamiento"""
+
+    def __init__(self, requested_by=None, min_confidence=0.7):
+        self.id = uuid.uuid4().hex
+        self.requested_by = requested_by
+        self.min_confidence = min_confidence
+        self.status = STATUS_RUNNING
+        self.last_id = 0
+        self.processed = 0
+        self.total = 0
+        self.resumed_from = 0
+        self.published = 0
+        self.error = None
+        self.started_at = datetime.now()
+        self.finished_at = None
+        # Clave normalizada -> [patrón, respuesta, confianza, apariciones]
+        self.learned = {}
+        # Claves modificadas desde el último punto de control
+        self.dirty = set()
+        self._run_started = time.monotonic()
+
+    def learn(self, vectors):
+        for key, pattern, response, confidence in vectors:
+            self.dirty.add(key)
+            entry = self.learned.get(key)
+            if entry is None:
+                self.learned[key] = [pattern, response, confidence, 1]
+                continue
+            entry[3] += 1
+            # Se conserva la respuesta con mayor confianza
+            if confidence > entry[2]:
+                entry[1], entry[2] = response, confidence
+
+    @property
+    def rate(self):
+        """Mensajes por segundo en esta ejecución (sin contar lo reanudado)"""
+        elapsed = time.monotonic() - self._run_started
+        return (self.processed - self.resumed_from) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta_seconds(self):
+        rate = self.rate
+        if self.status != STATUS_RUNNING or rate <= 0:
+            return None
+        return max(self.total - self.processed, 0) / rate
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'pid': os.getpid(),
+            'requested_by': self.requested_by,
+            'processed': self.processed,
+            'total': self.total,
+            'progress': round(100.0 * self.processed / self.total, 1) if self.total else 0.0,
+            'learned': len(self.learned),
+            'published': self.published,
+            'rate': round(self.rate, 1),
+            'eta_seconds': round(self.eta_seconds) if self.eta_seconds is not None else None,
+            'resumed_from': self.resumed_from,
+            'error': self.error,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'updated_at': datetime.now().isoformat()
+        }
+
+    def checkpoint(self, learned_offset):
+        """Metadatos del punto de control; los pares van aparte en LEARNED_FILE"""
+        return {
+            'id': self.id,
+            'requested_by': self.requested_by,
+            'min_confidence': self.min_confidence,
+            'last_id': self.last_id,
+            'processed': self.processed,
+            'started_at': self.started_at.isoformat(),
+            'learned_offset': learned_offset
+        }
+
+    @classmethod
+    def from_checkpoint(cls, data, learned):
+        job = cls(data.get('requested_by'), data['min_confidence'])
+        job.id = data['id']
+        job.last_id = data['last_id']
+        job.processed = job.resumed_from = data['processed']
+        job.started_at = datetime.fromisoformat(data['started_at'])
+        job.learned = learned
+        return job
+
+class Trainer:
+    """Lanza el entrenamiento en un hilo y publica su estado en disco"""
+
+    def __init__(self, directory=TRAIN_DIR, chunk_size=TRAIN_CHUNK, workers=TRAIN_WORKERS,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.checkpoint_interval = checkpoint_interval
+        self._job = None
+        self._lock = threading.Lock()
+        self._run_lock = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def status(self):
+        """Estado del último entrenamiento, lo lance este worker u otro"""
+        job = self._job
+        if job is not None and job.status in (STATUS_RUNNING, STATUS_PUBLISHING):
+            return job.to_dict()
+        status = _read_json(self._path(STATUS_FILE))
+        if status and status['status'] in (STATUS_RUNNING, STATUS_PUBLISHING) and not is_locked(self._path(LOCK_FILE)):
+            status['status'] = STATUS_INTERRUPTED
+            status['eta_seconds'] = None
+        return status
+
+    def start(self, session_factory, requested_by=None, min_confidence=0.7):
+        """Inicia (o reanuda desde el punto de control) un entrenamiento
+
+        Devuelve (estado, iniciado); iniciado es False si ya había uno en curso.
+        """
+        with self._lock:
+            ensure_private_dir(self.directory)
+            run_lock = FileLock(self._path(LOCK_FILE))
+            if not run_lock.acquire(blocking=False):
+                return self.status(), False
+            self._run_lock = run_lock
+
+            checkpoint = _read_json(self._path(CHECKPOINT_FILE))
+            if checkpoint and 'learned_offset' in checkpoint:
+                job = TrainingJob.from_checkpoint(checkpoint, self._read_learned(checkpoint['learned_offset']))
+                logger.info(f"Reanudando entrenamiento {job.id} desde {job.processed} mensajes")
+            else:
+                job = TrainingJob(requested_by, min_confidence)
+                self._remove(LEARNED_FILE)
+            self._job = job
+            self._write_status(job)
+
+        threading.Thread(target=self._run, args=(job, session_factory), name='ai-training', daemon=True).start()
+        logger.info(f"Entrenamiento de IA {job.id} iniciado por {requested_by}")
+        return job.to_dict(), True
+
+    def _write_status(self, job):
+        _write_json(self._path(STATUS_FILE), job.to_dict())
+
+    def _remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def _read_learned(self, offset):
+        """Pares guardados hasta offset; lo escrito después del último punto de control se descarta"""
+        learned = {}
+        path = self._path(LEARNED_FILE)
+        if not os.path.exists(path):
+            return learned
+        with open(path, 'r+b') as f:
+            for line in f.read(offset).splitlines():
+                key, *entry = json.loads(line)
+                learned[key] = entry
+            f.truncate(offset)
+        return learned
+
+    def _write_checkpoint(self, job):
+        """Añade a LEARNED_FILE solo los pares cambiados y luego guarda los metadatos
+
+        Cuando el fichero acumula más del doble de líneas que pares, se reescribe entero.
+        """
+        path = self._path(LEARNED_FILE)
+        if self._learned_lines > 2 * len(job.learned) + self.chunk_size:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            keys, mode = job.learned.keys(), 'wb'
+        else:
+            tmp_path, keys, mode = path, job.dirty, 'ab'
+        with open(tmp_path, mode) as f:
+            for key in keys:
+                f.write(json.dumps([key] + job.learned[key], ensure_ascii=False).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        if tmp_path != path:
+            os.replace(tmp_path, path)
+            self._learned_lines = len(job.learned)
+        else:
+            self._learned_lines += len(job.dirty)
+        job.dirty.clear()
+        _write_json(self._path(CHECKPOINT_FILE), job.checkpoint(offset))
+
+    def _read_chunks(self, db, job):
+        """Bloques (último id, filas) de mensajes posteriores a job.last_id"""
+        from shared.database import Message
+
+        last_id = job.last_id
+        while True:
+            rows = db.query(
+                Message.id, Message.content, Message.response, Message.confidence
+            ).filter(Message.id > last_id).order_by(Message.id).limit(self.chunk_size).all()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield last_id, [(row.content, row.response, row.confidence) for row in rows]
+
+    def _run(self, job, session_factory):
+        from shared.database import Message
+        from sqlalchemy import func
+
+        executor = None
+        # Al reanudar, el fichero contiene al menos un par por clave
+        self._learned_lines = len(job.learned)
+        db = session_factory()
+        try:
+            job.total = db.query(func.count(Message.id)).scalar() or 0
+            if self.workers > 0:
+                # spawn: el worker de gunicorn tiene hilos y fork podría heredar bloqueos
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+
+            pending = deque()
+            last_checkpoint = time.monotonic()
+
+            def consume():
+                chunk_last_id, size, result = pending.popleft()
+                job.learn(result.result() if executor is not None else result)
+                # Los bloques se consumen en orden, así que last_id nunca salta mensajes
+                job.last_id = chunk_last_id
+                job.processed += size
+                self._write_status(job)
+
+            for chunk_last_id, rows in self._read_chunks(db, job):
+                if executor is not None:
+                    result = executor.submit(vectorize_chunk, rows, job.min_confidence)
+                else:
+                    result = vectorize_chunk(rows, job.min_confidence)
+                pending.append((chunk_last_id, len(rows), result))
+                # Lectura de la base de datos solapada con la tokenización en el pool
+                while len(pending) > max(self.workers, 1) * 2:
+                    consume()
+                if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                    self._write_checkpoint(job)
+                    last_checkpoint = time.monotonic()
+            while pending:
+                consume()
+            self._write_checkpoint(job)
+            # La conexión no hace falta mientras se publica
+            db.close()
+
+            job.status = STATUS_PUBLISHING
+            self._write_status(job)
+            job.published = self._publish(job, session_factory)
+
+            job.status = STATUS_DONE
+            job.finished_at = datetime.now()
+            self._write_status(job)
+            self._remove(CHECKPOINT_FILE)
+            self._remove(LEARNED_FILE)
+            logger.info(
+                f"Entrenamiento {job.id} terminado: {job.processed} mensajes, "
+                f"{len(job.learned)} pares vistos, {job.published} patrones nuevos"
+            )
+        except Exception as e:
+            # El punto de control se conserva para reanudar
+            job.status = STATUS_FAILED
+            job.error = str(e)
+            job.finished_at = datetime.now()
+            self._write_status(job)
+            logger.error(f"Error en el entrenamiento {job.id}: {e}")
+        finally:
+            db.close()
+            if executor is not None:
+                executor.shutdown()
+            self._run_lock.release()
+
+    def _publish(self, job, session_factory):
+        """Aprende los pares nuevos con SimpleAI.learn y sustituye el índice de una vez
+
+        Se descartan los pares vistos menos de MIN_OCCURRENCES veces y los que
+        responden con la respuesta de un patrón existente: son mensajes que el
+        propio bot contestó con ese patrón y solo darían casi duplicados.
+        """
+        from shared.database import AIPattern
+        from .ai_engine import ai_engine
+        from .middleware import clear_response_cache
+
+        db = session_factory()
+        try:
+            existing = {pattern for (pattern,) in db.query(AIPattern.pattern).yield_per(1000)}
+            answers = {response for (response,) in db.query(AIPattern.response).distinct().yield_per(1000)}
+        finally:
+            db.close()
+
+        ai = ai_engine.get()
+        created = 0
+        for pattern, response, confidence, appearances in job.learned.values():
+            if appearances < MIN_OCCURRENCES or pattern in existing or response in answers:
+                continue
+            existing.add(pattern)
+            if ai.learn(pattern, response, confidence):
+                created += 1
+
+        # El índice nuevo se construye aparte y se publica con un solo cambio de referencia
+        if created:
+            index, change_id = ai_engine.build_index()
+            ai_engine.publish_index(index, change_id)
+            clear_response_cache()
+        return created
+
+trainer = Trainer()
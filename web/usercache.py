@@ -0,0 +1,143 @@
+"""
+Caché de usuarios para Flask-Login
+Guarda copias ligeras y desconectadas de web_users (LRU con caducidad) para
+que autenticar una solicitud no consulte la base de datos
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from flask_login import UserMixin
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger('web')
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+# Comprobar auth_version en cada solicitud: un cambio de contraseña o de
+# is_admin hecho en otro worker se aplica en la siguiente solicitud
+USER_CACHE_VERSION_CHECK = os.environ.get('USER_CACHE_VERSION_CHECK', '1') == '1'
+
+# Cambios que obligan a invalidar la copia cacheada
+AUTH_FIELDS = ('password_hash', 'is_admin', 'username')
+
+class CachedUser(UserMixin):
+    """Copia de solo lectura de un usuario web, sin sesión de SQLAlchemy"""
+
+    def __init__(self, id, username, is_admin, auth_version=0):
+        self.id = id
+        self.username = username
+        self.is_admin = bool(is_admin)
+        self.auth_version = auth_version or 0
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(user.id, user.username, user.is_admin, getattr(user, 'auth_version', 0))
+
+class UserCache:
+    """LRU con caducidad de CachedUser indexado por id"""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, version_check=USER_CACHE_VERSION_CHECK):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_check = version_check
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._model = None
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, model):
+        """Modelo de usuario del que se cargan las entradas"""
+        self._model = model
+
+    def _load(self, user_id):
+        user = self._model.query.get(user_id)
+        return CachedUser.from_model(user) if user is not None else None
+
+    def _current_version(self, user_id):
+        return self._model.query.with_entities(self._model.auth_version).filter_by(id=user_id).scalar()
+
+    def get(self, user_id):
+        """Usuario cacheado, cargándolo de la base de datos si falta o caducó"""
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                cached = entry[1]
+            else:
+                cached = None
+
+        if cached is not None and self.version_check and self._current_version(user_id) != cached.auth_version:
+            cached = None
+
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        user = self._load(user_id)
+        if user is None:
+            self.invalidate(user_id)
+            return None
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(int(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+user_cache = UserCache()
+
+def _bump_version(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in AUTH_FIELDS):
+        target.auth_version = (target.auth_version or 0) + 1
+
+def _mark_changed(mapper, connection, target):
+    # Antes del commit otra solicitud aún leería la fila antigua y la volvería a cachear
+    if target.id is not None:
+        session = inspect(target).session
+        if session is not None:
+            session.info.setdefault('user_cache_invalidate', set()).add(target.id)
+
+def _invalidate_committed(session):
+    for user_id in session.info.pop('user_cache_invalidate', ()):
+        user_cache.invalidate(user_id)
+
+def _discard_changed(session):
+    session.info.pop('user_cache_invalidate', None)
+
+_session_hooks_installed = False
+
+def install_user_cache(model):
+    """Enlaza la caché al modelo e invalida las entradas al confirmar cambios o borrados de usuarios"""
+    global _session_hooks_installed
+    user_cache.bind(model)
+    event.listen(model, 'before_update', _bump_version)
+    event.listen(model, 'after_update', _mark_changed)
+    event.listen(model, 'after_delete', _mark_changed)
+    if not _session_hooks_installed:
+        event.listen(Session, 'after_commit', _invalidate_committed)
+        event.listen(Session, 'after_rollback', _discard_changed)
+        _session_hooks_installed = True
+
+def ensure_auth_version_column(bind, table='web_users'):
+    """Añade web_users.auth_version a las bases de datos creadas antes de la columna"""
+    columns = {column['name'] for column in inspect(bind).get_columns(table)}
+    if 'auth_version' not in columns:
+        with bind.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN auth_version INTEGER NOT NULL DEFAULT 0"))
+        logger.info(f"Columna auth_version añadida a {table}")
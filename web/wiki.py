@@ -0,0 +1,94 @@
+"""
+Caché de la wiki del proyecto
+Renderiza WIKI.md una sola vez por versión del fichero (mtime y tamaño) y
+precalcula las anclas del índice y la ETag de la página
+"""
+import os
+import re
+import html
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger('web')
+
+WIKI_PATH = 'WIKI.md'
+# Niveles de encabezado que aparecen en el índice
+TOC_LEVELS = (1, 2, 3)
+
+_HEADING_RE = re.compile(r'<h([1-6]) id="([^"]+)">(.*?)</h\1>', re.S)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+class WikiPage:
+    """Versión renderizada de la wiki"""
+
+    def __init__(self, key, content, toc, etag, last_modified):
+        self.key = key
+        self.content = content
+        self.toc = toc
+        self.etag = etag
+        self.last_modified = last_modified
+
+def _extract_toc(content):
+    """Lista de (nivel, ancla, título) a partir de los encabezados con id"""
+    toc = []
+    for level, anchor, title in _HEADING_RE.findall(content):
+        level = int(level)
+        if level in TOC_LEVELS:
+            toc.append((level, anchor, html.unescape(_TAG_RE.sub('', title)).strip()))
+    return toc
+
+def render_wiki(text):
+    """Convierte el Markdown en HTML con ids en los encabezados"""
+    import markdown2
+    content = str(markdown2.markdown(text, extras=['header-ids', 'fenced-code-blocks', 'tables']))
+    return content, _extract_toc(content)
+
+class WikiCache:
+    """Mantiene la última versión renderizada de la wiki"""
+
+    def __init__(self, path=WIKI_PATH):
+        self.path = path
+        self._page = None
+        self._lock = threading.Lock()
+
+    def _stat_key(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self):
+        """Devuelve la página vigente, volviendo a renderizar solo si el fichero cambió"""
+        key = self._stat_key()
+        page = self._page
+        if page is not None and page.key == key:
+            return page
+
+        with self._lock:
+            page = self._page
+            if page is not None and page.key == key:
+                return page
+
+            with open(self.path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            content, toc = render_wiki(text)
+            page = WikiPage(
+                key=key,
+                content=content,
+                toc=toc,
+                etag=hashlib.sha256(content.encode('utf-8')).hexdigest()[:32],
+                last_modified=datetime.fromtimestamp(key[0] / 1e9, tz=timezone.utc).replace(microsecond=0)
+            )
+            self._page = page
+            logger.info(f"Wiki renderizada ({len(toc)} secciones, {key[1]} bytes)")
+            return page
+
+    def warm_up(self):
+        """Precompila la wiki al arrancar; no falla si el fichero no existe"""
+        try:
+            return self.get()
+        except FileNotFoundError:
+            logger.warning(f"No se encontró {self.path}, la wiki se renderizará al crearse")
+            return None
+
+wiki_cache = WikiCache()